@@ -0,0 +1,439 @@
+"""asyncio protocols for the bridge.
+
+These let the bridge run inside an asyncio application, on its event loop,
+rather than alongside it with the Twisted reactor in another thread.
+
+The Twisted protocols only rely on the reactor for the time, and for their
+transports, so rather than duplicating them the protocols here drive the
+same `onkyo_serial.iscp` and `onkyo_serial.command` objects: asyncio
+transports are adapted to Twisted transports, and timers are scheduled on
+the event loop by `LoopClock`. Parsing, translation, receiver state, write
+pacing and slow client handling all behave exactly as they do under
+Twisted.
+
+On Python 2, asyncio is provided by trollius. For example, to bridge a
+receiver behind a console server to eISCP clients::
+
+    loop = asyncio.get_event_loop()
+    device = aio.ISCPProtocol(loop=loop)
+    loop.run_until_complete(loop.create_connection(
+            lambda: device, 'console-server', 7001))
+    loop.run_until_complete(loop.create_server(
+            aio.eISCPServer(device, loop=loop), port=60128))
+    response = loop.run_until_complete(
+            device.command('master-volume=query', wait=True))
+
+A serial port can be connected with pyserial-asyncio's
+create_serial_connection in the same way. Reconnecting after the device is
+lost is left to the application.
+"""
+
+import socket
+
+from twisted.internet import address
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import interfaces as twisted_interfaces
+from twisted.python import failure
+from twisted.python import log
+from zope import interface
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from . import command
+from . import iscp
+from . import ramp
+from . import scheduler
+from . import state
+
+__author__ = 'blaedd@gmail.com'
+
+
+def _loop(loop):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    return loop
+
+
+def toFuture(d, loop=None):
+    """Wrap a Deferred in an asyncio Future.
+
+    Cancelling the Future cancels the Deferred.
+
+    Args:
+        d (:twisted:`twisted.internet.defer.Deferred`): the Deferred.
+        loop: event loop for the Future, defaults to the current loop.
+
+    Returns:
+        asyncio.Future: fires with the result of the Deferred.
+    """
+    future = asyncio.Future(loop=_loop(loop))
+
+    def fired(result):
+        if not future.cancelled():
+            if isinstance(result, failure.Failure):
+                future.set_exception(result.value)
+            else:
+                future.set_result(result)
+
+    def cancelled(f):
+        if f.cancelled():
+            d.cancel()
+
+    d.addBoth(fired)
+    future.add_done_callback(cancelled)
+    return future
+
+
+class _DelayedCall(object):
+    """An :twisted:`twisted.internet.interfaces.IDelayedCall` on a loop."""
+
+    def __init__(self, loop, delay, f, args, kwargs):
+        self._loop = loop
+        self._f = f
+        self._args = args
+        self._kwargs = kwargs
+        self.called = False
+        self.cancelled = False
+        self._schedule(delay)
+
+    def _schedule(self, delay):
+        self.time = self._loop.time() + delay
+        self._handle = self._loop.call_later(delay, self._run)
+
+    def _run(self):
+        self.called = True
+        self._f(*self._args, **self._kwargs)
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled()
+        if self.called:
+            raise error.AlreadyCalled()
+        self.cancelled = True
+        self._handle.cancel()
+
+    def delay(self, secondsLater):
+        self.reset(self.time + secondsLater - self._loop.time())
+
+    def reset(self, secondsFromNow):
+        if not self.active():
+            raise error.AlreadyCalled()
+        self._handle.cancel()
+        self._schedule(secondsFromNow)
+
+
+@interface.implementer(twisted_interfaces.IReactorTime)
+class LoopClock(object):
+    """The parts of the reactor's clock the bridge uses, on an event loop."""
+
+    def __init__(self, loop=None):
+        """
+
+        Args:
+            loop: the event loop, defaults to the current loop.
+        """
+        self.loop = _loop(loop)
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, f, *args, **kwargs):
+        return _DelayedCall(self.loop, delay, f, args, kwargs)
+
+    # noinspection PyMethodMayBeStatic
+    def getDelayedCalls(self):
+        return []
+
+
+def _address(addr):
+    """Convert an asyncio peername/sockname to a Twisted address."""
+    if isinstance(addr, tuple) and len(addr) == 2:
+        return address.IPv4Address('TCP', addr[0], addr[1])
+    if isinstance(addr, tuple) and len(addr) == 4:
+        return address.IPv6Address('TCP', addr[0], addr[1], addr[2], addr[3])
+    return addr
+
+
+@interface.implementer(twisted_interfaces.ITransport,
+                       twisted_interfaces.IConsumer)
+class _Transport(object):
+    """A Twisted transport over an asyncio transport."""
+
+    def __init__(self, transport):
+        self._transport = transport
+        self.producer = None
+        self.disconnecting = False
+
+    def write(self, data):
+        self._transport.write(data)
+
+    def writeSequence(self, data):
+        self._transport.writelines(data)
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self._transport.close()
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self._transport.abort()
+
+    def getPeer(self):
+        return _address(self._transport.get_extra_info('peername'))
+
+    def getHost(self):
+        return _address(self._transport.get_extra_info('sockname'))
+
+    # noinspection PyUnusedLocal
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class _DatagramTransport(object):
+    """A Twisted datagram transport over an asyncio one."""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def write(self, data, addr=None):
+        self._transport.sendto(data, addr)
+
+    def getHost(self):
+        return self._transport.get_extra_info('sockname')
+
+    def setBroadcastAllowed(self, enabled):
+        sock = self._transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, enabled)
+
+    def getBroadcastAllowed(self):
+        sock = self._transport.get_extra_info('socket')
+        if sock is None:
+            return False
+        return bool(sock.getsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST))
+
+    def loseConnection(self):
+        self._transport.close()
+
+
+class _ProtocolAdapter(asyncio.Protocol):
+    """An asyncio protocol driving a Twisted protocol.
+
+    Attributes:
+        protocol (:twisted:`twisted.internet.protocol.Protocol`): the Twisted
+            protocol.
+        transport: its transport, once connected.
+    """
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = _Transport(transport)
+        self.protocol.makeConnection(self.transport)
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        if exc is None:
+            reason = failure.Failure(error.ConnectionDone())
+        else:
+            reason = failure.Failure(error.ConnectionLost(str(exc)))
+        self.protocol.connectionLost(reason)
+
+    def pause_writing(self):
+        if self.transport.producer is not None:
+            self.transport.producer.pauseProducing()
+
+    def resume_writing(self):
+        if self.transport.producer is not None:
+            self.transport.producer.resumeProducing()
+
+
+class ISCPProtocol(_ProtocolAdapter):
+    """asyncio protocol for an ISCP device.
+
+    The `onkyo_serial.interfaces.IISCPDevice` operations are available
+    here, with `command` returning a Future rather than a Deferred, so it
+    can be awaited (or yielded from, with trollius) by coroutines.
+
+    The underlying `onkyo_serial.iscp.ISCP` is `protocol`, and is what
+    should be given to the eISCP and command port servers.
+    """
+
+    def __init__(self, loop=None, baudrate=9600, gap=0.05,
+                 state_ttl=state.DEFAULT_TTL):
+        """
+
+        Args:
+            loop: the event loop, defaults to the current loop.
+            baudrate(int): baudrate of the device, used to pace commands.
+            gap(float): seconds to wait between commands sent to the device.
+            state_ttl(float): seconds a reported value is used to answer
+                queries for.
+        """
+        self.loop = _loop(loop)
+        clock = LoopClock(self.loop)
+        proto = iscp.ISCP(receiver_state=state.ReceiverState(
+                ttl=state_ttl, clock=clock))
+        proto.clock = clock
+        proto.scheduler = scheduler.WriteScheduler(
+                proto.sendLine, baudrate=baudrate, gap=gap, clock=clock,
+                state=proto.receiver_state)
+        _ProtocolAdapter.__init__(self, proto)
+
+    def command(self, line, priority=None, reply=None, wait=False,
+                timeout=iscp.DEFAULT_TIMEOUT, retries=0):
+        """Send a command to the device.
+
+        See `onkyo_serial.iscp.ISCP.command` for the arguments.
+
+        Returns:
+            asyncio.Future: fires with the response if waiting, otherwise
+            with None once the command is queued. Fails with ValueError
+            for invalid commands.
+        """
+        return toFuture(defer.maybeDeferred(
+                self.protocol.command, line, priority=priority, reply=reply,
+                wait=wait, timeout=timeout, retries=retries), self.loop)
+
+    def ramp(self, level, duration=ramp.DEFAULT_DURATION, curve=ramp.LINEAR):
+        """Fade the master volume to a level.
+
+        See `onkyo_serial.iscp.ISCP.ramp` for the arguments.
+
+        Returns:
+            asyncio.Future: fires with the response for the final level.
+        """
+        return toFuture(defer.maybeDeferred(
+                self.protocol.ramp, level, duration=duration, curve=curve),
+                self.loop)
+
+    def add_cb(self, inst, cb, codes=None):
+        """See `onkyo_serial.interfaces.IISCPDevice.add_cb`."""
+        self.protocol.add_cb(inst, cb, codes=codes)
+
+    def remove_cb(self, inst):
+        """See `onkyo_serial.interfaces.IISCPDevice.remove_cb`."""
+        self.protocol.remove_cb(inst)
+
+
+def _device(device):
+    if isinstance(device, ISCPProtocol):
+        return device.protocol
+    return device
+
+
+class eISCPBridgeProtocol(_ProtocolAdapter):
+    """asyncio protocol for an eISCP client, see `eISCPServer`."""
+
+    def __init__(self, factory):
+        """
+
+        Args:
+            factory (onkyo_serial.iscp.eISCPFactory): the shared factory.
+        """
+        _ProtocolAdapter.__init__(self, factory.buildProtocol(None))
+
+
+class CommandPortProtocol(_ProtocolAdapter):
+    """asyncio protocol for a command port client, see `CommandServer`."""
+
+    def __init__(self, factory):
+        """
+
+        Args:
+            factory (onkyo_serial.command.CommandPortFactory): the shared
+                factory.
+        """
+        _ProtocolAdapter.__init__(self, factory.buildProtocol(None))
+
+
+def eISCPServer(device, loop=None, **kwargs):
+    """Create a protocol factory for an eISCP server.
+
+    Args:
+        device (ISCPProtocol): the ISCP device to bridge, or any
+            `onkyo_serial.interfaces.IISCPDevice`.
+        loop: the event loop, defaults to the current loop.
+        kwargs: passed to `onkyo_serial.iscp.eISCPFactory`.
+
+    Returns:
+        callable: a protocol factory for loop.create_server.
+    """
+    factory = iscp.eISCPFactory(_device(device), **kwargs)
+    factory.clock = LoopClock(loop)
+    return lambda: eISCPBridgeProtocol(factory)
+
+
+def CommandServer(device, loop=None, **kwargs):
+    """Create a protocol factory for a command port server.
+
+    Args:
+        device (ISCPProtocol): the ISCP device to control, or any
+            `onkyo_serial.interfaces.IISCPDevice`.
+        loop: the event loop, defaults to the current loop.
+        kwargs: passed to `onkyo_serial.command.CommandPortFactory`.
+
+    Returns:
+        callable: a protocol factory for loop.create_server.
+    """
+    factory = command.CommandPortFactory(_device(device), **kwargs)
+    factory.clock = LoopClock(loop)
+    return lambda: CommandPortProtocol(factory)
+
+
+class eISCPDiscoveryProtocol(asyncio.DatagramProtocol):
+    """asyncio protocol answering eISCP discovery requests.
+
+    Use with loop.create_datagram_endpoint, eg.::
+
+        loop.create_datagram_endpoint(
+                lambda: aio.eISCPDiscoveryProtocol(60128),
+                local_addr=('0.0.0.0', 60128))
+
+    Attributes:
+        protocol (onkyo_serial.iscp.eISCPDiscovery): the discovery protocol,
+            more receivers can be added with its addIdentity.
+    """
+
+    def __init__(self, eiscp_port=60128, loop=None):
+        """
+
+        Args:
+            eiscp_port (int): port of the eISCP bridge to advertise, or
+                None to add identities later.
+            loop: the event loop, defaults to the current loop.
+        """
+        self.protocol = iscp.eISCPDiscovery(eiscp_port,
+                                            clock=LoopClock(loop))
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = _DatagramTransport(transport)
+        self.protocol.makeConnection(self.transport)
+
+    def datagram_received(self, data, addr):
+        self.protocol.datagramReceived(data, addr)
+
+    # noinspection PyMethodMayBeStatic
+    def error_received(self, exc):
+        log.msg('eISCP discovery error: {}'.format(exc))
+
+    def connection_lost(self, exc):
+        self.protocol.doStop()
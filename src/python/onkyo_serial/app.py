@@ -1,20 +1,34 @@
 """Application module for the Onkyo ISCP protocol bridge."""
 
 import functools
+import os
+import re
 
 import sys
 from twisted.application import internet
+from twisted.application import service as app_service
 from twisted.python import log
 from twisted.python import usage
+from twisted.web import server
 
 from . import command
 from . import iscp
+from . import keymap
 from . import lirc
+from . import lircd
+from . import macros
+from . import metrics
+from . import repeat
 from . import service
+from . import simulator
 
 __author__ = 'blaedd@gmail.com'
 
-PORT_TYPES = ['command', 'eiscp', 'lirc']
+PORT_TYPES = ['command', 'eiscp', 'lirc', 'lircd', 'metrics']
+ISCP_TYPES = ['serial', 'tcp', 'sim']
+
+# Ports of each additional receiver are offset by this much from the last.
+PORT_STRIDE = 10
 
 
 class GenericOptions(usage.Options):
@@ -40,18 +54,42 @@ class RunOptions(GenericOptions):
          'Type of ports to listen on. Valid types are: {}'.format(
                  ','.join(PORT_TYPES))
          ],
-        ['iscp_type', 't', 'serial', 'Type of ISCP device, serial, tcp'],
+        ['iscp_type', 't', 'serial', 'Type of ISCP device, serial, tcp, sim'],
         ['iscp_device', 'd', '/dev/ttyUSB1',
          'Device (or host:port) for the ISCP device'],
         ['command_port', 'c', '60129', 'Command port to listen on'],
-        # ['lirc_socket', 's', '/var/run/lirc/lircd', 'Path to lirc socket.'],
+        ['command_gap', 'g', '0.05',
+         'Seconds to wait between commands sent to a serial device, or a '
+         'console server'],
+        ['state_ttl', None, '30',
+         'Seconds to answer queries from the last reported value'],
+        ['state_dir', None, None,
+         'Directory to save receiver state in between runs [default: '
+         '$XDG_CACHE_HOME/onkyo_serial]'],
+        ['slow_client', None, iscp.COALESCE,
+         'What to do when an eISCP client falls behind: {}'.format(
+                 ', '.join(iscp.SLOW_CLIENT_POLICIES))],
+        ['metrics_port', 'm', '60130',
+         'Local HTTP port to serve Prometheus metrics on'],
+        ['lirc_socket', 's', lircd.DEFAULT_SOCKET,
+         'Path to the lircd socket, for lircd'],
         ['lirc_config', None, None, 'Path to a custom lirc configuration file.'],
+        ['lirc_repeat', None, str(repeat.DEFAULT_MIN_INTERVAL),
+         'Seconds between repeats of a held remote key'],
+        ['macros', None, None,
+         'Config file of named command batches for the command port'],
+    ]
+
+    optFlags = [
+        ['no_state', None, 'Do not save receiver state between runs'],
     ]
 
     compData = usage.Completions(
             optActions={
                 'iscp_type': usage.CompleteList(
-                        items=['serial', 'tcp'], repeat=False),
+                        items=ISCP_TYPES, repeat=False),
+                'slow_client': usage.CompleteList(
+                        items=iscp.SLOW_CLIENT_POLICIES, repeat=False),
                 'listen': usage.CompleteMultiList(
                         items=[PORT_TYPES]
                 )
@@ -59,6 +97,49 @@ class RunOptions(GenericOptions):
             }
     )
 
+    # Numeric options, converted by postOptions: the type, the value they
+    # must be below (and at least 0) and what they are, for errors.
+    _numbers = [
+        ('eiscp', int, 65536, 'eISCP port'),
+        ('command_port', int, 65536, 'command port'),
+        ('metrics_port', int, 65536, 'metrics port'),
+        ('command_gap', float, float('inf'), 'command gap'),
+        ('state_ttl', float, float('inf'), 'state TTL'),
+        ('lirc_repeat', float, float('inf'), 'lirc repeat interval'),
+    ]
+
+    def __init__(self):
+        GenericOptions.__init__(self)
+        self['receivers'] = []
+
+    def opt_receiver(self, spec):
+        """TYPE,DEVICE[,EISCP_PORT[,COMMAND_PORT]] of a receiver, repeatable"""
+        parts = spec.split(',')
+        if not 2 <= len(parts) <= 4 or parts[0] not in ISCP_TYPES:
+            raise usage.UsageError('Invalid receiver: {}'.format(spec))
+        try:
+            ports = [int(p) for p in parts[2:]]
+        except ValueError:
+            raise usage.UsageError('Invalid receiver ports: {}'.format(spec))
+        self['receivers'].append(
+                (parts[0], parts[1]) + tuple(ports + [None] * (2 - len(ports))))
+
+    def receivers(self):
+        """Return (iscp_type, iscp_device, eiscp_port, command_port) for each
+        receiver to bridge.
+        """
+        specs = self['receivers'] or [
+            (self['iscp_type'], self['iscp_device'], None, None)]
+        receivers = []
+        for i, (iscp_type, device, eiscp_port, command_port) in enumerate(
+                specs):
+            if eiscp_port is None:
+                eiscp_port = self['eiscp'] + i * PORT_STRIDE
+            if command_port is None:
+                command_port = self['command_port'] + i * PORT_STRIDE
+            receivers.append((iscp_type, device, eiscp_port, command_port))
+        return receivers
+
     def postOptions(self):
         self.opts['listen'] = self.opts['listen'].split(',')
         port_set = set(PORT_TYPES)
@@ -67,6 +148,66 @@ class RunOptions(GenericOptions):
             raise usage.UsageError(
                     'Invalid port types: {}\n Valid types: {}'.format(
                             ','.join(invalid_ports), ','.join(PORT_TYPES)))
+        if self.opts['slow_client'] not in iscp.SLOW_CLIENT_POLICIES:
+            raise usage.UsageError(
+                    'Invalid slow client policy: {}'.format(
+                            self.opts['slow_client']))
+        for name, kind, limit, what in self._numbers:
+            try:
+                value = kind(self.opts[name])
+            except ValueError:
+                value = None
+            if value is None or not 0 <= value < limit:
+                raise usage.UsageError(
+                        'Invalid {}: {}'.format(what, self.opts[name]))
+            self.opts[name] = value
+        if self.opts['macros'] is not None:
+            try:
+                self.opts['macros'] = macros.load(self.opts['macros'])
+            except ValueError, e:
+                raise usage.UsageError(e.args[0])
+        if 'lirc' in self.opts['listen'] and lirc.pylirc is None:
+            raise usage.UsageError(
+                    'lirc needs pylirc, which is not installed, try lircd')
+        self.opts['keymap'] = None
+        if 'lirc' in self.opts['listen'] or 'lircd' in self.opts['listen']:
+            if not self.opts['lirc_config']:
+                # Where pylirc looks by default.
+                path = os.path.expanduser(keymap.DEFAULT_LIRCRC)
+                if not os.path.exists(path):
+                    raise usage.UsageError(
+                            'No lircrc at {}, give one with --lirc_config'
+                            .format(path))
+                self.opts['lirc_config'] = path
+            lirc_keymap = keymap.Keymap(self.opts['lirc_config'],
+                                        self.opts['program_name'])
+            try:
+                lirc_keymap.load()
+            except ValueError, e:
+                raise usage.UsageError(e.args[0])
+            self.opts['keymap'] = lirc_keymap
+
+
+class SimulateOptions(usage.Options):
+    """Options related to running a simulated receiver."""
+    optParameters = [
+        ['listen', 'l', 'tcp:60200',
+         'Endpoint to serve the simulated receiver on, or pty'],
+        ['baudrate', 'b', '9600', 'Simulated baud rate'],
+        ['delay', None, '0.05', 'Seconds taken to process each command'],
+        ['max_pending', None, '4',
+         'Commands that can wait to be processed before more are dropped'],
+        ['unsolicited', None, '10', 'Seconds between unsolicited updates'],
+    ]
+
+    def simulatorArgs(self):
+        """Return the keyword arguments for a `simulator.SimulatedReceiver`."""
+        return {
+            'baudrate': int(self['baudrate']),
+            'processing_delay': float(self['delay']),
+            'max_pending': int(self['max_pending']),
+            'unsolicited_interval': float(self['unsolicited']),
+        }
 
 
 class Options(usage.Options):
@@ -75,49 +216,153 @@ class Options(usage.Options):
     subCommands = [
         ['lirc_config', None, LircRcOptions, 'Write a default lircrc'],
         ['run', None, RunOptions, 'Run the server'],
+        ['simulate', None, SimulateOptions, 'Run a simulated receiver'],
     ]
     defaultSubCommand = 'run'
 
 
-def makeService(config):
-    """Create the ISCP service.
+def stateFile(config, iscp_device):
+    """Return the file to save a device's state in, or None.
 
     Args:
         config (RunOptions): configuration for the service.
+        iscp_device (str): device (or host:port) of the ISCP device.
     """
-    if config['iscp_type'] == 'serial':
-        iscp_service = service.SerialISCPService(config['iscp_device'])
+    if config['no_state']:
+        return None
+    state_dir = config['state_dir']
+    if state_dir is None:
+        from xdg import BaseDirectory
+        state_dir = BaseDirectory.save_cache_path('onkyo_serial')
+    name = re.sub(r'[^A-Za-z0-9.-]+', '_', iscp_device).strip('_')
+    return os.path.join(state_dir, 'state-{}.json'.format(name))
+
+
+def makeDeviceService(config, iscp_type, iscp_device, eiscp_port,
+                      command_port, discovery=None):
+    """Create the service for one ISCP device, and the ports bridging to it.
+
+    Args:
+        config (RunOptions): configuration for the service.
+        iscp_type (str): serial, tcp or sim.
+        iscp_device (str): device (or host:port) of the ISCP device.
+        eiscp_port (int): port to listen for eISCP on.
+        command_port (int): port to listen for commands on.
+        discovery (iscp.eISCPDiscovery): discovery protocol to advertise
+            the eISCP port with.
+    """
+    if iscp_type in ('serial', 'sim'):
+        sim_service = None
+        device = iscp_device
+        if iscp_type == 'sim':
+            sim_service = simulator.PtySimulatorService()
+            device = sim_service.device
+        # A simulator's state doesn't outlive it.
+        iscp_service = service.SerialISCPService(
+                device, gap=config['command_gap'],
+                state_ttl=config['state_ttl'],
+                state_file=(None if sim_service is not None
+                            else stateFile(config, device)))
+        if sim_service is not None:
+            sim_service.setServiceParent(iscp_service)
     else:
-        host, port = config['iscp_device'].split(':', 1)
-        iscp_service = service.ISCPTCPService(host, int(port))
-    eiscp_port = int(config['eiscp'])
-    command_port = int(config['command_port'])
+        host, port = iscp_device.split(':', 1)
+        iscp_service = service.ISCPTCPService(
+                host, int(port), gap=config['command_gap'],
+                state_ttl=config['state_ttl'],
+                state_file=stateFile(config, iscp_device))
 
     if 'eiscp' in config['listen']:
         eiscp_service = service.OnkyoService(
                 'tcp:{}'.format(eiscp_port),
-                functools.partial(iscp.eISCPFactory, iscp_service.getProtocol()))
+                functools.partial(iscp.eISCPFactory, iscp_service.getProtocol(),
+                                  policy=config['slow_client']))
         eiscp_service.setServiceParent(iscp_service)
-
-        discovery = iscp.eISCPDiscovery(eiscp_port)
-        # noinspection PyUnresolvedReferences
-        discovery_service = internet.UDPServer(eiscp_port, discovery)
-        discovery_service.setServiceParent(iscp_service)
+        if discovery is not None:
+            discovery.addIdentity(eiscp_port)
 
     if 'command' in config['listen']:
         command_service = service.OnkyoService(
                 'tcp:{}'.format(command_port),
-                functools.partial(command.CommandPortFactory, iscp_service.getProtocol()))
+                functools.partial(command.CommandPortFactory,
+                                  iscp_service.getProtocol(),
+                                  macros=config['macros']))
         command_service.setServiceParent(iscp_service)
+    return iscp_service
+
+
+def makeService(config):
+    """Create the bridge service, with a child service for each ISCP device.
+
+    All devices share one eISCP discovery socket, which advertises each of
+    them. lirc commands go to the first device.
+
+    Args:
+        config (RunOptions): configuration for the service.
+    """
+    bridge = app_service.MultiService()
+    receivers = config.receivers()
+
+    discovery = None
+    if 'eiscp' in config['listen']:
+        discovery = iscp.eISCPDiscovery(None)
+        # Discovery stays on the standard port, whatever the eISCP ports are.
+        # noinspection PyUnresolvedReferences
+        discovery_service = internet.UDPServer(config['eiscp'], discovery)
+        discovery_service.setServiceParent(bridge)
+
+    devices = []
+    for receiver in receivers:
+        iscp_service = makeDeviceService(config, *receiver, discovery=discovery)
+        iscp_service.setServiceParent(bridge)
+        devices.append(iscp_service)
+
+    if 'metrics' in config['listen']:
+        metrics_service = service.OnkyoService(
+                'tcp:{}:interface=127.0.0.1'.format(config['metrics_port']),
+                functools.partial(server.Site, metrics.MetricsResource()))
+        metrics_service.setServiceParent(bridge)
 
     if 'lirc' in config['listen']:
         from twisted.internet import reactor
-        ep = lirc.LircEndPoint(reactor, config['program_name'], config['lirc_config'])
+        ep = lirc.LircEndPoint(
+                reactor, config['program_name'], config['lirc_config'],
+                repeat_filter=repeat.RepeatFilter(
+                        min_interval=config['lirc_repeat']),
+                keymap=config['keymap'])
         lirc_service = lirc.LircClientService(
                 ep,
-                functools.partial(command.CommandPortFactory, iscp_service.getProtocol()))
-        lirc_service.setServiceParent(iscp_service)
-    return iscp_service
+                functools.partial(command.CommandPortFactory,
+                                  devices[0].getProtocol(),
+                                  macros=config['macros']),
+                keymap=config['keymap'])
+        lirc_service.setServiceParent(devices[0])
+
+    if 'lircd' in config['listen']:
+        lircd_service = lircd.LircdClientService(
+                config['lirc_socket'],
+                functools.partial(command.CommandPortFactory,
+                                  devices[0].getProtocol(),
+                                  macros=config['macros']),
+                config['keymap'],
+                repeat_filter=repeat.RepeatFilter(
+                        min_interval=config['lirc_repeat']))
+        lircd_service.setServiceParent(devices[0])
+    return bridge
+
+
+def makeSimulatorService(config):
+    """Create a simulated receiver service.
+
+    Args:
+        config (SimulateOptions): configuration for the simulator.
+    """
+    if config['listen'] == 'pty':
+        return simulator.PtySimulatorService(**config.simulatorArgs())
+    return service.OnkyoService(
+            config['listen'],
+            functools.partial(simulator.SimulatorFactory,
+                              **config.simulatorArgs()))
 
 
 def start():
@@ -143,8 +388,20 @@ def start():
         log.msg('Starting...')
 
         # noinspection PyTypeChecker
-        iscp_service = makeService(config.subOptions)
-        iscp_service.startService()
+        bridge = makeService(config.subOptions)
+        bridge.startService()
+
+        reactor.run()
+    elif config.subCommand == 'simulate':
+        from twisted.internet import reactor
+
+        observer = log.startLogging(sys.stdout)
+        observer.timeFormat = ''
+        log.msg('Starting simulated receiver...')
+
+        # noinspection PyTypeChecker
+        sim_service = makeSimulatorService(config.subOptions)
+        sim_service.startService()
 
         reactor.run()
     else:
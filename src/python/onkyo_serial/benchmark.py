@@ -0,0 +1,297 @@
+"""Benchmarks for the bridge's hot paths.
+
+Run with::
+
+    python -m onkyo_serial.benchmark --output results.json
+
+Results are written as JSON, so they can be compared between commits.
+Each benchmark is run several times and the best time is reported, which
+is the least noisy figure on a shared machine.
+"""
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import timeit
+
+from twisted.internet import task
+from twisted.python import usage
+from twisted.test import proto_helpers
+
+from . import command
+from . import iscp
+
+__author__ = 'blaedd@gmail.com'
+
+FANOUT_CLIENTS = (1, 10, 100, 1000)
+
+# A representative mix of responses from a receiver.
+RESPONSES = ['PWR01', 'MVL2A', 'AMT00', 'SLI10', 'LMD0C', 'TUN08750',
+             'DIM00', 'SLA00', 'IFAHDMI 1,PCM,48 kHz,2.0 ch,Stereo,',
+             'NTM00:01:25/04:12']
+
+# And of commands from clients.
+COMMANDS = ['master-volume=level-up', 'master-volume=level-down',
+            'system-power=query', 'master-volume=query', '!1PWR01', 'MVL20',
+            'input-selector=dvd', 'audio-muting=toggle']
+
+
+class _Parser(iscp.eISCPMixin):
+    """Stand-in for an eISCP bridge that discards parsed commands."""
+
+    def __init__(self):
+        iscp.eISCPMixin.__init__(self)
+        self.count = 0
+
+    def doCmd(self, cmd):
+        self.count += 1
+
+
+def _connectedISCP():
+    proto = iscp.ISCP()
+    proto.makeConnection(proto_helpers.StringTransport())
+    return proto
+
+
+def _time(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def _result(name, operations, seconds, **extra):
+    result = {'name': name,
+              'operations': operations,
+              'seconds': seconds,
+              'per_second': operations / seconds if seconds else None}
+    result.update(extra)
+    return result
+
+
+def _chunks(data, rng, low, high):
+    chunks = []
+    i = 0
+    while i < len(data):
+        n = rng.randint(low, high)
+        chunks.append(data[i:i + n])
+        i += n
+    return chunks
+
+
+def benchParse(number, repeat):
+    """eISCPMixin._processData with whole, fragmented and garbage input."""
+    rng = random.Random(0)
+    packets = [iscp.command_to_packet(r) for r in RESPONSES]
+    stream = ''.join(packets)
+    inputs = [
+        ('parse_whole', packets),
+        ('parse_fragmented', _chunks(stream, rng, 1, 7)),
+        ('parse_garbage',
+         ['\x00garbage\xffIS' + p for p in packets]),
+    ]
+    results = []
+    for name, chunks in inputs:
+        def run():
+            parser = _Parser()
+            for chunk in chunks:
+                parser._processData(chunk)
+        seconds = _time(run, number, repeat)
+        results.append(_result(name, number * len(packets), seconds))
+    return results
+
+
+def benchDecode(number, repeat):
+    """ISCP.lineReceived decode rate, with no callbacks."""
+    proto = _connectedISCP()
+    lines = ['!1{}'.format(r) for r in RESPONSES]
+
+    def run():
+        for line in lines:
+            proto.lineReceived(line)
+    return [_result('decode', number * len(lines),
+                    _time(run, number, repeat))]
+
+
+def benchTranslate(number, repeat):
+    """ISCP.command translation rate."""
+    proto = _connectedISCP()
+
+    def run():
+        for cmd in COMMANDS:
+            proto.command(cmd)
+        proto.transport.clear()
+    return [_result('translate', number * len(COMMANDS),
+                    _time(run, number, repeat))]
+
+
+def benchFanout(number, repeat, clients=FANOUT_CLIENTS):
+    """Cost of one response with many eISCP and command port clients."""
+    results = []
+    lines = ['!1{}'.format(r) for r in RESPONSES]
+    for n in clients:
+        proto = _connectedISCP()
+        factories = [('fanout_eiscp', iscp.eISCPFactory(proto)),
+                     ('fanout_command', command.CommandPortFactory(proto))]
+        for name, factory in factories:
+            protocols, transports = [], []
+            for _ in range(n):
+                client = factory.buildProtocol(None)
+                tr = proto_helpers.StringTransport()
+                client.makeConnection(tr)
+                protocols.append(client)
+                transports.append(tr)
+
+            def run():
+                for line in lines:
+                    proto.lineReceived(line)
+                for tr in transports:
+                    tr.clear()
+            # Keep the total work roughly constant as clients grow.
+            iterations = max(1, number // n)
+            seconds = _time(run, iterations, repeat)
+            results.append(_result(name, iterations * len(lines), seconds,
+                                   clients=n))
+            for client in protocols:
+                client.connectionLost(None)
+    return results
+
+
+def benchDispatch(number, repeat, clients=FANOUT_CLIENTS):
+    """Cost of one response with many subscribers, each for one command."""
+    results = []
+    lines = ['!1{}'.format(r) for r in RESPONSES]
+    for n in clients:
+        proto = _connectedISCP()
+        for i in range(n):
+            proto.add_cb(i, lambda resp: None, codes=['MVL'])
+
+        def run():
+            for line in lines:
+                proto.lineReceived(line)
+        iterations = max(1, number // n)
+        seconds = _time(run, iterations, repeat)
+        results.append(_result('dispatch_filtered', iterations * len(lines),
+                               seconds, clients=n))
+    return results
+
+
+def benchDiscovery(number, repeat, sources=256):
+    """eISCP discovery queries, from new hosts and flooding ones."""
+    # As onkyo-eiscp sends it.
+    query = iscp.message_to_packet(iscp.DISCOVERY_QUERY)
+    addrs = [('10.0.{}.{}'.format(i // 256, i % 256), 60128)
+             for i in xrange(sources)]
+    results = []
+    for name, advance in (('discovery_answered', iscp.DISCOVERY_INTERVAL),
+                          ('discovery_limited', 0)):
+        clock = task.Clock()
+        discovery = iscp.eISCPDiscovery(60128, clock=clock)
+        discovery.transport = proto_helpers.FakeDatagramTransport()
+
+        def run():
+            for addr in addrs:
+                discovery.datagramReceived(query, addr)
+            clock.advance(advance)
+            del discovery.transport.written[:]
+        results.append(_result(name, number * sources,
+                               _time(run, number, repeat)))
+    return results
+
+
+# Resolved on import, as the working directory may change before use.
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter by benchStartup. Prints import time, time to
+# the first translation, and whether the onkyo-eiscp tables were imported.
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.time()
+from onkyo_serial import command, iscp
+imported = time.time()
+from onkyo_serial import translate
+translate.TRANSLATOR.translate('master-volume=level-up')
+translate.DECODER.decode('PWR01')
+print(json.dumps([imported - start, time.time() - imported,
+                  'eiscp.commands' in sys.modules]))
+"""
+
+
+def benchStartup(number, repeat):
+    """Time to import the bridge, and to translate its first command.
+
+    Each timing is in a new interpreter, so `number` is ignored. The
+    compiled command tables are built first, so this measures a warm cache.
+    """
+    from . import tables
+    tables.build()
+    env = dict(os.environ, PYTHONPATH=_PACKAGE_ROOT)
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+                [sys.executable, '-c', _STARTUP_SCRIPT], env=env)
+        timings.append(json.loads(output))
+    import_seconds, first_seconds, eiscp_loaded = min(timings)
+    return [_result('startup_import', 1, import_seconds),
+            _result('startup_first_translate', 1, first_seconds,
+                    eiscp_loaded=eiscp_loaded)]
+
+
+BENCHMARKS = [benchParse, benchDecode, benchTranslate, benchFanout,
+              benchDispatch, benchDiscovery, benchStartup]
+
+
+def run(number=1000, repeat=5):
+    """Run all benchmarks.
+
+    Args:
+        number (int): iterations per timing.
+        repeat (int): number of timings, the best is reported.
+
+    Returns:
+        dict: the results, along with some details of the environment.
+    """
+    results = []
+    for bench in BENCHMARKS:
+        results.extend(bench(number, repeat))
+    return {
+        'meta': {
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'number': number,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+class Options(usage.Options):
+    """Benchmark options."""
+    optParameters = [
+        ['output', 'o', None, 'File to write JSON results to, or stdout.'],
+        ['number', 'n', '1000', 'Iterations per timing.'],
+        ['repeat', 'r', '5', 'Number of timings, the best is reported.'],
+    ]
+
+
+def start():
+    config = Options()
+    try:
+        config.parseOptions()
+    except usage.UsageError as errortext:
+        print('{}: {}'.format(sys.argv[0], errortext))
+        print('{}: Try --help for usage details'.format(sys.argv[0]))
+        sys.exit(1)
+
+    results = run(int(config['number']), int(config['repeat']))
+    if config['output'] is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(config['output'], 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    start()
@@ -1,13 +1,33 @@
 """Handle user-friendly commands as per onkyo_eiscp."""
 
-from eiscp import core
+from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.protocols import basic
 
 from . import interfaces
+from . import macros
+from . import metrics
+from . import translate
 
 __author__ = 'blaedd@gmail.com'
 
+# Most times a command can be sent with 'repeat N COMMAND'.
+MAX_REPEAT = 20
+
+_received_commands = metrics.REGISTRY.counter(
+        'onkyo_serial_command_port_commands_total',
+        'Commands received on the command port.')
+_invalid_commands = metrics.REGISTRY.counter(
+        'onkyo_serial_command_port_invalid_commands_total',
+        'Invalid commands received on the command port.')
+_sent_responses = metrics.REGISTRY.counter(
+        'onkyo_serial_command_port_responses_total',
+        'Responses sent to command port clients.')
+_batches = metrics.REGISTRY.counter(
+        'onkyo_serial_command_port_batches_total',
+        'Batches and macros run from the command port, by result.',
+        ('result',))
+
 
 # noinspection PyClassHasNoInit
 class CommandPort(basic.LineOnlyReceiver):
@@ -15,44 +35,194 @@ class CommandPort(basic.LineOnlyReceiver):
 
     It uses the command mappings from the onkyo-eiscp package, but you
     can also send raw ISCP commands with the 'raw ' prefix.
+
+    By default every response from the receiver is sent to the client.
+    'subscribe MVL,AMT' limits that to responses for those ISCP commands
+    (or command prefixes), and 'subscribe all' goes back to everything.
+
+    Several commands separated by semicolons are run as a batch, as is
+    'macro NAME' for a macro loaded into the factory (see
+    :py:mod:`onkyo_serial.macros`). Once every command in the batch has
+    been answered, one line is sent with the results, in order::
+
+        OK system power=on; audio muting=off; master volume=28
+
+    or, if any failed, starting with FAILED instead.
+
+    'ramp LEVEL [SECONDS [CURVE]]' fades the master volume to LEVEL (see
+    :py:mod:`onkyo_serial.ramp`), and likewise reports with one line once
+    it is done, or has been cancelled by a newer ramp.
+
+    'repeat N COMMAND' sends a command N times, translating it once. Steps
+    like master-volume=level-up are merged by the device's write scheduler
+    into one net change.
     """
 
     def connectionMade(self):
-        def mycb(cmd):
-            cmd = core.iscp_to_command(cmd)
-            if isinstance(cmd[0], tuple):
-                cmd_name = cmd[0][0]
-            else:
-                cmd_name = cmd[0]
-            cmdstr = '{}={}'.format(core.normalize_command(cmd_name), cmd[1])
-            self.sendLine(cmdstr)
+        self.factory.add_cb(self, self.reply)
+
+    def subscribe(self, codes):
+        """Only send the client responses for some ISCP commands.
 
-        self.factory.add_cb(self, mycb)
+        Args:
+            codes (str): comma separated ISCP command prefixes, or 'all'.
+        """
+        codes = codes.strip()
+        if codes.lower() == 'all':
+            self.factory.add_cb(self, self.reply)
+        else:
+            self.factory.add_cb(self, self.reply, codes=[
+                c.strip().upper() for c in codes.split(',') if c.strip()])
+        self.sendLine('OK')
 
     # noinspection PyUnusedLocal
     def connectionLost(self, reason=protocol.connectionDone):
         self.factory.remove_cb(self)
 
     def lineReceived(self, line):
+        _received_commands.inc()
+        if line.startswith('subscribe '):
+            self.subscribe(line[len('subscribe '):])
+            return
+        if line.startswith('macro '):
+            name = line[len('macro '):].strip()
+            lines = self.factory.macros.get(name.lower())
+            if lines is None:
+                _invalid_commands.inc()
+                self.sendLine('Unknown macro: {}'.format(name))
+                return
+            self.runBatch(lines)
+            return
+        if line.startswith('repeat '):
+            self.repeat(line[len('repeat '):])
+            return
+        if line.startswith('ramp '):
+            self.ramp(line[len('ramp '):])
+            return
+        if macros.isBatch(line):
+            try:
+                lines = macros.compileBatch(line, self.factory.translator)
+            except ValueError, e:
+                _invalid_commands.inc()
+                self.sendLine(e.args[0])
+                return
+            self.runBatch(lines)
+            return
+        try:
+            cmd = self.factory.translator.translate(line)
+        except ValueError, e:
+            _invalid_commands.inc()
+            self.sendLine(e.args[0])
+            return
+        self.factory.command(cmd, reply=self.reply)
+
+    def repeat(self, args):
+        """Send a command several times.
+
+        Args:
+            args (str): N COMMAND.
+        """
         try:
-            self.factory.command(line)
+            parts = args.split(None, 1)
+            if len(parts) != 2:
+                raise ValueError('Usage: repeat N COMMAND')
+            count, cmd = int(parts[0]), parts[1]
+            if not 1 <= count <= MAX_REPEAT:
+                raise ValueError(
+                        'Repeat count must be from 1 to {}'.format(MAX_REPEAT))
+            cmd = self.factory.translator.translate(cmd)
         except ValueError, e:
+            _invalid_commands.inc()
             self.sendLine(e.args[0])
+            return
+        for _ in xrange(count):
+            self.factory.command(cmd, reply=self.reply)
+
+    def ramp(self, args):
+        """Start a volume ramp.
+
+        Args:
+            args (str): LEVEL [SECONDS [CURVE]], the level in decimal.
+        """
+        parts = args.split()
+        kwargs = {}
+        try:
+            if not 1 <= len(parts) <= 3:
+                raise ValueError('Usage: ramp LEVEL [SECONDS [CURVE]]')
+            level = int(parts[0])
+            if len(parts) > 1:
+                kwargs['duration'] = float(parts[1])
+            if len(parts) > 2:
+                kwargs['curve'] = parts[2]
+            d = self.factory.ramp(level, **kwargs)
+        except ValueError, e:
+            _invalid_commands.inc()
+            self.sendLine(e.args[0])
+            return
+        d.addCallbacks(
+                lambda resp: self.sendLine('OK {}'.format(resp.normalized)),
+                lambda f: self.sendLine('FAILED {}'.format(
+                        f.getErrorMessage())))
+
+    def runBatch(self, lines):
+        """Send a batch of commands, and report on them in one line.
+
+        The commands are queued together, so they go out back to back at
+        the pace of the device's write scheduler.
+
+        Args:
+            lines (tuple): raw ISCP commands.
+
+        Returns:
+            Deferred: fires once the result has been sent.
+        """
+        d = defer.DeferredList(
+                [defer.maybeDeferred(self.factory.command, line, wait=True)
+                 for line in lines], consumeErrors=True)
+        d.addCallback(self._batchDone)
+        return d
+
+    def _batchDone(self, results):
+        ok = all(success for success, _ in results)
+        parts = [result.normalized if success else result.getErrorMessage()
+                 for success, result in results]
+        _batches.inc(labels=('ok' if ok else 'failed',))
+        self.sendLine('{} {}'.format('OK' if ok else 'FAILED',
+                                     '; '.join(parts)))
+
+    def reply(self, resp):
+        """Send a response from the receiver to the client.
+
+        Args:
+            resp (str): ISCP response, without the !1 prefix.
+        """
+        if not isinstance(resp, translate.Response):
+            resp = translate.DECODER.decode(resp)
+        _sent_responses.inc()
+        self.sendLine(resp.normalized)
 
 
 class CommandPortFactory(protocol.Factory, interfaces.ISCPProxyMixin):
     """Factory for `CommandPort` protocol."""
     protocol = CommandPort
 
-    def __init__(self, onkyo):
+    def __init__(self, onkyo, translator=None, macros=None):
         """Initialize the factory.
 
         Args:
             onkyo (onkyo_serial.iscp.ISCP): A :twisted:`twisted.internet.protocol.Protocol`
                 connected to the receiver via ISCP.
+            translator (translate.CommandTranslator): translator used to
+                validate incoming commands, defaults to the shared translator.
+            macros (dict): compiled macros clients can run, by name, see
+                :py:func:`onkyo_serial.macros.load`.
 
         """
         interfaces.ISCPProxyMixin.__init__(self)
+        if translator is None:
+            translator = translate.TRANSLATOR
+        self.translator = translator
+        self.macros = macros or {}
         if not interfaces.IISCPDevice.providedBy(onkyo):
             raise TypeError('%{!r} does not provide {!s}', onkyo,
                             interfaces.IISCPDevice)
@@ -1,13 +1,32 @@
 """Interfaces for onkyo_serial."""
 
+import collections
+import itertools
+
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.python import log
 from zope import interface
 
+from . import metrics
+from . import translate
+
+_offline_commands = metrics.REGISTRY.counter(
+        'onkyo_serial_offline_commands_total',
+        'Commands sent while the ISCP device was disconnected, by what '
+        'became of them.', ('result',))
+
+# Arguments that change a setting relative to where it is, so each one sent
+# while offline counts, rather than replacing an earlier copy.
+RELATIVE_ARGS = frozenset(['UP', 'DOWN', 'UP1', 'DOWN1', 'TG'])
+
 
 # noinspection PyMethodMayBeStatic,PyMethodParameters
 class IISCPDevice(interface.Interface):
     """Interface that represents an ISCP device."""
 
-    def command(line):
+    def command(line, priority=None, reply=None, wait=False, timeout=None,
+                retries=0):
         """Send a command to the ISCP device.
 
         This can either be in human readable form::
@@ -19,9 +38,23 @@ class IISCPDevice(interface.Interface):
 
         Args:
             line (str): Command to send to the device.
+            priority (int): priority class for devices that queue commands,
+                see :py:mod:`onkyo_serial.scheduler`.
+            reply (callable): called with the response if the device can
+                answer a query itself, in which case the response is not
+                sent to the other callbacks.
+            wait (bool): if True, return a Deferred that fires with the
+                matching response from the device.
+            timeout (float): seconds to wait for the response, None for
+                the device's default.
+            retries (int): number of times to resend the command if the
+                device doesn't respond in time.
+
+        Returns:
+            Deferred: if waiting, otherwise None.
         """
 
-    def add_cb(inst, cb):
+    def add_cb(inst, cb, codes=None):
         """Add a callback to the ISCP device.
 
         The callback should have a signature of cb(resp), where resp
@@ -30,6 +63,8 @@ class IISCPDevice(interface.Interface):
         Args:
             inst (object): a unique hashable identifier for this callback.
             cb (callable): the callback to add.
+            codes (iterable): ISCP command prefixes to call it for, eg.
+                ['MVL', 'AMT']. By default it is called for every response.
         """
 
     def remove_cb(inst):
@@ -40,43 +75,142 @@ class IISCPDevice(interface.Interface):
                 remove.
         """
 
+    def ramp(level, duration=None, curve=None):
+        """Fade the master volume to a level.
+
+        A new ramp cancels the one in progress, if any.
+
+        Args:
+            level (int): volume level to end at.
+            duration (float): seconds to take, None for the default
+                (`onkyo_serial.ramp.DEFAULT_DURATION`).
+            curve (str): shape of the fade, see :py:mod:`onkyo_serial.ramp`,
+                None for the default (linear).
+
+        Returns:
+            Deferred: fires with the response for the final level once it
+            has been sent, or fails if the ramp is cancelled.
+
+        Raises:
+            ValueError: for an invalid level, duration or curve.
+        """
+
 
 @interface.implementer(IISCPDevice)
 class ISCPProxyMixin(object):
-    _proxyMethods = ['command', 'add_cb', 'remove_cb']
+    """Forwards `IISCPDevice` calls to a device that comes and goes.
+
+    Callbacks are remembered, and registered with each new device as it is
+    connected (see `_process_backlog`), so they survive reconnects.
+
+    Commands sent while there is no device are queued, and replayed once
+    one connects (see `_replay`). The queue holds at most `offline_maxsize`
+    commands, for at most `offline_ttl` seconds each, and a command that is
+    already queued (in any form, friendly or raw) replaces the earlier copy
+    rather than being queued twice, unless it is a step or toggle (see
+    `RELATIVE_ARGS`). Commands that wait for a response fail straight away
+    instead.
+    Invalid commands are rejected when they are sent, as a connected
+    device would, and replies aren't queued since the client asking may
+    be gone by the time the device connects.
+    """
+    _proxyMethods = ['command', 'add_cb', 'remove_cb', 'ramp']
     _proxyDeviceAttr = '_onkyo'
 
+    offline_maxsize = 32
+    offline_ttl = 10
+    # Defaults to the reactor.
+    clock = None
+    # Checks commands before they're queued, defaults to the shared
+    # translator.
+    translator = None
+
     def __init__(self):
-        self._add_cb_queue = {}
-        self._remove_cb_queue = {}
+        self._callbacks = {}
+        self._offline = collections.OrderedDict()
+        self._offline_ids = itertools.count()
 
     def _process_backlog(self, proxy):
-        while self._add_cb_queue:
-            proxy.add_cb(*self._add_cb_queue.popitem())
-        while self._remove_cb_queue:
-            proxy.add_cb(*self._remove_cb_queue.popitem())
+        """Register all callbacks with a newly connected device."""
+        for inst, (cb, codes) in self._callbacks.items():
+            proxy.add_cb(inst, cb, codes=codes)
+
+    def _seconds(self):
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        return clock.seconds()
+
+    def _queue(self, line, kwargs):
+        """Queue a raw ISCP line to be sent once a device connects."""
+        key = line
+        if line[5:] in RELATIVE_ARGS:
+            key = (line, next(self._offline_ids))
+        if key in self._offline:
+            del self._offline[key]
+            _offline_commands.inc(labels=('duplicate',))
+        elif len(self._offline) >= self.offline_maxsize:
+            self._offline.popitem(last=False)
+            _offline_commands.inc(labels=('overflow',))
+        self._offline[key] = (line, self._seconds() + self.offline_ttl,
+                              kwargs)
+        _offline_commands.inc(labels=('queued',))
+
+    def _replay(self, proxy):
+        """Send the commands queued while disconnected to a new device.
 
-    def command(self, line):
+        Args:
+            proxy (IISCPDevice): the newly connected device.
+        """
+        now = self._seconds()
+        offline, self._offline = self._offline, collections.OrderedDict()
+        replayed = 0
+        for line, expires, kwargs in offline.itervalues():
+            if expires < now:
+                _offline_commands.inc(labels=('expired',))
+                continue
+            try:
+                proxy.command(line, **kwargs)
+            except ValueError, e:
+                # Don't let one bad command stop the device connecting.
+                _offline_commands.inc(labels=('invalid',))
+                log.err(e, 'Could not replay {}'.format(line))
+                continue
+            replayed += 1
+        if replayed:
+            _offline_commands.inc(replayed, labels=('replayed',))
+            log.msg('Replayed {} commands queued while disconnected'.format(
+                    replayed))
+
+    def command(self, line, **kwargs):
         proxy = getattr(self, self._proxyDeviceAttr)
         if proxy is not None:
-            self._process_backlog(proxy)
-            proxy.command(line)
-
-    def add_cb(self, inst, cb):
+            return proxy.command(line, **kwargs)
+        if kwargs.get('wait'):
+            return defer.fail(error.ConnectionClosed(
+                    'Not connected to the ISCP device'))
+        translator = self.translator
+        if translator is None:
+            translator = translate.TRANSLATOR
+        line = translator.translate(line)
+        kwargs.pop('reply', None)
+        self._queue(line, kwargs)
+
+    def add_cb(self, inst, cb, codes=None):
+        self._callbacks[inst] = (cb, codes)
         proxy = getattr(self, self._proxyDeviceAttr)
         if proxy is not None:
-            self._process_backlog(proxy)
-            proxy.add_cb(inst, cb)
-        else:
-            if inst in self._remove_cb_queue:
-                del self._remove_cb_queue[inst]
-            self._add_cb_queue[inst] = cb
+            proxy.add_cb(inst, cb, codes=codes)
 
     def remove_cb(self, inst):
+        self._callbacks.pop(inst, None)
         proxy = getattr(self, self._proxyDeviceAttr)
         if proxy is not None:
-            self._process_backlog(proxy)
             proxy.remove_cb(inst)
-        else:
-            if inst in self._add_cb_queue:
-                del self._add_cb_queue[inst]
+
+    def ramp(self, level, **kwargs):
+        proxy = getattr(self, self._proxyDeviceAttr)
+        if proxy is not None:
+            return proxy.ramp(level, **kwargs)
+        return defer.fail(error.ConnectionClosed(
+                'Not connected to the ISCP device'))
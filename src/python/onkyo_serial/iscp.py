@@ -1,19 +1,167 @@
 """Communicate with Onkyo receivers via ISCP."""
 
+import collections
 import struct
 import uuid
 
-from eiscp import core
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import interfaces as twisted_interfaces
 from twisted.internet import protocol
 from twisted.protocols import basic
 from twisted.python import log
 from zope import interface
 
 from . import interfaces
+from . import metrics
+from . import ramp as volume_ramp
+from . import scheduler
+from . import state
+from . import translate
+
+
+eISCPPacketHeader = struct.Struct('!4sIIb3x')
 
 
 def command_to_packet(cmd):
-    return str(core.eISCPPacket('!1{}\x1a'.format(cmd)))
+    """Encapsulate an ISCP command in an eISCP packet.
+
+    Args:
+        cmd (str): ISCP command, without the !1 prefix.
+    """
+    message = '!1{}\x1a'.format(cmd)
+    return eISCPPacketHeader.pack(
+            'ISCP', eISCPPacketHeader.size, len(message), 1) + message
+
+
+def message_to_packet(message):
+    """Encapsulate a whole ISCP message, prefix and all, in an eISCP packet.
+
+    Args:
+        message (str): the message, eg. !xECNQSTN.
+    """
+    return eISCPPacketHeader.pack(
+            'ISCP', eISCPPacketHeader.size, len(message), 1) + message
+
+
+def packet_to_command(packet):
+    """Extract the ISCP message from a single eISCP packet.
+
+    Args:
+        packet (str): the eISCP packet.
+
+    Returns:
+        str: the ISCP message, as sent (eg. !xECNQSTN\r).
+
+    Raises:
+        ValueError: if the packet is not a valid eISCP packet.
+    """
+    if len(packet) < eISCPPacketHeader.size:
+        raise ValueError('Short eISCP packet')
+    magic, header_size, length, _ = eISCPPacketHeader.unpack_from(packet)
+    if magic != 'ISCP' or header_size != eISCPPacketHeader.size:
+        raise ValueError('Invalid eISCP header')
+    data = packet[header_size:header_size + length]
+    if len(data) != length:
+        raise ValueError('Truncated eISCP packet')
+    return data
+
+
+class PacketEncoder(object):
+    """Small LRU cache of encoded eISCP packets.
+
+    Status responses tend to repeat (power, volume, input), so the most
+    recently encoded packets are kept around.
+    """
+
+    def __init__(self, maxsize=64):
+        """
+
+        Args:
+            maxsize (int): maximum number of packets to keep.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def encode(self, cmd):
+        """Return the eISCP packet for an ISCP command.
+
+        Args:
+            cmd (str): ISCP command, without the !1 prefix.
+        """
+        cache = self._cache
+        try:
+            packet = cache.pop(cmd)
+        except KeyError:
+            self.misses += 1
+            packet = command_to_packet(cmd)
+            if len(cache) >= self.maxsize:
+                cache.popitem(last=False)
+        else:
+            self.hits += 1
+        cache[cmd] = packet
+        return packet
+
+
+# Seconds to wait for the receiver to respond to a command.
+DEFAULT_TIMEOUT = 3
+
+_sent_bytes = metrics.REGISTRY.counter(
+        'onkyo_serial_iscp_sent_bytes_total',
+        'Bytes written to the ISCP device.')
+_sent_commands = metrics.REGISTRY.counter(
+        'onkyo_serial_iscp_sent_commands_total',
+        'Commands written to the ISCP device.')
+_received_bytes = metrics.REGISTRY.counter(
+        'onkyo_serial_iscp_received_bytes_total',
+        'Bytes received from the ISCP device.')
+_received_responses = metrics.REGISTRY.counter(
+        'onkyo_serial_iscp_received_responses_total',
+        'Responses received from the ISCP device.')
+_invalid_lines = metrics.REGISTRY.counter(
+        'onkyo_serial_iscp_invalid_lines_total',
+        'Lines received from the ISCP device that were not ISCP responses.')
+_response_latency = metrics.REGISTRY.histogram(
+        'onkyo_serial_iscp_response_latency_seconds',
+        'Time from writing a command to the next response for it.')
+_callback_latency = metrics.REGISTRY.histogram(
+        'onkyo_serial_callback_seconds',
+        'Time taken to deliver a response to each subscriber.')
+_eiscp_received_bytes = metrics.REGISTRY.counter(
+        'onkyo_serial_eiscp_received_bytes_total',
+        'Bytes received from eISCP clients.')
+_eiscp_sent_packets = metrics.REGISTRY.counter(
+        'onkyo_serial_eiscp_sent_packets_total',
+        'Packets sent to eISCP clients.')
+_discovery_queries = metrics.REGISTRY.counter(
+        'onkyo_serial_discovery_queries_total',
+        'eISCP discovery datagrams received, by what was done with them.',
+        ('result',))
+_eiscp_slow_clients = metrics.REGISTRY.counter(
+        'onkyo_serial_eiscp_slow_client_packets_total',
+        'Packets held back from eISCP clients that were not keeping up, by '
+        'what became of them.', ('result',))
+
+# What an eISCP bridge does with packets for a client that isn't keeping up,
+# once it has max_pending of them waiting.
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+SLOW_CLIENT_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class _Waiter(object):
+    """A command waiting for a matching response from the receiver."""
+
+    def __init__(self, line, priority, timeout, retries):
+        self.line = line
+        self.priority = priority
+        self.timeout = timeout
+        self.retries = retries
+        self.deferred = None
+        self.timer = None
 
 
 # noinspection PyPep8Naming
@@ -22,8 +170,9 @@ class ISCP(basic.LineOnlyReceiver):
     """Onkyo ISCP Protocol over Serial.
 
     The receiver will issue updates spontaneously, so the protocol
-    maintains this known state internally, although nothing is done
-    with it yet.
+    maintains this known state internally, and uses it to answer queries
+    from clients that provide a reply callback without going out to the
+    receiver. See :py:class:`state.ReceiverState`.
 
     To use, send human friendly or raw ISCP commands with command()::
 
@@ -32,7 +181,15 @@ class ISCP(basic.LineOnlyReceiver):
         iscp_protocol.command('MVL20')
 
     To receive responses, register a callback with add_cb(), this gets invoked
-    for every valid response from the receiver.
+    for every valid response from the receiver with a
+    :py:class:`translate.Response`, which is decoded once for all callbacks.
+
+    To wait for the receiver to acknowledge a command, pass wait=True to
+    command(), which returns a Deferred that fires with the next response
+    for the same ISCP command::
+
+        d = iscp_protocol.command('system-power=on', wait=True)
+        d.addCallback(lambda resp: resp.normalized)
 
     If connecting to an actual receiver, the settings are generally
 
@@ -49,29 +206,229 @@ class ISCP(basic.LineOnlyReceiver):
     """
     delimiter = '\x1a'
     send_delimiter = '\n'
+    # Set by the factory, if built by one.
+    factory = None
 
-    def __init__(self):
+    def __init__(self, translator=None, decoder=None, write_scheduler=None,
+                 receiver_state=None):
+        """
+
+        Args:
+            translator (translate.CommandTranslator): translator to use for
+                commands, defaults to the shared translator.
+            decoder (translate.ResponseDecoder): decoder to use for
+                responses, defaults to the shared decoder.
+            write_scheduler (scheduler.WriteScheduler): paces commands sent
+                to the receiver, by default they are written immediately.
+            receiver_state (state.ReceiverState): raw receiver state used to
+                answer queries.
+        """
         self.state = {}
+        # All callbacks, by identifier.
         self.cb = {}
+        # Callbacks for every response, and for responses whose ISCP
+        # command starts with a prefix, by prefix.
+        self._wildcard_cb = {}
+        self._prefix_cb = {}
+        self._prefix_lengths = ()
+        self._cb_codes = {}
+        self.clock = None
+        self._waiters = {}
+        self._sent_at = {}
+        self._ramp = None
+        self.scheduler = write_scheduler
+        if receiver_state is None:
+            receiver_state = state.ReceiverState()
+        self.receiver_state = receiver_state
+        if translator is None:
+            translator = translate.TRANSLATOR
+        if decoder is None:
+            decoder = translate.DECODER
+        self.translator = translator
+        self.decoder = decoder
 
     def connectionMade(self):
-        """Query the system power state initially."""
+        """Query the system power state initially.
+
+        Values restored from a state snapshot are queried too, in the
+        background, so they are revalidated with the receiver.
+        """
         self.command('system-power=query')
+        for code in sorted(self.receiver_state.restored - set(['PWR'])):
+            try:
+                self.command(code + 'QSTN', priority=scheduler.BACKGROUND)
+            except ValueError, e:
+                # Not every command can be queried, don't let one restored
+                # value keep the connection from being set up.
+                self.receiver_state.invalidate(code)
+                log.msg('Could not revalidate {}: {}'.format(code, e))
+        if isinstance(self.factory, ISCPClientFactory):
+            self.factory.deviceConnected(self)
 
-    def command(self, cmd):
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self._ramp is not None:
+            self._ramp.cancel('Lost connection to the receiver')
+            self._ramp = None
+        self.receiver_state.disconnected()
+        if self.scheduler is not None:
+            self.scheduler.clear()
+        self._sent_at.clear()
+        waiters, self._waiters = self._waiters, {}
+        for code_waiters in waiters.itervalues():
+            for waiter in code_waiters:
+                waiter.timer.cancel()
+                waiter.deferred.errback(error.ConnectionLost(
+                        'Lost connection waiting for {}'.format(waiter.line)))
+
+    def command(self, cmd, priority=None, reply=None, wait=False,
+                timeout=DEFAULT_TIMEOUT, retries=0):
         """Issue an ISCP command based on the onkyo-eiscp command mappings.
 
         Args:
             cmd: Command to execute.
+            priority (int): scheduler priority class, by default queries are
+                sent in the background and everything else is interactive.
+            reply (callable): if given, queries for a value that is known to
+                be current are answered by calling this with a
+                :py:class:`translate.Response`, instead of asking the
+                receiver.
+            wait (bool): return a Deferred that fires with the response.
+            timeout (float): seconds to wait for the response, if waiting,
+                None for `DEFAULT_TIMEOUT`.
+            retries (int): number of times to resend the command if the
+                receiver doesn't respond in time.
+
+        Returns:
+            Deferred: if waiting, fires with the matching
+            :py:class:`translate.Response`, or fails with
+            :twisted:`twisted.internet.error.TimeoutError`.
+
+        Raises:
+            ValueError: if the command is not valid.
+        """
+        line = self.translator.translate(cmd)
+        code = line[2:5]
+        if line[5:] == 'QSTN':
+            if reply is not None or wait:
+                args = self.receiver_state.answer(code)
+                if args is not None:
+                    resp = self.decoder.decode(code + args)
+                    if reply is not None:
+                        reply(resp)
+                    if wait:
+                        return defer.succeed(resp)
+                    return
+        else:
+            self.receiver_state.invalidate(code)
+        if priority is None:
+            if line.endswith('QSTN'):
+                priority = scheduler.BACKGROUND
+            else:
+                priority = scheduler.INTERACTIVE
+        d = None
+        if wait:
+            if timeout is None:
+                timeout = DEFAULT_TIMEOUT
+            d = self._wait(_Waiter(line, priority, timeout, retries))
+        self._send(line, priority)
+        return d
+
+    def ramp(self, level, duration=volume_ramp.DEFAULT_DURATION,
+             curve=volume_ramp.LINEAR):
+        """Fade the master volume to a level.
+
+        Rather than stepping the volume one level at a time, a few
+        absolute levels are written, paced to the link (see
+        :py:mod:`onkyo_serial.ramp`). A new ramp cancels the one in
+        progress, from wherever it got to.
+
+        Args:
+            level (int): volume level to end at.
+            duration (float): seconds to take, None for
+                `ramp.DEFAULT_DURATION`.
+            curve (str): shape of the fade, one of `ramp.CURVES`, None for
+                `ramp.LINEAR`.
+
+        Returns:
+            Deferred: fires with the :py:class:`translate.Response` for the
+            final level once it has been sent, or fails with
+            :twisted:`twisted.internet.defer.CancelledError` if the ramp is
+            cancelled.
+
+        Raises:
+            ValueError: for an invalid level, duration or curve.
         """
-        if cmd.startswith('!1'):
-            cmd = cmd[2:]
+        level_range = self.decoder.levelRange('MVL')
+        if level_range is not None and not (
+                level_range[0] <= level <= level_range[1]):
+            raise ValueError('Volume level {} is out of range'.format(level))
+        if duration is None:
+            duration = volume_ramp.DEFAULT_DURATION
+        if curve is None:
+            curve = volume_ramp.LINEAR
+        if duration < 0:
+            raise ValueError('Invalid ramp duration {}'.format(duration))
+        if curve not in volume_ramp.CURVES:
+            raise ValueError('Unknown ramp curve {}'.format(curve))
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        if self._ramp is not None:
+            self._ramp.cancel('Superseded by a newer ramp')
+        interval = volume_ramp.MIN_INTERVAL
+        if self.scheduler is not None:
+            interval = max(interval, self.scheduler.transmitTime('!1MVL00') +
+                           self.scheduler.gap)
         try:
-            cmd = '!1{}'.format(core.command_to_iscp(cmd))
-        except ValueError:
-            core.iscp_to_command(cmd)
-            cmd = '!1{}'.format(cmd)
-        self.sendLine(cmd)
+            current = int(self.receiver_state.get('MVL'), 16)
+        except (TypeError, ValueError):
+            current = None
+        self._ramp = volume_ramp.Ramp(self, level, duration, curve, interval,
+                                      self.clock)
+        return self._ramp.start(current)
+
+    def _send(self, line, priority):
+        if self.scheduler is None:
+            self.sendLine(line)
+        else:
+            self.scheduler.schedule(line, priority)
+
+    def _wait(self, waiter):
+        """Arrange for a waiter to be fired by its response, or time out."""
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+
+        def cancel(_):
+            waiter.timer.cancel()
+            self._discardWaiter(waiter)
+
+        waiter.deferred = defer.Deferred(cancel)
+        waiter.timer = self.clock.callLater(
+                waiter.timeout, self._timedOut, waiter)
+        self._waiters.setdefault(waiter.line[2:5], []).append(waiter)
+        return waiter.deferred
+
+    def _discardWaiter(self, waiter):
+        code = waiter.line[2:5]
+        code_waiters = self._waiters.get(code, [])
+        if waiter in code_waiters:
+            code_waiters.remove(waiter)
+            if not code_waiters:
+                del self._waiters[code]
+
+    def _timedOut(self, waiter):
+        if waiter.retries > 0:
+            waiter.retries -= 1
+            log.msg('No response to {}, retrying'.format(waiter.line))
+            waiter.timer = self.clock.callLater(
+                    waiter.timeout, self._timedOut, waiter)
+            self._send(waiter.line, waiter.priority)
+            return
+        self._discardWaiter(waiter)
+        self._sent_at.pop(waiter.line[2:5], None)
+        waiter.deferred.errback(error.TimeoutError(
+                'No response to {}'.format(waiter.line)))
 
     def lineReceived(self, line):
         """Handle incoming line of text from the receiver.
@@ -81,14 +438,32 @@ class ISCP(basic.LineOnlyReceiver):
         """
         # Seen some odd characters turn up at the start of serial communications.
         # None of these characters are part of the protocol.
+        _received_bytes.inc(len(line) + len(self.delimiter))
         line = filter(lambda x: 128 > ord(x) > 32, line)
 
         if line[0:2] == '!1':
-            cmd = core.iscp_to_command((line[2:].strip()))
-            self.state[cmd[0]] = cmd[1]
-            for inst in self.cb:
-                self.cb[inst](line[2:].strip())
+            resp = self.decoder.decode(line[2:].strip())
+            _received_responses.inc()
+            sent_at = self._sent_at.pop(resp.code, None)
+            if sent_at is not None:
+                latency = metrics.now() - sent_at
+                # Otherwise the command went unanswered, and this response
+                # is for something else.
+                if latency <= DEFAULT_TIMEOUT:
+                    _response_latency.observe(latency)
+            self.state[resp.name] = resp.value
+            self.receiver_state.update(resp.code, resp.args)
+            for cb in self._callbacksFor(resp.code):
+                start = metrics.now()
+                cb(resp)
+                _callback_latency.observe(metrics.now() - start)
+            waiters = self._waiters.pop(resp.code, None)
+            if waiters:
+                for waiter in waiters:
+                    waiter.timer.cancel()
+                    waiter.deferred.callback(resp)
         else:
+            _invalid_lines.inc()
             log.msg('invalid line ' + line)
 
     def sendLine(self, line):
@@ -97,17 +472,53 @@ class ISCP(basic.LineOnlyReceiver):
         Args:
             line (str): Line of text to send.
         """
+        now = metrics.now()
+        sent_at = self._sent_at.get(line[2:5])
+        if sent_at is None or now - sent_at > DEFAULT_TIMEOUT:
+            self._sent_at[line[2:5]] = now
+        _sent_commands.inc()
+        _sent_bytes.inc(len(line) + len(self.send_delimiter))
         return self.transport.write(line + self.send_delimiter)
 
-    def add_cb(self, inst, cb):
-        """Add a callback to be called for every response received.
+    def _callbacksFor(self, code):
+        """Return the callbacks interested in an ISCP command."""
+        if not self._prefix_lengths:
+            return self._wildcard_cb.values()
+        matched = [self._wildcard_cb] if self._wildcard_cb else []
+        for length in self._prefix_lengths:
+            interested = self._prefix_cb.get(code[:length])
+            if interested:
+                matched.append(interested)
+        if len(matched) == 1:
+            return matched[0].values()
+        # A callback may be interested through more than one prefix.
+        callbacks = {}
+        for interested in matched:
+            callbacks.update(interested)
+        return callbacks.values()
+
+    def add_cb(self, inst, cb, codes=None):
+        """Add a callback to be called for responses received.
 
         Args:
             inst (object): A hashable, unique identifier to refer to this callback by.
             cb (callable): callable to call for every response received from the receiver.
                 It should accept one argument (the command response received).
+            codes (iterable): ISCP command prefixes (eg. 'MVL', or 'Z' for
+                all zone 2 commands) to call it for, by default all.
         """
+        self.remove_cb(inst)
         self.cb[inst] = cb
+        if codes is None:
+            self._wildcard_cb[inst] = cb
+            return
+        if isinstance(codes, basestring):
+            codes = [codes]
+        codes = frozenset(codes)
+        self._cb_codes[inst] = codes
+        for code in codes:
+            self._prefix_cb.setdefault(code, {})[inst] = cb
+        self._updatePrefixLengths()
 
     def remove_cb(self, inst):
         """Remove a callback.
@@ -117,6 +528,19 @@ class ISCP(basic.LineOnlyReceiver):
         """
         if inst in self.cb:
             del self.cb[inst]
+        self._wildcard_cb.pop(inst, None)
+        codes = self._cb_codes.pop(inst, None)
+        if codes is not None:
+            for code in codes:
+                interested = self._prefix_cb[code]
+                del interested[inst]
+                if not interested:
+                    del self._prefix_cb[code]
+            self._updatePrefixLengths()
+
+    def _updatePrefixLengths(self):
+        self._prefix_lengths = tuple(sorted(set(
+                len(code) for code in self._prefix_cb)))
 
 
 ISCPHeader = struct.Struct('!4s2ib3c')
@@ -124,9 +548,16 @@ ISCPHeader = struct.Struct('!4s2ib3c')
 
 class ISCPClientFactory(protocol.ReconnectingClientFactory,
                         interfaces.ISCPProxyMixin):
-    """Client factory for an ISCP communication link."""
+    """Client factory for an ISCP communication link.
+
+    Interested parties can follow the link going up and down with
+    `addConnectionObserver`, or wait for it with `whenConnected`.
+    """
     protocol = ISCP
     maxDelay = 10
+    # Paces writes to the device, and is shared by each connection. Its
+    # write callable should be `sendLine`.
+    scheduler = None
 
     def __init__(self):
         interfaces.ISCPProxyMixin.__init__(self)
@@ -134,11 +565,77 @@ class ISCPClientFactory(protocol.ReconnectingClientFactory,
             raise TypeError('protocol must implement {!s}'.format(
                     interfaces.IISCPDevice))
         self._onkyo = None
+        self._connected = False
+        self._observers = []
+        self._waiting = []
+        # Kept across reconnects, so the state can be used to answer
+        # queries once unsolicited updates start arriving again.
+        self.receiver_state = state.ReceiverState()
+
+    @property
+    def connected(self):
+        """True if the ISCP device is connected."""
+        return self._connected
+
+    def addConnectionObserver(self, connected, disconnected):
+        """Follow the device connecting and disconnecting.
+
+        Args:
+            connected (callable): called with the device's protocol once it
+                is connected, straight away if it already is.
+            disconnected (callable): called with the reason when the
+                connection is lost.
+        """
+        self._observers.append((connected, disconnected))
+        if self._connected:
+            connected(self._onkyo)
+
+    def removeConnectionObserver(self, connected, disconnected):
+        """Stop following the device, see `addConnectionObserver`."""
+        if (connected, disconnected) in self._observers:
+            self._observers.remove((connected, disconnected))
+
+    def whenConnected(self):
+        """Wait for the device to be connected.
+
+        Returns:
+            Deferred: fires with the device's protocol once connected.
+        """
+        if self._connected:
+            return defer.succeed(self._onkyo)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def deviceConnected(self, device):
+        """Called by the protocol once its connection is made.
+
+        Commands queued while disconnected are replayed first.
+
+        Args:
+            device (ISCP): the connected protocol.
+        """
+        self._connected = True
+        self._replay(device)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(device)
+        for connected, _ in list(self._observers):
+            connected(device)
+
+    def sendLine(self, line):
+        """Write a line to the device, if it is connected."""
+        if self._onkyo is not None:
+            self._onkyo.sendLine(line)
 
     def clientConnectionLost(self, connector, reason):
         log.msg('Lost connection')
         del self._onkyo
         self._onkyo = None
+        was_connected, self._connected = self._connected, False
+        if was_connected:
+            for _, disconnected in list(self._observers):
+                disconnected(reason)
         protocol.ReconnectingClientFactory.clientConnectionLost(
                 self, connector, reason)
 
@@ -153,6 +650,8 @@ class ISCPClientFactory(protocol.ReconnectingClientFactory,
         p = self.protocol()
         self.resetDelay()
         p.factory = self
+        p.receiver_state = self.receiver_state
+        p.scheduler = self.scheduler
         self._onkyo = p
         self._process_backlog(self._onkyo)
         return p
@@ -161,7 +660,9 @@ class ISCPClientFactory(protocol.ReconnectingClientFactory,
 class eISCPMixin(object):
     """Mixin to handle all the actual eISCPBridge protocol decoding.
 
-     This maintains internal state regarding the state of decoding.
+     This maintains a single buffer of data that has been received but not
+     yet decoded, so packets may be split over, or share, any number of
+     chunks, and garbage before a packet is skipped.
 
      Re-initialize the state with :py:meth:`eISCPMixin.reset`
 
@@ -175,77 +676,49 @@ class eISCPMixin(object):
     Lots stolen shamelessly from https://github.com/miracle2k/onkyo-eiscp
     """
 
-    def __init__(self):
-        self.header = {'data': '',
-                       'length': ''}
-        self.cmd = self.init_cmd(0)
+    # Anything claiming to be larger than this is treated as garbage.
+    max_data_size = 4096
 
-    @staticmethod
-    def init_cmd(length):
-        """Return a fresh command dictionary with no content.
-        Args:
-            length: length of the packet.
-        """
-        return {'data': '',
-                'length': length,
-                'cur_length': 0}
+    def __init__(self):
+        self._buffer = bytearray()
 
     def reset(self):
-        """Reset the current command being processed."""
-        self.cmd = self.init_cmd(0)
-        self.header = {'data': '', 'length': 0}
-
-    def _headerStart(self):
-        data = self.header['data']
-        i = data.find('I')
-        if i != -1:
-            data = data[i:]
-        else:
-            data = ''
-        self.header['data'] = data
+        """Discard any partially received data."""
+        del self._buffer[:]
 
     def _processData(self, data):
-        while data:
-            if self.header['length'] < 16:
-                self.header['data'] += data
-                data = ''
-                self.header['length'] = len(self.header['data'])
-                if self.header['length'] >= 4:
-                    while not self._isHeaderStart():
-                        self._headerStart()
-                if self.header['length'] >= 16:
-                    data = self.header['data'][16:]
-                    self.header['data'] = self.header['data'][:16]
-                    try:
-                        (_, _, length, _, _, _, _) = ISCPHeader.unpack(self.header['data'])
-                        self.cmd = self.init_cmd(length)
-                    except struct.error:
-                        self.reset()
-
-            self.cmd['data'] += data
-            self.cmd['cur_length'] = len(self.cmd['data'])
-            if self.cmd['cur_length'] >= self.cmd['length']:
-                end = self.cmd['data'].find('\x1a')
-                self.doCmd(self.cmd['data'][:end])
-                data = self.cmd['data'][self.cmd['length']:]
-                self.reset()
-
-    def _isHeaderStart(self):
-        data = self.header['data']
-        if data.startswith('ISCP'):
-            return True
-        if len(data) > 3:
-            return False
-        if len(data) == 3 and data.startswith('ISC'):
-            return True
-        if len(data) == 2 and data.startswith('IS'):
-            return True
-        if len(data) == 1 and data.startswith('I'):
-            return True
-        if len(data) == 0:
-            return True
-
-        return False
+        buf = self._buffer
+        buf.extend(data)
+        end = len(buf)
+        offset = 0
+        view = memoryview(buf)
+        try:
+            while True:
+                start = buf.find('ISCP', offset)
+                if start == -1:
+                    # Keep a possibly partial magic at the end of the buffer.
+                    offset = max(offset, end - 3)
+                    break
+                if end - start < ISCPHeader.size:
+                    offset = start
+                    break
+                (_, header_size, length, _, _, _, _) = ISCPHeader.unpack_from(
+                        buf, start)
+                if (not ISCPHeader.size <= header_size <= self.max_data_size or
+                        not 0 <= length <= self.max_data_size):
+                    offset = start + 1
+                    continue
+                data_start = start + header_size
+                offset = data_start + length
+                if offset > end:
+                    offset = start
+                    break
+                cmd = view[data_start:offset].tobytes()
+                self.doCmd(cmd.split('\x1a', 1)[0].rstrip('\r\n'))
+        finally:
+            # The buffer can't be resized while the view is exported.
+            del view
+            del buf[:offset]
 
     def doCmd(self, cmd):
         """Execute an ISCP command.
@@ -256,33 +729,107 @@ class eISCPMixin(object):
         raise NotImplementedError
 
 
+@interface.implementer(twisted_interfaces.IPushProducer)
 class eISCPBridge(protocol.Protocol, eISCPMixin):
     """Twisted protocol to bridge eISCP and ISCP.
 
     Basically parses inbound eISCP, pulls out the ISCP
     commands, and passes them on to the ISCP protocol to be executed.
 
-    Likewise it registers a callback with the ISCP end of the bridge, and
-    for each response encapsulates it in an eISCP packet and sends it.
+    Likewise it registers with its factory, which encapsulates each
+    response from the ISCP end of the bridge in an eISCP packet once, and
+    sends it to every connected bridge.
+
+    The bridge is a producer for its transport, which pauses it when the
+    client isn't reading fast enough. While paused, at most the factory's
+    `max_pending` packets are held, and the factory's `policy` decides what
+    happens after that:
+
+        DROP_OLDEST: the oldest held packet is dropped.
+        COALESCE: only the latest packet for each ISCP command is held, the
+            oldest is dropped if there are still too many.
+        DISCONNECT: the client is disconnected.
 
     Typically lives on TCP port 60128.
     """
 
-    def connectionMade(self):
-        def eiscp_callback(cmd):
-            self.transport.write(command_to_packet(cmd))
+    def __init__(self):
+        eISCPMixin.__init__(self)
+        self.paused = False
+        self._pending = collections.OrderedDict()
+        self._sequence = 0
 
-        self.factory.add_cb(self, eiscp_callback)
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        self.factory.addBridge(self)
 
     # noinspection PyUnusedLocal
     def connectionLost(self, reason=protocol.connectionDone):
-        self.factory.remove_cb(self)
+        self.factory.removeBridge(self)
+        self._pending.clear()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self._pending and not self.paused:
+            _, packet = self._pending.popitem(last=False)
+            _eiscp_slow_clients.inc(labels=('sent',))
+            self.transport.write(packet)
+
+    def stopProducing(self):
+        self._pending.clear()
+
+    def sendPacket(self, packet, code=None):
+        """Send an encoded eISCP packet to the client.
+
+        Args:
+            packet (str): the eISCP packet.
+            code (str): ISCP command of the packet, packets for the same
+                command may be coalesced if the client is slow.
+        """
+        if not self.paused:
+            self.transport.write(packet)
+            return
+        policy = self.factory.policy
+        if policy == COALESCE and code is not None:
+            key = code
+            if key in self._pending:
+                del self._pending[key]
+                _eiscp_slow_clients.inc(labels=('coalesced',))
+        else:
+            key = self._sequence
+            self._sequence += 1
+        if len(self._pending) >= self.factory.max_pending:
+            if policy == DISCONNECT:
+                _eiscp_slow_clients.inc(len(self._pending), labels=('dropped',))
+                self._pending.clear()
+                log.msg('Disconnecting slow eISCP client {}'.format(
+                        self.transport.getPeer()))
+                abort = getattr(self.transport, 'abortConnection',
+                                self.transport.loseConnection)
+                abort()
+                return
+            self._pending.popitem(last=False)
+            _eiscp_slow_clients.inc(labels=('dropped',))
+        self._pending[key] = packet
+        _eiscp_slow_clients.inc(labels=('held',))
 
     def dataReceived(self, data):
+        _eiscp_received_bytes.inc(len(data))
         self._processData(data)
 
     def doCmd(self, cmd):
-        self.factory.command(cmd)
+        self.factory.command(cmd, reply=self.reply)
+
+    def reply(self, resp):
+        """Send a response to this client only.
+
+        Args:
+            resp (str): ISCP response, without the !1 prefix.
+        """
+        self.sendPacket(self.factory.encoder.encode(resp), resp[:3])
 
 
 class eISCPFactory(protocol.Factory, interfaces.ISCPProxyMixin):
@@ -290,14 +837,76 @@ class eISCPFactory(protocol.Factory, interfaces.ISCPProxyMixin):
 
     protocol = eISCPBridge
 
-    def __init__(self, iscp_device):
+    def __init__(self, iscp_device, encoder=None, policy=COALESCE,
+                 max_pending=64):
         """
         Args:
             iscp_device (:py:class:`interfaces.IISCPDevice`): ISCP device to
                 read/write.
+            encoder (PacketEncoder): encoder for outgoing packets.
+            policy (str): what to do with packets for clients that aren't
+                keeping up, one of `SLOW_CLIENT_POLICIES`.
+            max_pending (int): packets held for each client that isn't
+                keeping up before the policy kicks in.
         """
+        if policy not in SLOW_CLIENT_POLICIES:
+            raise ValueError('Unknown slow client policy {}'.format(policy))
         interfaces.ISCPProxyMixin.__init__(self)
         self._onkyo = iscp_device
+        self.policy = policy
+        self.max_pending = max_pending
+        if encoder is None:
+            encoder = PacketEncoder()
+        self.encoder = encoder
+        self.bridges = set()
+
+    def addBridge(self, bridge):
+        """Start sending responses to a bridge connection.
+
+        Args:
+            bridge (eISCPBridge): the connection to add.
+        """
+        if not self.bridges:
+            self.add_cb(self, self.broadcast)
+        self.bridges.add(bridge)
+
+    def removeBridge(self, bridge):
+        """Stop sending responses to a bridge connection.
+
+        Args:
+            bridge (eISCPBridge): the connection to remove.
+        """
+        self.bridges.discard(bridge)
+        if not self.bridges:
+            self.remove_cb(self)
+
+    def broadcast(self, cmd):
+        """Encode a response once, and send it to every bridge connection.
+
+        Args:
+            cmd (str): ISCP response, without the !1 prefix.
+        """
+        packet = self.encoder.encode(cmd)
+        code = cmd[:3]
+        bridges = tuple(self.bridges)
+        _eiscp_sent_packets.inc(len(bridges))
+        for bridge in bridges:
+            bridge.sendPacket(packet, code)
+
+
+DiscoveryIdentity = collections.namedtuple(
+        'DiscoveryIdentity', ['model', 'port', 'region', 'mac'])
+
+DISCOVERY_QUERY = '!xECNQSTN'
+
+# What apps end the discovery query with. onkyo-eiscp sends it bare.
+DISCOVERY_TERMINATORS = ('', '\r', '\n', '\r\n', '\x1a')
+
+# Seconds before answering discovery queries from the same host again.
+DISCOVERY_INTERVAL = 1.0
+
+# Hosts remembered for rate limiting, before the stale ones are forgotten.
+MAX_DISCOVERY_SOURCES = 1024
 
 
 class eISCPDiscovery(protocol.DatagramProtocol):
@@ -318,19 +927,82 @@ class eISCPDiscovery(protocol.DatagramProtocol):
     model = 'TX-NR609'
     region = 'XX'
 
-    def __init__(self, eiscp_port=60128):
+    # The query packet, with each of the usual terminators.
+    _query_packets = frozenset(
+            message_to_packet(DISCOVERY_QUERY + end)
+            for end in DISCOVERY_TERMINATORS)
+
+    def __init__(self, eiscp_port=60128, interval=DISCOVERY_INTERVAL,
+                 clock=None):
         """
 
         Args:
-                eiscp_port (int): port to listen for eISCP discovery on.
+                eiscp_port (int): eISCP port of the first identity, or None
+                    to add identities with `addIdentity`.
+                interval (float): seconds before answering the same host
+                    again. Queries in between are dropped.
+                clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                    defaults to the reactor.
         """
-        self.mac = self._getMac()
-        self.eiscp_port = eiscp_port
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.interval = interval
+        self.clock = clock
+        self.identities = []
+        self._replies = []
+        self._answered = {}
+        if eiscp_port is not None:
+            self.addIdentity(eiscp_port)
+
+    @property
+    def eiscp_port(self):
+        """int: the first identity's eISCP port, or None without one."""
+        if not self.identities:
+            return None
+        return self.identities[0].port
+
+    @property
+    def mac(self):
+        """str: the first identity's mac address, or None without one."""
+        if not self.identities:
+            return None
+        return self.identities[0].mac
 
     @staticmethod
-    def _getMac():
-        """Get our machines mac address and format it for the packet."""
-        return '{:0>12X}'.format(uuid.getnode())
+    def _getMac(offset=0):
+        """Get our machines mac address and format it for the packet.
+
+        Args:
+            offset (int): added to the address, to give each identity a
+                different one.
+        """
+        return '{:0>12X}'.format((uuid.getnode() + offset) & 0xFFFFFFFFFFFF)
+
+    def addIdentity(self, eiscp_port, model=None, region=None, mac=None):
+        """Add a receiver to answer discovery requests for.
+
+        Each identity is reported in its own response to a request, so one
+        discovery socket can advertise several bridged receivers.
+
+        Args:
+            eiscp_port (int): port of the receiver's eISCP bridge.
+            model (str): model to report, defaults to `model`.
+            region (str): region to report, defaults to `region`.
+            mac (str): identifier to report, defaults to our mac address
+                offset by the number of identities already added.
+
+        Returns:
+            DiscoveryIdentity: the new identity.
+        """
+        identity = DiscoveryIdentity(
+                model or self.model, eiscp_port, region or self.region,
+                mac or self._getMac(len(self.identities)))
+        self.identities.append(identity)
+        self._replies.append(command_to_packet(
+                'ECN{model}/{port}/{region}/{mac}'.format(
+                        model=identity.model, port=identity.port,
+                        region=identity.region, mac=identity.mac)))
+        return identity
 
     def startProtocol(self):
         self.transport.setBroadcastAllowed(True)
@@ -339,28 +1011,56 @@ class eISCPDiscovery(protocol.DatagramProtocol):
         """Process incoming datagrams.
 
         Look for eISCP discovery commands in received datagram, and reply
-        if a valid one is found.
+        for each identity if a valid one is found.
 
         We assume no fragmentation. If your local network is fragmenting
         25 byte UDP packets...
 
+        The usual queries are matched byte for byte, anything else is
+        parsed.
+        The replies are encoded when identities are added, and each host is
+        answered at most once per `interval`, so a storm of queries costs
+        little more than a dict lookup each.
+
         Args:
             datagram: datagram to parse
             addr: Address received from
         """
-
-        try:
-            cmd = core.eISCPPacket.parse(datagram)
-        except ValueError, e:
-            log.err(e)
+        if datagram not in self._query_packets:
+            try:
+                cmd = packet_to_command(datagram)
+            except ValueError, e:
+                _discovery_queries.inc(labels=('invalid',))
+                log.msg('Invalid discovery datagram from {}: {}'.format(
+                        addr[0], e))
+                return
+            if not cmd.startswith(DISCOVERY_QUERY):
+                _discovery_queries.inc(labels=('unknown',))
+                log.msg('Unknown command %s', cmd)
+                return
+        if not self._allow(addr[0]):
+            _discovery_queries.inc(labels=('limited',))
             return
-        if cmd.startswith('!xECNQSTN'):
-            response = 'ECN{model}/{port}/{region}/{mac}'.format(
-                    model=self.model, port=self.eiscp_port, region=self.region,
-                    mac=self.mac)
-            self.transport.write(command_to_packet(response), addr)
-        else:
-            log.msg('Unknown command %s', cmd)
+        _discovery_queries.inc(labels=('answered',))
+        for reply in self._replies:
+            self.transport.write(reply, addr)
+
+    def _allow(self, host):
+        """Return True if host can be answered now, and note that it was."""
+        now = self.clock.seconds()
+        answered = self._answered
+        last = answered.get(host)
+        if last is not None and now - last < self.interval:
+            return False
+        if last is None and len(answered) >= MAX_DISCOVERY_SOURCES:
+            for stale in [h for h, t in answered.iteritems()
+                          if now - t >= self.interval]:
+                del answered[stale]
+            if len(answered) >= MAX_DISCOVERY_SOURCES:
+                # Too many hosts at once to tell apart, answer no one new.
+                return False
+        answered[host] = now
+        return True
 
 
 class eISCPDiscoveryFactory(protocol.Factory):
@@ -0,0 +1,322 @@
+"""Precompiled, reloadable lirc keymaps.
+
+The config strings in a lircrc are friendly commands (or raw ones, or
+batches), which would otherwise only be checked the first time their key
+is pressed. A `Keymap` reads the lircrc once, compiles each config string
+for our program to raw ISCP, and rejects the whole file if any of them is
+invalid. Key presses are then a dictionary lookup.
+
+The lircrc can be reloaded without restarting the bridge, on SIGHUP or
+when the file changes. A file that no longer compiles is logged, and the
+keymap already loaded is kept.
+"""
+
+import os
+import signal
+
+from twisted.internet import task
+from twisted.python import log
+
+from . import macros
+from . import metrics
+from . import translate
+
+__author__ = 'blaedd@gmail.com'
+
+# Read when no lircrc is given, as by lirc_client.
+DEFAULT_LIRCRC = '~/.lircrc'
+
+# Seconds between checks of the lircrc for changes.
+CHECK_INTERVAL = 2.0
+
+# Command port commands that can be used as config strings as they are.
+PASSTHROUGH = ('macro ', 'ramp ', 'repeat ')
+
+# Matches any remote in a lircrc.
+ANY_REMOTE = '*'
+
+_reloads = metrics.REGISTRY.counter(
+        'onkyo_serial_keymap_reloads_total',
+        'lircrc keymap reloads, by result.', ('result',))
+
+
+def parse(path):
+    """Read the entries of a lircrc.
+
+    Only plain begin/end blocks are read, modes and includes are skipped.
+
+    Args:
+        path (str): the lircrc.
+
+    Returns:
+        list: a dict of the settings (prog, remote, button, config...) for
+        each entry, in order. Settings given more than once keep the first
+        value.
+
+    Raises:
+        ValueError: if the file can't be read, or an entry isn't closed.
+    """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except IOError, e:
+        raise ValueError('Could not read lircrc {}: {}'.format(path, e))
+    entries = []
+    entry = None
+    depth = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        words = line.split()
+        if words[0] == 'begin':
+            depth += 1
+            if depth == 1 and len(words) == 1:
+                entry = {}
+            continue
+        if words[0] == 'end':
+            if depth == 0:
+                raise ValueError('{}:{}: end without begin'.format(path, number))
+            depth -= 1
+            if depth == 0 and entry is not None:
+                entries.append(entry)
+                entry = None
+            continue
+        if entry is None or depth != 1 or '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        entry.setdefault(name.strip().lower(), value.strip())
+    if depth:
+        raise ValueError('{}: begin without end'.format(path))
+    return entries
+
+
+def compileConfig(config, translator=None):
+    """Compile a lircrc config string to a command port line.
+
+    Args:
+        config (str): a command, batch of commands, or one of the
+            `PASSTHROUGH` command port commands.
+        translator (translate.CommandTranslator): translator to use,
+            defaults to the shared translator.
+
+    Returns:
+        str: the line to send, with commands in raw ISCP.
+
+    Raises:
+        ValueError: if the config string is invalid.
+    """
+    if config.startswith(PASSTHROUGH):
+        return config
+    return '; '.join(macros.compileBatch(config, translator))
+
+
+class Keymap(object):
+    """Compiled lircrc config strings for a program.
+
+    Attributes:
+        commands (dict): compiled lines, by config string.
+        buttons (dict): compiled lines, by (remote, button).
+        repeats (dict): the lircrc (repeat, delay) settings, by (remote,
+            button).
+    """
+
+    def __init__(self, path, program_name, translator=None,
+                 interval=CHECK_INTERVAL, clock=None, reactor=None):
+        """
+
+        Args:
+            path (str): the lircrc.
+            program_name (str): program name the entries are for.
+            translator (translate.CommandTranslator): translator to compile
+                with, defaults to the shared translator.
+            interval (float): seconds between checks for changes, once
+                started.
+            clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                defaults to the reactor.
+            reactor (:twisted:`twisted.internet.interfaces.IReactorThreads`):
+                reloads on SIGHUP are run from its loop, defaults to the
+                reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if reactor is None:
+            from twisted.internet import reactor
+        if translator is None:
+            translator = translate.TRANSLATOR
+        self.path = path
+        self.program_name = program_name
+        self.translator = translator
+        self.interval = interval
+        self.clock = clock
+        self.reactor = reactor
+        self.commands = {}
+        self.buttons = {}
+        self.repeats = {}
+        self._mtime = None
+        self._cbs = {}
+        self._loop = None
+        self._previous_handler = None
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        """Read and compile the lircrc, replacing the current keymap.
+
+        Returns:
+            int: the number of keys mapped.
+
+        Raises:
+            ValueError: if the lircrc can't be read, or has an invalid
+                config string. The current keymap is left as it was.
+        """
+        mtime = self._stat()
+        commands = {}
+        buttons = {}
+        repeats = {}
+        for entry in parse(self.path):
+            if entry.get('prog') != self.program_name:
+                continue
+            config = entry.get('config')
+            if config is None:
+                continue
+            if config not in commands:
+                try:
+                    commands[config] = compileConfig(config, self.translator)
+                except ValueError, e:
+                    raise ValueError('Invalid config for {}: {}'.format(
+                            entry.get('button', config), e))
+            if 'button' not in entry:
+                continue
+            key = (entry.get('remote', ANY_REMOTE), entry['button'])
+            if key in buttons:
+                continue
+            try:
+                repeat = int(entry.get('repeat', 0))
+                delay = int(entry.get('delay', 0))
+                if repeat < 0 or delay < 0:
+                    raise ValueError('must not be negative')
+            except ValueError, e:
+                raise ValueError('Invalid repeat or delay for {}: {}'.format(
+                        entry['button'], e))
+            buttons[key] = commands[config]
+            repeats[key] = (repeat, delay)
+        self.commands = commands
+        self.buttons = buttons
+        self.repeats = repeats
+        self._mtime = mtime
+        for cb in self._cbs.values():
+            cb(self)
+        return len(buttons)
+
+    def reload(self):
+        """Reload the lircrc, keeping the current keymap if it's invalid.
+
+        Returns:
+            bool: True if the keymap was reloaded.
+        """
+        try:
+            count = self.load()
+        except ValueError, e:
+            _reloads.inc(labels=('failed',))
+            # Don't reload the same broken file again and again.
+            self._mtime = self._stat()
+            log.msg('Keeping the current keymap: {}'.format(e.args[0]))
+            return False
+        _reloads.inc(labels=('ok',))
+        log.msg('Reloaded {} keys from {}'.format(count, self.path))
+        return True
+
+    def changed(self):
+        """Return True if the lircrc has changed since it was last loaded."""
+        return self._stat() != self._mtime
+
+    def check(self):
+        """Reload the lircrc if it has changed."""
+        if self.changed():
+            self.reload()
+
+    def lookup(self, config):
+        """Return the compiled line for a config string.
+
+        Config strings that aren't in the keymap (from another lircrc, say)
+        are returned as they are.
+        """
+        return self.commands.get(config, config)
+
+    def button(self, remote, button):
+        """Return the compiled line for a button, or None if it isn't mapped.
+
+        Args:
+            remote (str): the remote's name.
+            button (str): the button's name.
+        """
+        line = self.buttons.get((remote, button))
+        if line is None:
+            line = self.buttons.get((ANY_REMOTE, button))
+        return line
+
+    def press(self, remote, button, count):
+        """Return the compiled line for a press of a button, or None.
+
+        As with lirc_client, repeats of a held button are dropped unless
+        its entry has 'repeat = N', in which case every Nth is sent once
+        the first 'delay' repeats have passed.
+
+        Args:
+            remote (str): the remote's name.
+            button (str): the button's name.
+            count (int): lircd's repeat count, 0 for a new press.
+        """
+        key = (remote, button)
+        line = self.buttons.get(key)
+        if line is None:
+            key = (ANY_REMOTE, button)
+            line = self.buttons.get(key)
+            if line is None:
+                return None
+        if count:
+            repeat, delay = self.repeats[key]
+            if not repeat or count <= delay or (count - delay) % repeat:
+                return None
+        return line
+
+    def add_cb(self, key, cb):
+        """Call cb with the keymap whenever it is (re)loaded."""
+        self._cbs[key] = cb
+
+    def remove_cb(self, key):
+        self._cbs.pop(key, None)
+
+    def start(self, hup=True):
+        """Start reloading the lircrc when it changes.
+
+        Args:
+            hup (bool): reload on SIGHUP too.
+        """
+        if self._loop is not None:
+            return
+        self._loop = task.LoopingCall(self.check)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False)
+        if hup:
+            self._previous_handler = signal.signal(signal.SIGHUP, self._hup)
+
+    def stop(self):
+        """Stop watching the lircrc."""
+        if self._loop is not None:
+            if self._loop.running:
+                self._loop.stop()
+            self._loop = None
+        if self._previous_handler is not None:
+            signal.signal(signal.SIGHUP, self._previous_handler)
+            self._previous_handler = None
+
+    def _hup(self, signum, frame):
+        # Signal handlers can interrupt the reactor anywhere, so reload from
+        # the reactor loop instead.
+        self.reactor.callFromThread(self.reload)
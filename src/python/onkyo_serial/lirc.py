@@ -3,16 +3,35 @@
 # cribbed from https://github.com/proquar/twisted-stuff/blob/master/lirc/LircReceiver.py
 
 import os
-import pylirc
+
+try:
+    import pylirc
+except ImportError:
+    # Only LircReader needs it, onkyo_serial.lircd reads lircd directly.
+    pylirc = None
 
 from twisted.application import service
 from twisted.internet import abstract
 from twisted.internet import defer
 from twisted.internet import endpoints
 from twisted.internet import interfaces
+from twisted.internet import main
+from twisted.python import failure
 from twisted.python import log
 from zope import interface
 
+from . import metrics
+
+_codes = metrics.REGISTRY.counter(
+        'onkyo_serial_lirc_codes_total',
+        'Codes read from lirc.')
+_dropped_codes = metrics.REGISTRY.counter(
+        'onkyo_serial_lirc_dropped_codes_total',
+        'Codes from lirc dropped or merged as key repeats.')
+_read_latency = metrics.REGISTRY.histogram(
+        'onkyo_serial_lirc_read_seconds',
+        'Time taken to read and dispatch a batch of lirc codes.')
+
 # Default mapping of Remote key to ISCP commands
 KEYMAP = {
     'KEY_DVD': 'input-selector=dvd',
@@ -87,19 +106,45 @@ class LircReader(abstract.FileDescriptor):
     """A transport to read from the lirc control socket."""
     interface.implements(interfaces.IReadDescriptor)
 
-    def __init__(self, program_name, lirc_config=None, reactor=None):
+    def __init__(self, program_name, lirc_config=None, reactor=None,
+                 repeat_filter=None, keymap=None):
         """
 
         Args:
             program_name (str): Program name as used in the lircrc
             lirc_config (str): Path to the lircrc to use.
             reactor (:twisted:`twisted.internet.reactor`): twisted reactor
+            repeat_filter (onkyo_serial.repeat.RepeatFilter): filter for
+                each batch of codes read, to tame held keys.
+            keymap (onkyo_serial.keymap.Keymap): compiled config strings of
+                the lircrc. lirc is reinitialised when it is reloaded.
 
         """
         abstract.FileDescriptor.__init__(self, reactor)
         self._fd = -1
         self._lirc_config = lirc_config
         self._program_name = program_name
+        self.repeat_filter = repeat_filter
+        self.keymap = keymap
+        if keymap is not None:
+            keymap.add_cb(self, self._keymapReloaded)
+
+    def _init(self):
+        if self._lirc_config is not None:
+            self._fd = pylirc.init(self._program_name, self._lirc_config)
+        else:
+            self._fd = pylirc.init(self._program_name)
+        pylirc.blocking(0)
+
+    def _keymapReloaded(self, _):
+        # pylirc reads the lircrc once, in init, so it has to start over to
+        # see new keys. Only the lirc socket is reopened.
+        if self._fd == -1:
+            return
+        abstract.FileDescriptor.stopReading(self)
+        pylirc.exit()
+        self._init()
+        abstract.FileDescriptor.startReading(self)
 
     def startReading(self):
         if self._fd != -1:
@@ -109,11 +154,7 @@ class LircReader(abstract.FileDescriptor):
                 return
             except OSError:
                 pass
-        if self._lirc_config is not None:
-            self._fd = pylirc.init(self._program_name, self._lirc_config)
-        else:
-            self._fd = pylirc.init(self._program_name)
-        pylirc.blocking(0)
+        self._init()
         self.protocol.connectionMade()
         abstract.FileDescriptor.startReading(self)
 
@@ -121,19 +162,41 @@ class LircReader(abstract.FileDescriptor):
         return
 
     def doRead(self):
+        start = metrics.now()
         codes = pylirc.nextcode()
         output = []
         while codes:
             output.extend(codes)
             codes = pylirc.nextcode()
+        if output:
+            _codes.inc(len(output))
+            if self.keymap is not None:
+                output = [self.keymap.lookup(code) for code in output]
+        if output and self.repeat_filter is not None:
+            filtered = self.repeat_filter.filter(output)
+            _dropped_codes.inc(len(output) - len(filtered))
+            output = filtered
         if output:
             output.append('')
             self.protocol.dataReceived('\r\n'.join(output))
+        _read_latency.observe(metrics.now() - start)
 
     def fileno(self):
         return self._fd
 
+    def loseConnection(self, _connDone=failure.Failure(main.CONNECTION_DONE)):
+        """Close the lirc socket, so another reader can be started."""
+        # Nothing is ever written, so there's nothing to flush first.
+        if self._fd == -1:
+            return
+        abstract.FileDescriptor.stopReading(self)
+        pylirc.exit()
+        self._fd = -1
+        self.connectionLost(_connDone)
+
     def connectionLost(self, reason):
+        if self.keymap is not None:
+            self.keymap.remove_cb(self)
         abstract.FileDescriptor.connectionLost(self, reason)
         self.protocol.connectionLost(reason)
 
@@ -141,10 +204,13 @@ class LircReader(abstract.FileDescriptor):
 class LircEndPoint(object):
     """Lirc client endpoint for use with :twisted:`twisted.internet.endpoints`."""
 
-    def __init__(self, reactor, program_name, lirc_config=None):
+    def __init__(self, reactor, program_name, lirc_config=None,
+                 repeat_filter=None, keymap=None):
         self._reactor = reactor
         self._program_name = program_name
         self._lirc_config = lirc_config
+        self._repeat_filter = repeat_filter
+        self._keymap = keymap
 
     # noinspection PyProtectedMember
     def connect(self, protocolFactory):
@@ -152,7 +218,8 @@ class LircEndPoint(object):
         try:
             wf = endpoints._WrappingFactory(protocolFactory)
             reader = LircReader(self._program_name, self._lirc_config,
-                                self._reactor)
+                                self._reactor, self._repeat_filter,
+                                self._keymap)
             reader.protocol = wf.buildProtocol(None)
             reader.protocol.transport = reader
             reader.startReading()
@@ -165,16 +232,20 @@ class LircClientService(service.Service):
     """A service wrapper for lirc."""
     _factory = None
 
-    def __init__(self, endpoint, factory_klass):
+    def __init__(self, endpoint, factory_klass, keymap=None):
         """
 
         Args:
             endpoint (LircEndPoint):  endpoint for the service.
             factory_klass (:twisted:`twisted.internet.protocol.Factory`):
                 Protocol factory class used to send data from the endpoint to.
+            keymap (onkyo_serial.keymap.Keymap): keymap to reload when the
+                lircrc changes, or on SIGHUP, while the service is running.
         """
         self._endpoint = endpoint
         self._factory_klass = factory_klass
+        self._keymap = keymap
+        self._reader = None
 
     def startService(self):
         from twisted.internet import reactor
@@ -184,6 +255,21 @@ class LircClientService(service.Service):
             log.err(err, _why='Could not connect to lirc')
             reactor.stop()
 
+        def connected(proto):
+            self._reader = proto.transport
+
         factory = self._factory_klass()
         client = self._endpoint.connect(factory)
-        client.addErrback(failure)
+        client.addCallbacks(connected, failure)
+        if self._keymap is not None:
+            self._keymap.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._keymap is not None:
+            self._keymap.stop()
+        # The service is restarted when the receiver reconnects, and pylirc
+        # only allows one reader at a time.
+        if self._reader is not None:
+            reader, self._reader = self._reader, None
+            reader.loseConnection()
@@ -0,0 +1,230 @@
+"""Read button presses straight from the lircd socket.
+
+An alternative to :py:mod:`onkyo_serial.lirc` that doesn't need pylirc:
+it connects to lircd's Unix socket like irw does, and reads lines of::
+
+    <code> <repeat count> <button> <remote>
+
+Buttons are mapped to commands with a :py:class:`onkyo_serial.keymap.Keymap`,
+which drops a held button's repeats as lirc_client would, unless its lircrc
+entry sets repeat (and delay). Several readers can run in one process, and
+the connection to lircd is retried with backoff if it goes away.
+"""
+
+from twisted.application import service
+from twisted.internet import protocol
+from twisted.python import log
+
+from . import metrics
+
+__author__ = 'blaedd@gmail.com'
+
+DEFAULT_SOCKET = '/var/run/lirc/lircd'
+
+# Longest partial line kept between reads. lircd lines are ~50 bytes.
+MAX_LENGTH = 1024
+
+# Lines remembered with what they map to. Each held key only produces a
+# few hundred distinct lines (one per repeat count).
+MAX_CACHED_LINES = 512
+
+_codes = metrics.REGISTRY.counter(
+        'onkyo_serial_lircd_codes_total',
+        'Button presses read from lircd, by result.', ('result',))
+_connections = metrics.REGISTRY.counter(
+        'onkyo_serial_lircd_connections_total',
+        'Connections made to lircd.')
+
+
+class _NullTransport(object):
+    """Transport for the command port protocol, which no one reads."""
+
+    disconnecting = False
+
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+class LircdProtocol(protocol.Protocol):
+    """Map lircd button presses to commands for a command port protocol.
+
+    Lines are split out of each read in one go, and parsed lines are
+    cached with the command they map to, so the repeats of a held key
+    cost a dict lookup each. Replies to lircd commands (BEGIN ... END
+    blocks, eg. for SIGHUP) are skipped.
+    """
+
+    def __init__(self):
+        self.commands = None
+        self._buffer = ''
+        self._in_reply = False
+        self._lines = {}
+
+    def connectionMade(self):
+        _connections.inc()
+        self.factory.keymap.add_cb(self, self._keymapReloaded)
+        self.commands = self.factory.commands.buildProtocol(None)
+        self.commands.makeConnection(_NullTransport())
+        # No one reads the receiver's responses.
+        self.factory.commands.remove_cb(self.commands)
+
+    def _keymapReloaded(self, _):
+        self._lines.clear()
+
+    def _map(self, line):
+        """Return the command for a line from lircd, or None.
+
+        Repeats are dropped unless the button's lircrc entry asks for them.
+        """
+        parts = line.split(' ', 3)
+        if len(parts) != 4:
+            return None
+        try:
+            count = int(parts[1], 16)
+        except ValueError:
+            return None
+        return self.factory.keymap.press(parts[3], parts[2], count)
+
+    def dataReceived(self, data):
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        if len(self._buffer) > MAX_LENGTH:
+            log.msg('Dropping lircd connection, line too long')
+            self._buffer = ''
+            self.transport.loseConnection()
+            return
+        cache = self._lines
+        output = []
+        ignored = 0
+        for line in lines:
+            if self._in_reply:
+                if line == 'END':
+                    self._in_reply = False
+                continue
+            if line == 'BEGIN':
+                self._in_reply = True
+                continue
+            try:
+                command = cache[line]
+            except KeyError:
+                command = self._map(line)
+                if len(cache) >= MAX_CACHED_LINES:
+                    cache.clear()
+                cache[line] = command
+            if command is None:
+                ignored += 1
+            else:
+                output.append(command)
+        if ignored:
+            # Unmapped buttons, and repeats the lircrc doesn't want.
+            _codes.inc(ignored, labels=('ignored',))
+        if not output:
+            return
+        _codes.inc(len(output), labels=('mapped',))
+        repeat_filter = self.factory.repeat_filter
+        if repeat_filter is not None:
+            output = repeat_filter.filter(output)
+        for command in output:
+            self.commands.lineReceived(command)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.factory.keymap.remove_cb(self)
+        if self.commands is not None:
+            self.commands.connectionLost(reason)
+            self.commands = None
+
+
+class LircdClientFactory(protocol.ReconnectingClientFactory):
+    """Reconnecting factory for `LircdProtocol`."""
+
+    protocol = LircdProtocol
+    maxDelay = 30
+
+    def __init__(self, commands, keymap, repeat_filter=None):
+        """
+
+        Args:
+            commands (onkyo_serial.command.CommandPortFactory): factory for
+                the command port protocol commands are sent with.
+            keymap (onkyo_serial.keymap.Keymap): maps buttons to commands.
+            repeat_filter (onkyo_serial.repeat.RepeatFilter): filter for
+                each batch of commands read, to tame held keys.
+        """
+        self.commands = commands
+        self.keymap = keymap
+        self.repeat_filter = repeat_filter
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        log.msg('Could not connect to lircd: {}'.format(
+                reason.getErrorMessage()))
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+                self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        log.msg('Lost connection to lircd: {}'.format(
+                reason.getErrorMessage()))
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+                self, connector, reason)
+
+
+class LircdClientService(service.Service):
+    """A service reading from lircd, for as long as it runs."""
+
+    def __init__(self, path, factory_klass, keymap, repeat_filter=None,
+                 reactor=None):
+        """
+
+        Args:
+            path (str): path to the lircd socket.
+            factory_klass (:twisted:`twisted.internet.protocol.Factory`):
+                factory class for the command port protocol.
+            keymap (onkyo_serial.keymap.Keymap): maps buttons to commands,
+                and is reloaded when the lircrc changes, or on SIGHUP,
+                while the service is running.
+            repeat_filter (onkyo_serial.repeat.RepeatFilter): filter for
+                each batch of commands read, to tame held keys.
+            reactor: reactor to connect with, defaults to the global one.
+        """
+        self.path = path
+        self.keymap = keymap
+        self.repeat_filter = repeat_filter
+        self.factory = None
+        self._factory_klass = factory_klass
+        self._reactor = reactor
+        self._connector = None
+
+    def startService(self):
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        service.Service.startService(self)
+        self.factory = LircdClientFactory(
+                self._factory_klass(), self.keymap, self.repeat_filter)
+        self.factory.clock = reactor
+        self._connector = reactor.connectUNIX(self.path, self.factory)
+        self.keymap.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self.keymap.stop()
+        if self.factory is not None:
+            self.factory.stopTrying()
+        if self._connector is not None:
+            self._connector.disconnect()
+            self._connector = None
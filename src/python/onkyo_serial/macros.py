@@ -0,0 +1,89 @@
+"""Batches and named macros of commands.
+
+A batch is several commands on one line, separated by semicolons::
+
+    system-power=on; input-selector=dvd; master-volume=40
+
+Macros are named batches, loaded from the [macros] section of a config
+file::
+
+    [macros]
+    movie-night = system-power=on; input-selector=dvd;
+        listening-mode=thx; master-volume=40
+    bedtime = master-volume=10; dimmer-level=dark
+
+Both are compiled to raw ISCP up front, so an invalid command rejects the
+whole batch before anything is sent, and macros are only translated once,
+when they're loaded.
+"""
+
+import ConfigParser
+
+from . import translate
+
+__author__ = 'blaedd@gmail.com'
+
+BATCH_SEPARATOR = ';'
+SECTION = 'macros'
+
+
+def isBatch(line):
+    """Return True if a line holds a batch of commands."""
+    return BATCH_SEPARATOR in line
+
+
+def compileBatch(line, translator=None):
+    """Compile a batch of commands to raw ISCP.
+
+    Args:
+        line (str): commands, separated by BATCH_SEPARATOR. Newlines are
+            treated as separators too, for macros that span lines.
+        translator (translate.CommandTranslator): translator to use,
+            defaults to the shared translator.
+
+    Returns:
+        tuple: the raw ISCP commands, including the !1 prefix, in order.
+
+    Raises:
+        ValueError: if the batch is empty, or any command in it is invalid.
+    """
+    if translator is None:
+        translator = translate.TRANSLATOR
+    commands = [c.strip()
+                for c in line.replace('\n', BATCH_SEPARATOR).split(
+                        BATCH_SEPARATOR)]
+    commands = [c for c in commands if c]
+    if not commands:
+        raise ValueError('Empty batch')
+    return tuple(translator.translate(c) for c in commands)
+
+
+def load(path, translator=None):
+    """Load and compile macros from a config file.
+
+    Args:
+        path (str): the config file.
+        translator (translate.CommandTranslator): translator to use,
+            defaults to the shared translator.
+
+    Returns:
+        dict: raw ISCP commands, by lower case macro name.
+
+    Raises:
+        ValueError: if the file can't be read, or a macro is invalid.
+    """
+    parser = ConfigParser.RawConfigParser()
+    try:
+        if not parser.read([path]):
+            raise ValueError('Could not read macros from {}'.format(path))
+    except ConfigParser.Error, e:
+        raise ValueError('Could not parse macros in {}: {}'.format(path, e))
+    if not parser.has_section(SECTION):
+        return {}
+    macros = {}
+    for name, batch in parser.items(SECTION):
+        try:
+            macros[name.lower()] = compileBatch(batch, translator)
+        except ValueError, e:
+            raise ValueError('Invalid macro {}: {}'.format(name, e))
+    return macros
@@ -0,0 +1,266 @@
+"""Lightweight metrics, exposed in the Prometheus text format.
+
+Metrics are registered with a :py:class:`Registry`, normally the shared
+`REGISTRY`, and are cheap enough to update on every line sent or received.
+Histograms use fixed buckets, so an observation is a bisect and a couple
+of increments.
+
+The registry can be served over HTTP with :py:class:`MetricsResource`.
+"""
+
+import bisect
+import timeit
+
+from twisted.web import resource
+
+__author__ = 'blaedd@gmail.com'
+
+# Used to time things, the most precise wall clock on the platform.
+now = timeit.default_timer
+
+# Default buckets for latencies, in seconds.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5)
+
+
+def _labelString(labelnames, labelvalues, extra=None):
+    pairs = zip(labelnames, labelvalues)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in pairs))
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        """Return the metric in the Prometheus text format, as a list of lines."""
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A value that only goes up.
+
+    Labelled counters are incremented with the label values in the same
+    order as `labelnames`::
+
+        c = Counter('hits_total', 'Hits.', ['code'])
+        c.inc(labels=('MVL',))
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        """Increment the counter.
+
+        Args:
+            amount (int|float): amount to increment by.
+            labels (tuple): label values.
+        """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """Return the current value.
+
+        Args:
+            labels (tuple): label values.
+        """
+        return self.values.get(labels, 0)
+
+    def _samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name,
+                                   _labelString(self.labelnames, labels),
+                                   _formatValue(value))
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        """Set the gauge.
+
+        Args:
+            value (int|float): the new value.
+            labels (tuple): label values.
+        """
+        self.values[labels] = value
+
+
+class CallbackMetric(_Metric):
+    """A counter or gauge whose value is read from elsewhere when collected.
+
+    This is used to expose counters that are already kept by other objects
+    (caches, queues) without having to update two sets of counters.
+    """
+
+    def __init__(self, name, documentation, kind, func, labelnames=()):
+        """
+
+        Args:
+            name (str): metric name.
+            documentation (str): help text.
+            kind (str): 'counter' or 'gauge'.
+            func (callable): returns the value, or for labelled metrics a
+                dict of label value tuples to values.
+            labelnames (tuple): names of the labels.
+        """
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.kind = kind
+        self.func = func
+
+    def _samples(self):
+        values = self.func()
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield '{}{} {}'.format(self.name,
+                                   _labelString(self.labelnames, labels),
+                                   _formatValue(value))
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, in fixed buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        # One extra bucket for +Inf.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """Record an observation.
+
+        Args:
+            value (float): the observed value.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self):
+        cumulative = 0
+        bounds = self.buckets + (float('inf'),)
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                    self.name, _labelString((), (), ('le', _formatValue(bound))),
+                    cumulative)
+        yield '{}_sum {}'.format(self.name, _formatValue(self.sum))
+        yield '{}_count {}'.format(self.name, self.count)
+
+
+class Registry(object):
+    """A collection of metrics, by name."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def __contains__(self, name):
+        return name in self._metrics
+
+    def __getitem__(self, name):
+        return self._metrics[name]
+
+    def register(self, metric):
+        """Add a metric, replacing any previous one with the same name.
+
+        Args:
+            metric: the metric to add.
+
+        Returns:
+            the metric.
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        """Remove a metric.
+
+        Args:
+            name (str): name of the metric.
+        """
+        self._metrics.pop(name, None)
+
+    def _getOrCreate(self, klass, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self.register(klass(name, *args, **kwargs))
+        elif not isinstance(metric, klass):
+            raise TypeError('{} is already registered as a {}'.format(
+                    name, metric.kind))
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Return the named counter, creating it if needed."""
+        return self._getOrCreate(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        """Return the named gauge, creating it if needed."""
+        return self._getOrCreate(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        """Return the named histogram, creating it if needed."""
+        return self._getOrCreate(Histogram, name, documentation, buckets)
+
+    def callback(self, name, documentation, kind, func, labelnames=()):
+        """Register a metric read from a callable, see `CallbackMetric`."""
+        return self.register(
+                CallbackMetric(name, documentation, kind, func, labelnames))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+class MetricsResource(resource.Resource):
+    """Twisted web resource serving a registry in the Prometheus format."""
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        """
+
+        Args:
+            registry (Registry): metrics to serve.
+        """
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
@@ -0,0 +1,190 @@
+"""Server side volume ramps.
+
+Fading the volume with repeated level-up commands floods the link with
+writes, each one step. A ramp instead goes from the current level to a
+target over a given time, with as few absolute writes as the link and
+the ear need: at most one per `MIN_INTERVAL` (or per write, on a slower
+link), and never two for the same level.
+
+Only one ramp runs per device, a new ramp cancels the one in flight.
+"""
+
+from twisted.internet import defer
+from twisted.python import log
+
+from . import scheduler
+
+__author__ = 'blaedd@gmail.com'
+
+# Seconds between volume writes, at the most. Finer steps aren't audible.
+MIN_INTERVAL = 0.2
+
+DEFAULT_DURATION = 2.0
+
+LINEAR = 'linear'
+EASE_IN = 'ease-in'
+EASE_OUT = 'ease-out'
+EASE_IN_OUT = 'ease-in-out'
+
+# Fraction of the change made by a fraction of the duration.
+CURVES = {
+    LINEAR: lambda t: t,
+    EASE_IN: lambda t: t * t,
+    EASE_OUT: lambda t: 1 - (1 - t) * (1 - t),
+    EASE_IN_OUT: lambda t: t * t * (3 - 2 * t),
+}
+
+
+def steps(start, target, duration, interval=MIN_INTERVAL, curve=LINEAR):
+    """Plan the writes for a ramp.
+
+    Args:
+        start (int): level at the start of the ramp.
+        target (int): level at the end of the ramp.
+        duration (float): seconds the ramp takes.
+        interval (float): minimum seconds between writes.
+        curve (str): one of `CURVES`.
+
+    Returns:
+        list: (seconds from the start, level) for each write, ending with
+        the target. Empty if already at the target.
+    """
+    if start == target:
+        return []
+    shape = CURVES[curve]
+    delta = target - start
+    count = max(1, min(abs(delta), int(duration / interval)))
+    planned = []
+    last = start
+    for i in xrange(1, count + 1):
+        fraction = float(i) / count
+        level = int(round(start + delta * shape(fraction)))
+        if level != last:
+            planned.append((duration * fraction, level))
+            last = level
+    return planned
+
+
+class Ramp(object):
+    """A volume ramp in progress.
+
+    Attributes:
+        deferred (Deferred): fires with the response for the final write
+            once it has been queued, or fails with
+            :twisted:`twisted.internet.defer.CancelledError` if the ramp is
+            cancelled first.
+    """
+
+    def __init__(self, device, target, duration=DEFAULT_DURATION,
+                 curve=LINEAR, interval=MIN_INTERVAL, clock=None,
+                 code='MVL'):
+        """
+
+        Args:
+            device (onkyo_serial.iscp.ISCP): device to write to.
+            target (int): level to ramp to.
+            duration (float): seconds the ramp takes.
+            curve (str): one of `CURVES`.
+            interval (float): minimum seconds between writes.
+            clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                clock to pace the writes with, defaults to the reactor.
+            code (str): ISCP command to write levels with.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.device = device
+        self.target = target
+        self.duration = duration
+        self.curve = curve
+        self.interval = interval
+        self.clock = clock
+        self.code = code
+        self.deferred = defer.Deferred(lambda _: self._stop())
+        self._planned = []
+        self._start = None
+        self._call = None
+        self._query = None
+
+    @property
+    def active(self):
+        return not self.deferred.called
+
+    def start(self, level=None):
+        """Start the ramp.
+
+        Args:
+            level (int): the current level, queried from the device if
+                not known.
+
+        Returns:
+            Deferred: `deferred`.
+        """
+        if level is not None:
+            self._begin(level)
+        else:
+            self._query = self.device.command(
+                    self.code + 'QSTN', priority=scheduler.INTERACTIVE,
+                    wait=True)
+            self._query.addCallbacks(self._queried, self._queryFailed)
+            self._query.addErrback(self._failed)
+        return self.deferred
+
+    def cancel(self, reason='Ramp cancelled'):
+        """Stop the ramp where it is.
+
+        Args:
+            reason (str): message for the ramp's CancelledError.
+        """
+        if self.active:
+            self._stop()
+            self.deferred.errback(defer.CancelledError(reason))
+
+    def _stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self._query is not None:
+            query, self._query = self._query, None
+            query.cancel()
+
+    def _queried(self, resp):
+        self._query = None
+        self._begin(int(resp.args, 16))
+
+    def _queryFailed(self, failure):
+        # The query is forgotten first when the ramp is stopped.
+        if self._query is not None:
+            self._query = None
+            self._failed(failure)
+
+    def _failed(self, failure):
+        if self.active:
+            self._stop()
+            self.deferred.errback(failure)
+
+    def _begin(self, level):
+        if not self.active:
+            return
+        self._planned = steps(level, self.target, self.duration,
+                              self.interval, self.curve)
+        self._start = self.clock.seconds()
+        self._next()
+
+    def _next(self):
+        self._call = None
+        while self._planned:
+            at, level = self._planned[0]
+            delay = at - (self.clock.seconds() - self._start)
+            if delay > 0:
+                self._call = self.clock.callLater(delay, self._next)
+                return
+            self._planned.pop(0)
+            line = '!1{}{:02X}'.format(self.code, level)
+            try:
+                self.device.command(line, priority=scheduler.INTERACTIVE)
+            except ValueError, e:
+                log.err(e)
+                self.cancel('Invalid level {}'.format(level))
+                return
+        self.deferred.callback(self.device.decoder.decode(
+                '{}{:02X}'.format(self.code, self.target)))
@@ -0,0 +1,173 @@
+"""Tame held remote keys.
+
+A held key on a remote repeats several times a second, and each repeat
+would otherwise be a command to the receiver. `RepeatFilter` sits between
+lirc and the command port, and:
+
+    - collapses the commands read in one batch: repeats of the same
+      command are sent once, and UP/DOWN steps for the same ISCP command
+      net out into one step in the winning direction.
+    - sends each command at most once per minimum interval, dropping
+      repeats in between. The interval can be set per ISCP command, so
+      toggles like muting can be slower than volume.
+    - accelerates steps for commands with an acceleration curve (volume,
+      by default), taking bigger steps the longer the key is held.
+
+Steps of more than one go out as a single 'repeat N COMMAND' line, which
+the command port queues as one net change.
+"""
+
+import collections
+
+from . import scheduler
+from . import translate
+
+__author__ = 'blaedd@gmail.com'
+
+# Seconds between sends of the same command, while its key is held.
+DEFAULT_MIN_INTERVAL = 0.2
+
+# A key is still held if it repeats within this many seconds.
+DEFAULT_HOLD_TIMEOUT = 0.5
+
+# Toggles and power flap if repeated too quickly.
+DEFAULT_INTERVALS = {
+    'AMT': 0.5,
+    'ZMT': 0.5,
+    'PWR': 1.0,
+    'ZPW': 1.0,
+}
+
+# (seconds held, steps per repeat), in order.
+VOLUME_ACCELERATION = ((0, 1), (1.0, 2), (2.5, 4))
+
+DEFAULT_ACCELERATION = {
+    'MVL': VOLUME_ACCELERATION,
+    'ZVL': VOLUME_ACCELERATION,
+    'VL3': VOLUME_ACCELERATION,
+    'VL4': VOLUME_ACCELERATION,
+}
+
+
+class _Key(object):
+    """What's known about a held key."""
+
+    __slots__ = ('held_since', 'seen', 'sent')
+
+    def __init__(self, now):
+        self.held_since = now
+        self.seen = now
+        self.sent = None
+
+
+class RepeatFilter(object):
+    """Debounce, collapse and accelerate batches of lirc commands.
+
+    Attributes:
+        dropped (int): commands dropped, as repeats or net-zero steps.
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, intervals=None,
+                 acceleration=None, hold_timeout=DEFAULT_HOLD_TIMEOUT,
+                 clock=None, translator=None):
+        """
+
+        Args:
+            min_interval (float): seconds between sends of a command.
+            intervals (dict): min_interval for particular ISCP commands
+                (eg. 'AMT'), or command lines that aren't ISCP commands.
+                Defaults to `DEFAULT_INTERVALS`.
+            acceleration (dict): (seconds held, steps) curves, by ISCP
+                command, defaults to `DEFAULT_ACCELERATION`.
+            hold_timeout (float): a key repeated within this many seconds
+                is still being held.
+            clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                defaults to the reactor.
+            translator (translate.CommandTranslator): used to recognise
+                commands, defaults to the shared translator.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if intervals is None:
+            intervals = DEFAULT_INTERVALS
+        if acceleration is None:
+            acceleration = DEFAULT_ACCELERATION
+        if translator is None:
+            translator = translate.TRANSLATOR
+        self.min_interval = min_interval
+        self.intervals = intervals
+        self.acceleration = acceleration
+        self.hold_timeout = hold_timeout
+        self.clock = clock
+        self.translator = translator
+        self.dropped = 0
+        self._keys = {}
+
+    def _classify(self, line):
+        """Return (group, code, step) for a command line.
+
+        Lines in the same group are collapsed together. step is +1/-1 for
+        UP/DOWN steps that can be netted out, otherwise 0.
+        """
+        try:
+            raw = self.translator.translate(line)
+        except ValueError:
+            return line, line, 0
+        code, args = raw[2:5], raw[5:]
+        step = scheduler.STEPS.get(args, 0)
+        if step and code in scheduler.COALESCE_CODES:
+            return code, code, step
+        return raw, code, 0
+
+    def _steps(self, code, held):
+        steps = 1
+        for after, count in self.acceleration.get(code, ()):
+            if held >= after:
+                steps = count
+        return steps
+
+    def filter(self, lines):
+        """Filter a batch of command lines read together.
+
+        Args:
+            lines (list): command lines, in the order they were read.
+
+        Returns:
+            list: the lines to send, in order of first appearance.
+        """
+        now = self.clock.seconds()
+        groups = collections.OrderedDict()
+        for line in lines:
+            group, code, step = self._classify(line)
+            entry = groups.get(group)
+            if entry is None:
+                groups[group] = [line, code, step, bool(step)]
+            else:
+                self.dropped += 1
+                entry[2] += step
+                if not step:
+                    entry[0] = line
+        output = []
+        for group, (line, code, net, stepped) in groups.iteritems():
+            if stepped and net == 0:
+                # The steps cancelled out.
+                self.dropped += 1
+                continue
+            if net:
+                group = '{}{}'.format(code, 'UP' if net > 0 else 'DOWN')
+            key = self._keys.get(group)
+            if key is None or now - key.seen > self.hold_timeout:
+                key = self._keys[group] = _Key(now)
+            key.seen = now
+            interval = self.intervals.get(code, self.min_interval)
+            if key.sent is not None and now - key.sent < interval:
+                self.dropped += 1
+                continue
+            key.sent = now
+            if net:
+                line = '!1' + group
+                steps = self._steps(code, now - key.held_since)
+                if steps > 1:
+                    line = 'repeat {} {}'.format(steps, line)
+            output.append(line)
+        return output
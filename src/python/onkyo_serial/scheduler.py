@@ -0,0 +1,248 @@
+"""Pace writes to slow ISCP links."""
+
+import collections
+
+from . import state as receiver_state
+from . import translate
+
+__author__ = 'blaedd@gmail.com'
+
+# Priority classes, lower values are sent first.
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+# Commands whose queued settings may be merged, the latest value wins.
+# Menu navigation and the like must be sent as is, so aren't included.
+COALESCE_CODES = frozenset([
+    'MVL', 'ZVL', 'VL3', 'VL4',  # volume
+    'AMT', 'ZMT', 'MT3', 'MT4',  # muting
+    'SLI', 'SLZ', 'SL3', 'SL4',  # input selector
+    'PWR', 'ZPW', 'PW3', 'PW4',  # power
+    'LMD', 'DIM', 'LTN', 'RAS', 'SLP',
+])
+
+# Relative arguments that can be merged into a net change.
+STEPS = {'UP': 1, 'DOWN': -1}
+
+# Arguments that are neither a setting nor a step, and are sent as is.
+_OPAQUE = frozenset(['QSTN', 'TG', 'UP1', 'DOWN1'])
+
+
+class _Entry(object):
+    """A queued write, which may absorb later writes for the same command."""
+
+    __slots__ = ('code', 'args', 'steps', 'level', 'mergeable')
+
+    def __init__(self, line, mergeable):
+        self.code = line[2:5]
+        self.args = line[5:]
+        self.steps = STEPS.get(self.args, 0) if mergeable else 0
+        self.level = None
+        self.mergeable = mergeable
+
+    @property
+    def line(self):
+        if self.level is not None:
+            return '!1{}{:02X}'.format(self.code, self.level)
+        return '!1{}{}'.format(self.code, self.args)
+
+
+class WriteScheduler(object):
+    """Queue writes to an ISCP link, and send them no faster than it can take.
+
+    Receivers have tiny UART buffers, and commands sent back to back tend
+    to be silently dropped. Each write is held back until the previous one
+    has been transmitted at the configured baud rate, plus an inter-command
+    gap to let the receiver process it.
+
+    Writes are queued by priority class, interactive commands (key presses)
+    go ahead of background ones (status queries).
+
+    Commands that are still queued are coalesced with newer ones for the
+    same ISCP command:
+
+        - duplicate queries are dropped.
+        - a newer setting replaces a queued one (MVL20 then MVL28 sends only
+          MVL28).
+        - UP/DOWN steps are added to a queued level (MVL20 then MVLUP sends
+          MVL21), or merged into one net step, which is sent as a single
+          absolute level when the current level is fresh, and one step at
+          a time otherwise.
+
+    Only commands listed in `coalesce_codes` are merged, other than queries.
+    """
+
+    # 8 data bits, 1 start and 1 stop bit.
+    bits_per_byte = 10
+
+    def __init__(self, write, baudrate=9600, gap=0.05, clock=None,
+                 state=None, coalesce_codes=COALESCE_CODES, decoder=None):
+        """
+
+        Args:
+            write (callable): called with each line when it is due to be sent.
+            baudrate (int): baud rate of the link.
+            gap (float): seconds to wait between commands, after the
+                previous one has been transmitted.
+            clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                defaults to the reactor.
+            state (state.ReceiverState): the receiver's reported values,
+                used to turn net steps into absolute levels.
+            coalesce_codes (set): ISCP commands whose settings may be merged.
+            decoder (translate.ResponseDecoder): used to look up the level
+                ranges of commands, defaults to the shared decoder.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if decoder is None:
+            decoder = translate.DECODER
+        self._write = write
+        self.baudrate = baudrate
+        self.gap = gap
+        self.clock = clock
+        if state is None:
+            state = receiver_state.ReceiverState(clock=clock)
+        self.state = state
+        self.coalesce_codes = coalesce_codes
+        self.decoder = decoder
+        self.coalesced = 0
+        self._queues = tuple(collections.deque() for _ in PRIORITIES)
+        self._pending = {}
+        self._call = None
+        self._ready_at = 0
+
+    def __len__(self):
+        return self.depth
+
+    @property
+    def depth(self):
+        """Number of writes waiting to be sent."""
+        return sum(len(q) for q in self._queues)
+
+    def queueDepth(self, priority):
+        """Number of writes waiting to be sent in a priority class.
+
+        Args:
+            priority (int): priority class.
+        """
+        return len(self._queues[priority])
+
+    def transmitTime(self, line):
+        """Seconds taken to transmit a line at the configured baud rate.
+
+        Args:
+            line (str): line to be transmitted.
+        """
+        # Plus the line delimiter.
+        return float((len(line) + 1) * self.bits_per_byte) / self.baudrate
+
+    def schedule(self, line, priority=INTERACTIVE):
+        """Queue a line to be written.
+
+        Args:
+            line (str): raw ISCP command, including the !1 prefix.
+            priority (int): priority class, one of INTERACTIVE or BACKGROUND.
+        """
+        code, args = line[2:5], line[5:]
+        key = (priority, code)
+        pending = self._pending.get(key)
+        if pending is not None and self._merge(pending, args):
+            self.coalesced += 1
+            if pending.args in STEPS and pending.steps == 0:
+                # The steps cancelled out, there's nothing left to send.
+                self._queues[priority].remove(pending)
+                del self._pending[key]
+        else:
+            entry = _Entry(line, code in self.coalesce_codes and
+                           args not in _OPAQUE)
+            self._queues[priority].append(entry)
+            self._pending[key] = entry
+        if self._call is None:
+            self._pump()
+
+    def clear(self):
+        """Drop any queued writes."""
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        for q in self._queues:
+            q.clear()
+        self._pending.clear()
+
+    def _merge(self, entry, args):
+        """Merge a new command into a queued one, if possible."""
+        if args == 'QSTN':
+            return entry.args == 'QSTN'
+        if not entry.mergeable or args in _OPAQUE:
+            return False
+        step = STEPS.get(args)
+        if step is None:
+            entry.args = args
+            entry.steps = 0
+            entry.level = None
+            return True
+        if entry.args in STEPS:
+            entry.steps += step
+            if entry.steps:
+                entry.args = 'UP' if entry.steps > 0 else 'DOWN'
+            return True
+        level_range = self.decoder.levelRange(entry.code)
+        if not level_range:
+            return False
+        if entry.level is None:
+            try:
+                entry.level = int(entry.args, 16)
+            except ValueError:
+                return False
+        entry.level = max(level_range[0],
+                          min(level_range[1], entry.level + step))
+        return True
+
+    def _pop(self):
+        for priority, q in enumerate(self._queues):
+            if q:
+                entry = q.popleft()
+                key = (priority, entry.code)
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+                return self._render(priority, entry)
+        return None
+
+    def _render(self, priority, entry):
+        """Return the line to send for an entry, requeueing any remainder."""
+        steps = entry.steps
+        if steps in (0, 1, -1):
+            return entry.line
+        level_range = self.decoder.levelRange(entry.code)
+        # A stale level (restored, or from before a disconnect) could jump
+        # the receiver somewhere no one asked for.
+        current = self.state.fresh(entry.code)
+        if level_range and current is not None:
+            try:
+                level = int(current, 16)
+            except ValueError:
+                pass
+            else:
+                entry.level = max(level_range[0],
+                                  min(level_range[1], level + steps))
+                return entry.line
+        # Can't send the net change in one go, so send one step at a time.
+        entry.steps -= 1 if steps > 0 else -1
+        self._queues[priority].appendleft(entry)
+        self._pending.setdefault((priority, entry.code), entry)
+        return '!1{}{}'.format(entry.code, entry.args)
+
+    def _pump(self):
+        self._call = None
+        now = self.clock.seconds()
+        if now < self._ready_at:
+            self._call = self.clock.callLater(self._ready_at - now, self._pump)
+            return
+        line = self._pop()
+        if line is None:
+            return
+        self._ready_at = now + self.transmitTime(line) + self.gap
+        if self.depth:
+            self._call = self.clock.callLater(self._ready_at - now, self._pump)
+        self._write(line)
@@ -3,10 +3,13 @@
 import logging
 
 from twisted.application import service
-from twisted.internet import endpoints, error, serialport, defer, task
+from twisted.internet import endpoints, error, serialport, defer
 from twisted.python import log
 
 from . import iscp
+from . import metrics
+from . import scheduler
+from . import state
 
 __author__ = 'blaedd@gmail.com'
 
@@ -60,33 +63,115 @@ class OnkyoService(service.Service):
         self._port = port
 
 
+# Devices with registered metrics, by registry and then device name.
+_devices = {}
+
+
+def registerMetrics(receiver_state, write_scheduler=None,
+                    registry=metrics.REGISTRY, device=''):
+    """Expose the query cache and write queue of an ISCP device as metrics.
+
+    Each device's metrics are labelled with its name, so several devices
+    can share a registry.
+
+    Args:
+        receiver_state (onkyo_serial.state.ReceiverState): the device state.
+        write_scheduler (onkyo_serial.scheduler.WriteScheduler): the device
+            write scheduler, if any.
+        registry (onkyo_serial.metrics.Registry): registry to add them to.
+        device (str): name of the device.
+    """
+    devices = _devices.setdefault(registry, {})
+    devices[device] = (receiver_state, write_scheduler)
+
+    def queries():
+        values = {}
+        for name, (rs, _) in devices.iteritems():
+            for code, count in rs.hits.iteritems():
+                values[(name, code, 'hit')] = count
+            for code, count in rs.misses.iteritems():
+                values[(name, code, 'miss')] = count
+        return values
+
+    def queueDepth():
+        values = {}
+        for name, (_, ws) in devices.iteritems():
+            if ws is not None:
+                for p in scheduler.PRIORITIES:
+                    values[(name, p)] = ws.queueDepth(p)
+        return values
+
+    def coalesced():
+        return dict(((name,), ws.coalesced)
+                    for name, (_, ws) in devices.iteritems()
+                    if ws is not None)
+
+    registry.callback(
+            'onkyo_serial_queries_total',
+            'Queries by ISCP command, and whether they were answered from '
+            'cached state.', 'counter', queries, ('device', 'code', 'result'))
+    registry.callback(
+            'onkyo_serial_write_queue_depth',
+            'Commands waiting to be written, by priority class.', 'gauge',
+            queueDepth, ('device', 'priority'))
+    registry.callback(
+            'onkyo_serial_coalesced_commands_total',
+            'Commands merged into one already queued.', 'counter', coalesced,
+            ('device',))
+
+
 # noinspection PyTypeChecker
 class SerialISCPService(service.MultiService):
     """Service for an ISCP device, which also serves as a container.
     """
 
-    def __init__(self, device, baudrate=9600):
+    def __init__(self, device, baudrate=9600, gap=0.05,
+                 state_ttl=state.DEFAULT_TTL, state_file=None):
         """
 
+        Each service has its own protocol, write scheduler and state, so
+        several can run in one process without affecting each other.
+
         Args:
             device(str): serial device to connect to
             baudrate(int): baudrate to use with device.
+            gap(float): seconds to wait between commands sent to the device.
+            state_ttl(float): seconds a reported value is used to answer
+                queries for.
+            state_file(str): file to snapshot the receiver state in, so it
+                survives restarts.
         """
         service.MultiService.__init__(self)
-        self._iscp = iscp.ISCP()
+        self._iscp = iscp.ISCP(
+                receiver_state=state.ReceiverState(ttl=state_ttl))
+        self._iscp.scheduler = scheduler.WriteScheduler(
+                self._iscp.sendLine, baudrate=baudrate, gap=gap,
+                state=self._iscp.receiver_state)
+        registerMetrics(self._iscp.receiver_state, self._iscp.scheduler,
+                        device=device)
         self._device = device
         self._baudrate = baudrate
         self._serial = None
+        self._snapshot = None
+        if state_file is not None:
+            self._snapshot = state.StateSnapshot(
+                    self._iscp.receiver_state, state_file)
 
     def startService(self):
         from twisted.internet import reactor
         service.Service.startService(self)
+        # Restore state before connecting, so it's revalidated on connect.
+        if self._snapshot is not None:
+            self._snapshot.load()
+            self._snapshot.start()
         self._serial = serialport.SerialPort(self._iscp, self._device, reactor, baudrate=self._baudrate)
         for svc in self:
             svc.startService()
 
     def stopService(self):
         service.Service.stopService(self)
+        if self._snapshot is not None:
+            self._snapshot.stop()
         l = []
         for svc in reversed(list(self)):
             l.append(defer.maybeDeferred(svc.stopService))
@@ -104,63 +189,122 @@ class SerialISCPService(service.MultiService):
 
 # noinspection PyTypeChecker,PyTypeChecker,PyTypeChecker,PyTypeChecker
 class ISCPClientService(service.MultiService):
-    """ISCP over an endpoint (likely a raw tcp connection from a console server)"""
+    """ISCP over an endpoint (likely a raw tcp connection from a console server)
+
+    Child services (eISCP, command and lirc ports) are started as soon as
+    the device connects, and stopped when the connection is lost.
+    """
 
     def __init__(self, connectMethod, *args, **kwargs):
+        """
+
+        Args:
+            connectMethod (callable): connects the factory, eg.
+                reactor.connectTCP.
+            args: passed to connectMethod.
+            kwargs: passed to connectMethod, except for device_name which
+                names the device in metrics, state_file to snapshot the
+                receiver state in, and gap and baudrate, which pace writes
+                as for a `SerialISCPService` when gap is given (for a
+                serial line behind a console server, say).
+        """
         service.MultiService.__init__(self)
+        device_name = kwargs.pop('device_name', '')
+        state_file = kwargs.pop('state_file', None)
+        gap = kwargs.pop('gap', None)
+        baudrate = kwargs.pop('baudrate', 9600)
         self._connectMethod = connectMethod
         self._args = args
         self._kwargs = kwargs
         self._connector = None
+        self._childrenRunning = False
         self._factory = iscp.ISCPClientFactory()
+        if gap is not None:
+            self._factory.scheduler = scheduler.WriteScheduler(
+                    self._factory.sendLine, baudrate=baudrate, gap=gap,
+                    state=self._factory.receiver_state)
+        registerMetrics(self._factory.receiver_state, self._factory.scheduler,
+                        device=device_name)
+        self._snapshot = None
+        if state_file is not None:
+            self._snapshot = state.StateSnapshot(
+                    self._factory.receiver_state, state_file)
 
     def startService(self):
         service.Service.startService(self)
+        if self._snapshot is not None:
+            self._snapshot.load()
+            self._snapshot.start()
+        self._factory.addConnectionObserver(self._deviceConnected,
+                                            self._deviceDisconnected)
         self._connector = self._connectMethod(*self._args, factory=self._factory, **self._kwargs)
 
-        def waitForConnect():
-            if self._connector.state == 'connected':
-                log.msg('Starting child services now.', level=logging.DEBUG)
-                # noinspection PyTypeChecker
-                for svc in self:
-                    svc.startService()
-            else:
-                from twisted.internet import reactor
-                task.deferLater(reactor, 1, waitForConnect)
+    def _deviceConnected(self, device):
+        if self._childrenRunning:
+            return
+        log.msg('Starting child services now.', level=logging.DEBUG)
+        self._childrenRunning = True
+        # noinspection PyTypeChecker
+        for svc in self:
+            svc.startService()
 
-        waitForConnect()
+    def _deviceDisconnected(self, reason=None):
+        return self._stopChildren()
+
+    def _stopChildren(self):
+        if not self._childrenRunning:
+            return defer.succeed(None)
+        log.msg('Stopping child services.', level=logging.DEBUG)
+        self._childrenRunning = False
+        l = []
+        for svc in reversed(list(self)):
+            l.append(defer.maybeDeferred(svc.stopService))
+        return defer.DeferredList(l)
 
     def stopService(self):
-        def stop_cb():
+        def stop_cb(_=None):
             if self._connector is not None:
+                self._factory.stopTrying()
                 self._connector.disconnect()
-                del self._connector
+                self._connector = None
 
         service.Service.stopService(self)
-        l = []
-        for svc in reversed(list(self)):
-            l.append(defer.maybeDeferred(svc.stopService))
-        if l:
-            l = defer.DeferredList(l)
-            l.addCallback(stop_cb)
-        else:
-            stop_cb()
-        return l
+        if self._snapshot is not None:
+            self._snapshot.stop()
+        self._factory.removeConnectionObserver(self._deviceConnected,
+                                               self._deviceDisconnected)
+        d = self._stopChildren()
+        d.addCallback(stop_cb)
+        return d
 
     def getProtocol(self):
         return self._factory
 
 
 # noinspection PyUnresolvedReferences
-def ISCPTCPService(host, port):
+def ISCPTCPService(host, port, baudrate=9600, gap=0.05,
+                   state_ttl=state.DEFAULT_TTL, state_file=None):
     """Create an ISCP client service over TCP
 
+    Console servers usually have the receiver's serial port behind them,
+    so writes are paced as for a `SerialISCPService`.
+
     Args:
         host(str): Host to connect to.
         port(int): port to connect to.
+        baudrate(int): baudrate of the serial line behind the server.
+        gap(float): seconds to wait between commands sent to the device.
+        state_ttl(float): seconds a reported value is used to answer
+            queries for.
+        state_file(str): file to snapshot the receiver state in.
 
     Returns:
         `ISCPClientService`
     """
     from twisted.internet import reactor
-    return ISCPClientService(reactor.connectTCP, host, port)
+    svc = ISCPClientService(reactor.connectTCP, host, port,
+                            device_name='{}:{}'.format(host, port),
+                            state_file=state_file, gap=gap,
+                            baudrate=baudrate)
+    svc.getProtocol().receiver_state.ttl = state_ttl
+    return svc
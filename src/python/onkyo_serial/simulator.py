@@ -0,0 +1,280 @@
+"""A simulated ISCP receiver, for testing the bridge without hardware.
+
+The simulated receiver keeps its own state, answers queries, applies
+commands and sends unsolicited updates, with the timing of a 9600 baud
+serial link and a receiver that takes a while to process each command.
+
+It can be served over TCP (for use with `ISCPTCPService`) or over a
+local pty (for use with `SerialISCPService`)::
+
+    eiscp_bridge simulate --listen tcp:60200
+    eiscp_bridge run -t tcp -d localhost:60200
+"""
+
+import collections
+import os
+import tty
+
+from twisted.application import service
+from twisted.internet import main
+from twisted.internet import protocol
+from twisted.internet import stdio
+from twisted.internet import task
+from twisted.protocols import basic
+from twisted.python import failure
+from twisted.python import log
+
+from . import translate
+
+__author__ = 'blaedd@gmail.com'
+
+# Power on, volume 32, unmuted, DVD input, stereo.
+DEFAULT_STATE = {
+    'PWR': '01',
+    'MVL': '20',
+    'AMT': '00',
+    'SLI': '10',
+    'LMD': '00',
+    'DIM': '00',
+}
+
+TOGGLES = {'00': '01', '01': '00'}
+
+
+class SimulatedReceiver(basic.LineOnlyReceiver):
+    """Protocol imitating an ISCP receiver.
+
+    Commands are processed one at a time, each taking `processing_delay`
+    seconds. Like a real receiver's UART, only `max_pending` commands can
+    be waiting to be processed, anything arriving after that is dropped.
+
+    Responses are written no faster than `baudrate` allows.
+    """
+    delimiter = '\n'
+    response_delimiter = '\x1a'
+
+    # 8 data bits, 1 start and 1 stop bit.
+    bits_per_byte = 10
+
+    def __init__(self, baudrate=9600, processing_delay=0.05, max_pending=4,
+                 unsolicited_interval=10, state=None, clock=None,
+                 decoder=None):
+        """
+
+        Args:
+            baudrate (int): simulated baud rate of the link.
+            processing_delay (float): seconds taken to process a command.
+            max_pending (int): commands that can wait to be processed, or
+                None for no limit.
+            unsolicited_interval (float): seconds between unsolicited
+                updates, or None for none.
+            state (dict): initial state, by ISCP command.
+            clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                defaults to the reactor.
+            decoder (translate.ResponseDecoder): used to validate commands.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if decoder is None:
+            decoder = translate.DECODER
+        self.baudrate = baudrate
+        self.processing_delay = processing_delay
+        self.max_pending = max_pending
+        self.unsolicited_interval = unsolicited_interval
+        self.state = dict(DEFAULT_STATE if state is None else state)
+        self.clock = clock
+        self.decoder = decoder
+        self.received = 0
+        self.dropped = 0
+        self._pending = collections.deque()
+        self._processing = None
+        self._output = collections.deque()
+        self._writing = None
+        self._unsolicited = None
+        self._unsolicited_codes = None
+
+    def connectionMade(self):
+        if self.unsolicited_interval:
+            self._unsolicited = task.LoopingCall(self.sendUnsolicited)
+            self._unsolicited.clock = self.clock
+            self._unsolicited.start(self.unsolicited_interval, now=False)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self._unsolicited is not None and self._unsolicited.running:
+            self._unsolicited.stop()
+        for call in (self._processing, self._writing):
+            if call is not None and call.active():
+                call.cancel()
+        self._pending.clear()
+        self._output.clear()
+
+    def lineReceived(self, line):
+        line = line.strip()
+        if not line.startswith('!1'):
+            return
+        self.received += 1
+        if self.max_pending is not None and (
+                len(self._pending) >= self.max_pending):
+            self.dropped += 1
+            log.msg('Simulated receiver overrun, dropped {}'.format(line))
+            return
+        self._pending.append(line[2:])
+        if self._processing is None:
+            self._processing = self.clock.callLater(
+                    self.processing_delay, self._process)
+
+    def _process(self):
+        self._processing = None
+        response = self.apply(self._pending.popleft())
+        if response is not None:
+            self.respond(response)
+        if self._pending:
+            self._processing = self.clock.callLater(
+                    self.processing_delay, self._process)
+
+    def apply(self, cmd):
+        """Apply a command to the simulated state.
+
+        Args:
+            cmd (str): ISCP command, without the !1 prefix.
+
+        Returns:
+            str: the response, or None if the command is ignored.
+        """
+        code, args = cmd[:3], cmd[3:]
+        if code not in self.decoder:
+            return None
+        current = self.state.get(code)
+        if args == 'QSTN':
+            return code + (current if current is not None else 'N/A')
+        level_range = self.decoder.levelRange(code)
+        if args in ('UP', 'DOWN') and level_range and current is not None:
+            level = int(current, 16) + (1 if args == 'UP' else -1)
+            level = max(level_range[0], min(level_range[1], level))
+            args = '{:02X}'.format(level)
+        elif args == 'TG':
+            args = TOGGLES.get(current, '01')
+        elif args in ('UP', 'DOWN', 'UP1', 'DOWN1'):
+            # Cycles through settings we don't model, report no change.
+            args = current if current is not None else 'N/A'
+        self.state[code] = args
+        return code + args
+
+    def sendUnsolicited(self):
+        """Report the next piece of state, as receivers do when it changes."""
+        if not self._unsolicited_codes:
+            self._unsolicited_codes = collections.deque(sorted(self.state))
+        if self._unsolicited_codes:
+            code = self._unsolicited_codes.popleft()
+            self.respond(code + self.state[code])
+
+    def respond(self, response):
+        """Queue a response to be written at the simulated baud rate.
+
+        Args:
+            response (str): ISCP response, without the !1 prefix.
+        """
+        self._output.append('!1{}{}'.format(response, self.response_delimiter))
+        if self._writing is None:
+            self._write()
+
+    def _write(self):
+        self._writing = None
+        if not self._output:
+            return
+        data = self._output.popleft()
+        self.transport.write(data)
+        self._writing = self.clock.callLater(
+                float(len(data) * self.bits_per_byte) / self.baudrate,
+                self._write)
+
+
+class SimulatorFactory(protocol.Factory):
+    """Factory for `SimulatedReceiver`, sharing state between connections."""
+    protocol = SimulatedReceiver
+
+    def __init__(self, state=None, **kwargs):
+        """
+
+        Args:
+            state (dict): initial state, by ISCP command.
+            kwargs: passed to `SimulatedReceiver`.
+        """
+        self.state = dict(DEFAULT_STATE if state is None else state)
+        self._kwargs = kwargs
+
+    def buildProtocol(self, addr):
+        p = self.protocol(**self._kwargs)
+        p.state = self.state
+        p.factory = self
+        return p
+
+
+class PtySimulatorService(service.Service):
+    """Serve a simulated receiver on a local pty.
+
+    The pty is allocated when the service starts, or when its device is
+    first asked for, so that it can be passed to a `SerialISCPService`::
+
+        sim = PtySimulatorService()
+        iscp_service = SerialISCPService(sim.device)
+        sim.setServiceParent(iscp_service)
+
+    It is closed when the service stops.
+    """
+
+    def __init__(self, **kwargs):
+        """
+
+        Args:
+            kwargs: passed to `SimulatedReceiver`.
+        """
+        self._kwargs = kwargs
+        self._master = None
+        self._master_out = None
+        self._slave = None
+        self._device = None
+        self._transport = None
+        self.protocol = None
+
+    @property
+    def device(self):
+        """str: the pty's device."""
+        self._openPty()
+        return self._device
+
+    def _openPty(self):
+        if self._master is not None:
+            return
+        # The slave end is held open, so reads from the master don't fail
+        # before the serial port is opened.
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self._device = os.ttyname(self._slave)
+
+    def startService(self):
+        from twisted.internet import reactor
+        service.Service.startService(self)
+        self._openPty()
+        self.protocol = SimulatedReceiver(**self._kwargs)
+        # The reactor tracks readers and writers by file descriptor, so the
+        # two halves of the transport can't share one.
+        self._master_out = os.dup(self._master)
+        self._transport = stdio.StandardIO(
+                self.protocol, stdin=self._master, stdout=self._master_out,
+                reactor=reactor)
+        log.msg('Simulated receiver on {}'.format(self._device))
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._transport is not None:
+            # Disconnect now, rather than once the output is flushed, so the
+            # descriptors are out of the reactor before they're closed.
+            if not self._transport.disconnected:
+                self._transport.connectionLost(
+                        failure.Failure(main.CONNECTION_DONE))
+            self._transport = None
+        for fd in (self._master_out, self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._master_out = self._slave = None
@@ -0,0 +1,274 @@
+"""Known state of an ISCP receiver."""
+
+import collections
+import errno
+import json
+import os
+
+from twisted.internet import task
+from twisted.python import log
+
+from . import translate
+
+__author__ = 'blaedd@gmail.com'
+
+# Commands the receiver reports on its own whenever they change, so once
+# seen on a connection they stay current for as long as it lasts.
+UNSOLICITED_CODES = frozenset([
+    'PWR', 'MVL', 'AMT', 'SLI', 'LMD', 'TUN', 'PRS',
+    'ZPW', 'ZVL', 'ZMT', 'SLZ',
+])
+
+DEFAULT_TTL = 30
+
+# Seconds between state snapshots.
+DEFAULT_SNAPSHOT_INTERVAL = 60
+
+SNAPSHOT_VERSION = 1
+
+
+class ReceiverState(object):
+    """Last known arguments of each ISCP command, as reported by the receiver.
+
+    This is used to answer queries without going out to the receiver. A
+    command's value is considered fresh if it was reported within the last
+    `ttl` seconds, or if it is one the receiver reports unsolicited and was
+    seen since the last (re)connect.
+
+    Attributes:
+        ttl (float): seconds a reported value stays fresh.
+        unsolicited (set): ISCP commands that the receiver keeps current.
+        hits (collections.Counter): queries answered locally, by command.
+        misses (collections.Counter): queries passed to the receiver, by
+            command.
+        restored (set): commands whose value was restored from a snapshot,
+            and hasn't been reported by the receiver since.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, unsolicited=UNSOLICITED_CODES,
+                 clock=None):
+        """
+
+        Args:
+            ttl (float): seconds a reported value stays fresh.
+            unsolicited (set): ISCP commands that the receiver keeps current.
+            clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                defaults to the reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.ttl = ttl
+        self.unsolicited = unsolicited
+        self.clock = clock
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self._values = {}
+        self._updated = {}
+        self._live = set()
+        self.restored = set()
+
+    def __contains__(self, code):
+        return code in self._values
+
+    def __getitem__(self, code):
+        return self._values[code]
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, code, default=None):
+        """Return the last known arguments for a command, fresh or not.
+
+        Args:
+            code (str): three character ISCP command.
+            default: returned if the command has never been reported.
+        """
+        return self._values.get(code, default)
+
+    def items(self):
+        """Return (code, arguments) pairs for all known commands."""
+        return self._values.items()
+
+    def update(self, code, args):
+        """Record a value reported by the receiver.
+
+        Args:
+            code (str): three character ISCP command.
+            args (str): the reported arguments.
+        """
+        self._values[code] = args
+        self._updated[code] = self.clock.seconds()
+        self.restored.discard(code)
+        if code in self.unsolicited:
+            self._live.add(code)
+
+    def snapshot(self):
+        """Return the known values, as a dict of command to arguments."""
+        return dict(self._values)
+
+    def restore(self, values):
+        """Load values from a snapshot, eg. from before a restart.
+
+        Restored values are fresh for `ttl` seconds, so queries can be
+        answered straight away, but should be revalidated with the receiver.
+        Values the receiver has already reported are kept.
+
+        Args:
+            values (dict): ISCP command to arguments.
+        """
+        now = self.clock.seconds()
+        for code, args in values.iteritems():
+            if code in self._values:
+                continue
+            self._values[code] = args
+            self._updated[code] = now
+            self.restored.add(code)
+
+    def invalidate(self, code):
+        """Mark a command's value as stale, eg. because it's being changed.
+
+        Args:
+            code (str): three character ISCP command.
+        """
+        self._live.discard(code)
+        self._updated.pop(code, None)
+
+    def disconnected(self):
+        """The receiver went away, nothing it reported can be trusted now."""
+        self._live.clear()
+        self._updated.clear()
+
+    def fresh(self, code):
+        """Return the arguments for a command if they are known to be current.
+
+        Args:
+            code (str): three character ISCP command.
+
+        Returns:
+            str: the arguments, or None if unknown or stale.
+        """
+        if code in self._live:
+            return self._values[code]
+        updated = self._updated.get(code)
+        if updated is not None and self.clock.seconds() - updated <= self.ttl:
+            return self._values[code]
+        return None
+
+    def answer(self, code):
+        """Answer a query for a command, recording the hit or miss.
+
+        Args:
+            code (str): three character ISCP command.
+
+        Returns:
+            str: the arguments, or None if the receiver needs to be asked.
+        """
+        args = self.fresh(code)
+        if args is None:
+            self.misses[code] += 1
+        else:
+            self.hits[code] += 1
+        return args
+
+
+class StateSnapshot(object):
+    """Periodically saves a `ReceiverState` to disk, and loads it back.
+
+    Snapshots are small JSON files, written to a temporary file and then
+    renamed over the old one so a crash never leaves a partial snapshot.
+    """
+
+    def __init__(self, receiver_state, path,
+                 interval=DEFAULT_SNAPSHOT_INTERVAL, clock=None,
+                 decoder=None):
+        """
+
+        Args:
+            receiver_state (ReceiverState): state to save and restore.
+            path (str): file to save the snapshot in.
+            interval (float): seconds between snapshots.
+            clock (:twisted:`twisted.internet.interfaces.IReactorTime`):
+                defaults to the reactor.
+            decoder (translate.ResponseDecoder): used to drop commands that
+                are no longer known, defaults to the shared decoder.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if decoder is None:
+            decoder = translate.DECODER
+        self.receiver_state = receiver_state
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.decoder = decoder
+        self._loop = None
+
+    def load(self):
+        """Restore the receiver state from the snapshot, if there is one.
+
+        Returns:
+            int: the number of values restored.
+        """
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                log.msg('Could not read state snapshot {}: {}'.format(
+                        self.path, e))
+            return 0
+        except ValueError, e:
+            log.msg('Ignoring corrupt state snapshot {}: {}'.format(
+                    self.path, e))
+            return 0
+        if not isinstance(snapshot, dict):
+            log.msg('Ignoring malformed state snapshot {}'.format(self.path))
+            return 0
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return 0
+        saved = snapshot.get('values', {})
+        if not isinstance(saved, dict):
+            log.msg('Ignoring malformed state snapshot {}'.format(self.path))
+            return 0
+        values = {}
+        for code, args in saved.iteritems():
+            try:
+                if (len(code) == 3 and isinstance(args, basestring) and
+                        code in self.decoder):
+                    values[str(code)] = str(args)
+                    continue
+            except UnicodeError:
+                pass
+            log.msg('Ignoring invalid value in state snapshot {}: {!r}={!r}'
+                    .format(self.path, code, args))
+        self.receiver_state.restore(values)
+        return len(values)
+
+    def save(self):
+        """Write a snapshot of the receiver state."""
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'saved': self.clock.seconds(),
+                    'values': self.receiver_state.snapshot()}
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(snapshot, f, separators=(',', ':'), sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            log.msg('Could not save state snapshot {}: {}'.format(
+                    self.path, e))
+
+    def start(self):
+        """Start saving snapshots every `interval` seconds."""
+        if self._loop is None:
+            self._loop = task.LoopingCall(self.save)
+            self._loop.clock = self.clock
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        """Stop saving snapshots periodically, and save a final one."""
+        if self._loop is not None:
+            if self._loop.running:
+                self._loop.stop()
+            self._loop = None
+        self.save()
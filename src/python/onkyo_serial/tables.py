@@ -0,0 +1,211 @@
+"""Precompiled onkyo-eiscp command tables.
+
+Importing the onkyo-eiscp command module builds several thousand nested
+dicts, which is a noticeable part of the bridge's startup time. The parts
+of those tables the bridge needs are compiled once into plain dicts and
+tuples, and cached with :py:mod:`marshal`, which loads far faster.
+
+The cache lives in $XDG_CACHE_HOME/onkyo_serial, and is keyed on the
+onkyo-eiscp command module and the Python version, so it is rebuilt when
+either changes. It can be built ahead of time (eg. when building an
+appliance image) with::
+
+    python -m onkyo_serial.tables
+
+Nothing is loaded until :py:func:`load` is first called, which the
+translator and decoder in :py:mod:`onkyo_serial.translate` do on their
+first lookup.
+"""
+
+import hashlib
+import imp
+import marshal
+import os
+import sys
+
+from twisted.python import log
+
+__author__ = 'blaedd@gmail.com'
+
+# Bump when the layout of the compiled tables changes.
+FORMAT_VERSION = 2
+
+_tables = None
+
+
+def _normalize(command):
+    """Same as `eiscp.core.normalize_command`."""
+    return command.lower().replace('_', ' ').replace('-', ' ')
+
+
+def _range(values):
+    """Return (first, last, step) for a non-empty xrange."""
+    step = values[1] - values[0] if len(values) > 1 else 1
+    return values[0], values[-1], step
+
+
+def compileTables():
+    """Compile the onkyo-eiscp tables into plain, marshallable data.
+
+    Returns:
+        dict: with the keys
+
+            zone_mappings: zone aliases, to zones.
+            command_mappings: by zone, command names to ISCP commands.
+            codes: by zone, the ISCP commands in it.
+            value_mappings: by zone and ISCP command, a tuple of
+                (argument aliases to ISCP arguments, level ranges as
+                (first, last, step) tuples).
+            decoder: by ISCP command, (name, {ISCP argument: (name,
+                value, normalized)}) from the first zone that has it.
+            ranges: by ISCP command, the (low, high) levels it accepts,
+                for commands with non-negative level ranges.
+    """
+    from eiscp import commands
+
+    value_mappings = {}
+    for zone, zone_values in commands.VALUE_MAPPINGS.iteritems():
+        compiled = value_mappings[zone] = {}
+        for code, values in zone_values.iteritems():
+            aliases = {}
+            level_ranges = []
+            for arg, value in values.iteritems():
+                if isinstance(arg, xrange):
+                    if len(arg):
+                        level_ranges.append(_range(arg))
+                else:
+                    aliases[arg] = value
+            compiled[code] = (aliases, tuple(sorted(level_ranges)))
+
+    decoder = {}
+    ranges = {}
+    for zone_cmds in commands.COMMANDS.itervalues():
+        for code, info in zone_cmds.iteritems():
+            if code in decoder:
+                continue
+            name = info['name']
+            cmd_name = name[0] if isinstance(name, tuple) else name
+            values = {}
+            lows, highs = [], []
+            for args, value in info['values'].iteritems():
+                if isinstance(args, basestring):
+                    values[args] = (name, value['name'], '{}={}'.format(
+                            _normalize(cmd_name), value['name']))
+                elif isinstance(args, tuple) and len(args) == 2:
+                    lows.append(args[0])
+                    highs.append(args[1])
+            decoder[code] = (name, values)
+            if lows and min(lows) >= 0:
+                ranges[code] = (min(lows), max(highs))
+
+    return {
+        'format': FORMAT_VERSION,
+        'zone_mappings': dict(commands.ZONE_MAPPINGS),
+        'command_mappings': dict(
+                (zone, dict(mappings))
+                for zone, mappings in commands.COMMAND_MAPPINGS.iteritems()),
+        'codes': dict((zone, frozenset(zone_cmds))
+                      for zone, zone_cmds in commands.COMMANDS.iteritems()),
+        'value_mappings': value_mappings,
+        'decoder': decoder,
+        'ranges': ranges,
+    }
+
+
+def _source():
+    """Find the onkyo-eiscp command module, without importing it."""
+    eiscp_path = imp.find_module('eiscp')[1]
+    for name in ('commands.py', 'commands.pyc'):
+        path = os.path.join(eiscp_path, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def cachePath():
+    """Return the path of the compiled tables cache, or None.
+
+    The file name is derived from the onkyo-eiscp command module and the
+    Python version, so a stale cache is never used.
+    """
+    try:
+        source = _source()
+    except ImportError:
+        return None
+    if source is None:
+        return None
+    st = os.stat(source)
+    key = hashlib.sha1(repr((
+        FORMAT_VERSION, source, st.st_size, st.st_mtime,
+        sys.version_info[:2], marshal.version))).hexdigest()[:16]
+    from xdg import BaseDirectory
+    cache_dir = os.path.join(BaseDirectory.xdg_cache_home, 'onkyo_serial')
+    return os.path.join(cache_dir, 'eiscp-tables-{}.marshal'.format(key))
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            tables = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(tables, dict) or tables.get('format') != FORMAT_VERSION:
+        return None
+    return tables
+
+
+def _write(path, tables):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp, 'wb') as f:
+            marshal.dump(tables, f)
+        os.rename(tmp, path)
+    except (IOError, OSError), e:
+        log.msg('Could not cache command tables in {}: {}'.format(path, e))
+
+
+def build(path=None):
+    """Compile the tables and write them to the cache.
+
+    Args:
+        path (str): file to write, defaults to `cachePath`.
+
+    Returns:
+        dict: the compiled tables.
+    """
+    tables = compileTables()
+    if path is None:
+        path = cachePath()
+    if path is not None:
+        _write(path, tables)
+    return tables
+
+
+def load():
+    """Return the compiled tables, from the cache if possible.
+
+    The tables are only loaded once per process.
+
+    Returns:
+        dict: see `compileTables`.
+    """
+    global _tables
+    if _tables is None:
+        path = cachePath()
+        tables = _read(path) if path is not None else None
+        if tables is None:
+            tables = build(path)
+        _tables = tables
+    return _tables
+
+
+def start():
+    path = cachePath()
+    build(path)
+    print(path)
+
+
+if __name__ == '__main__':
+    start()
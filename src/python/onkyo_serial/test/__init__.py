@@ -0,0 +1,18 @@
+"""Tests for onkyo_serial.
+
+The suite caches the compiled command tables (see
+:py:mod:`onkyo_serial.tables`) in a temporary directory, rather than the
+real cache directory, including in the subprocesses it starts.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+from xdg import BaseDirectory
+
+_cache_home = tempfile.mkdtemp(prefix='onkyo_serial-test-')
+atexit.register(shutil.rmtree, _cache_home, True)
+os.environ['XDG_CACHE_HOME'] = _cache_home
+BaseDirectory.xdg_cache_home = _cache_home
@@ -0,0 +1,198 @@
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.trial import unittest
+
+from .. import iscp
+
+try:
+    from .. import aio
+    from ..aio import asyncio
+except ImportError:
+    aio = None
+
+
+class FakeTransport(object):
+    """Records what is written to an asyncio transport."""
+
+    def __init__(self, peername=('10.0.0.2', 1234)):
+        self.written = []
+        self.sent = []
+        self.closed = False
+        self.aborted = False
+        self.extra = {'peername': peername}
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writelines(self, data):
+        self.written.extend(data)
+
+    def sendto(self, data, addr=None):
+        self.sent.append((data, addr))
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+    def get_extra_info(self, name, default=None):
+        return self.extra.get(name, default)
+
+    def value(self):
+        return ''.join(self.written)
+
+
+class AsyncioTestCase(unittest.TestCase):
+    if aio is None:
+        skip = 'asyncio (trollius on Python 2) is not installed'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def future(self):
+        return asyncio.Future(loop=self.loop)
+
+
+class LoopClockTestCase(AsyncioTestCase):
+    def setUp(self):
+        AsyncioTestCase.setUp(self)
+        self.clock = aio.LoopClock(self.loop)
+
+    def testCallLater(self):
+        done = self.future()
+        call = self.clock.callLater(0.01, done.set_result, 'called')
+        self.assertTrue(call.active())
+        self.assertEqual('called', self.loop.run_until_complete(done))
+        self.assertFalse(call.active())
+        self.assertRaises(error.AlreadyCalled, call.cancel)
+
+    def testCancel(self):
+        cancelled = self.clock.callLater(0.01, self.fail, 'called')
+        cancelled.cancel()
+        self.assertFalse(cancelled.active())
+        self.assertRaises(error.AlreadyCancelled, cancelled.cancel)
+        done = self.future()
+        self.clock.callLater(0.02, done.set_result, None)
+        self.loop.run_until_complete(done)
+
+    def testToFuture(self):
+        d = defer.Deferred()
+        future = aio.toFuture(d, self.loop)
+        d.callback('result')
+        self.assertEqual('result', self.loop.run_until_complete(future))
+
+    def testToFutureCancel(self):
+        d = defer.Deferred()
+        future = aio.toFuture(d, self.loop)
+        future.cancel()
+        # Done callbacks run on the next iteration of the loop.
+        done = self.future()
+        self.loop.call_soon(done.set_result, None)
+        self.loop.run_until_complete(done)
+        self.assertTrue(d.called)
+        d.addErrback(lambda f: f.trap(defer.CancelledError))
+
+
+class ISCPProtocolTestCase(AsyncioTestCase):
+    def setUp(self):
+        AsyncioTestCase.setUp(self)
+        self.device = aio.ISCPProtocol(loop=self.loop, gap=0)
+        self.tr = FakeTransport(peername=None)
+        self.device.connection_made(self.tr)
+
+    def testConnect(self):
+        self.assertEqual('!1PWRQSTN\n', self.tr.value())
+
+    def testCommandWait(self):
+        future = self.device.command('master-volume=query', wait=True)
+        self.device.data_received('!1MVL20\x1a')
+        resp = self.loop.run_until_complete(future)
+        self.assertEqual('MVL20', resp)
+        self.assertEqual('master volume=20', resp.normalized)
+
+    def testCommand(self):
+        future = self.device.command('system-power=on')
+        self.assertIsNone(self.loop.run_until_complete(future))
+
+    def testCommandInvalid(self):
+        self.assertRaises(ValueError, self.loop.run_until_complete,
+                          self.device.command('bogus'))
+
+    def testCommandTimeout(self):
+        future = self.device.command('master-volume=query', wait=True,
+                                     timeout=0.01)
+        self.assertRaises(error.TimeoutError, self.loop.run_until_complete,
+                          future)
+
+    def testConnectionLost(self):
+        future = self.device.command('master-volume=query', wait=True)
+        self.device.connection_lost(None)
+        self.assertRaises(error.ConnectionLost, self.loop.run_until_complete,
+                          future)
+
+    def testCallbacks(self):
+        responses = []
+        self.device.add_cb(self, responses.append, codes=['MVL'])
+        self.device.data_received('!1PWR01\x1a!1MVL20\x1a')
+        self.assertEqual(['MVL20'], responses)
+        self.device.remove_cb(self)
+        self.device.data_received('!1MVL21\x1a')
+        self.assertEqual(['MVL20'], responses)
+
+
+class ServerTestCase(AsyncioTestCase):
+    def setUp(self):
+        AsyncioTestCase.setUp(self)
+        self.device = aio.ISCPProtocol(loop=self.loop, gap=0)
+        self.device.connection_made(FakeTransport(peername=None))
+
+    def testeISCP(self):
+        proto = aio.eISCPServer(self.device, loop=self.loop)()
+        tr = FakeTransport()
+        proto.connection_made(tr)
+        self.device.data_received('!1PWR01\x1a')
+        self.assertEqual(iscp.command_to_packet('PWR01'), tr.value())
+
+    def testeISCPPaused(self):
+        proto = aio.eISCPServer(self.device, loop=self.loop)()
+        tr = FakeTransport()
+        proto.connection_made(tr)
+        proto.pause_writing()
+        self.device.data_received('!1MVL20\x1a!1MVL21\x1a')
+        self.assertEqual('', tr.value())
+        proto.resume_writing()
+        self.assertEqual(iscp.command_to_packet('MVL21'), tr.value())
+
+    def testCommandPort(self):
+        proto = aio.CommandServer(self.device, loop=self.loop)()
+        tr = FakeTransport()
+        proto.connection_made(tr)
+        proto.data_received('bogus\r\n')
+        self.device.data_received('!1PWR01\x1a')
+        self.assertEqual('Cannot convert ISCP message to command: bogus\r\n'
+                         'system power=on\r\n', tr.value())
+        proto.connection_lost(None)
+        self.device.data_received('!1PWR00\x1a')
+        self.assertNotIn('system power=standby', tr.value())
+
+    def testDiscovery(self):
+        proto = aio.eISCPDiscoveryProtocol(60128, loop=self.loop)
+        # Rate limited on the loop's time, not the reactor's.
+        self.assertIsInstance(proto.protocol.clock, aio.LoopClock)
+        self.assertIs(self.loop, proto.protocol.clock.loop)
+        tr = FakeTransport()
+        proto.connection_made(tr)
+        mac = proto.protocol.identities[0].mac
+        message = '!xECNQSTN\r'
+        proto.datagram_received(
+                iscp.eISCPPacketHeader.pack(
+                        'ISCP', iscp.eISCPPacketHeader.size, len(message), 1) +
+                message, ('10.0.0.3', 60128))
+        self.assertEqual(
+                [(iscp.command_to_packet(
+                        'ECNTX-NR609/60128/XX/{}'.format(mac)),
+                  ('10.0.0.3', 60128))], tr.sent)
+        proto.connection_lost(None)
+        self.assertIsNone(proto.protocol.transport)
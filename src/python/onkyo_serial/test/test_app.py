@@ -0,0 +1,67 @@
+import os
+
+from .. import app
+
+import mock
+from twisted.python import usage
+from twisted.trial import unittest
+
+LIRCRC = """
+begin
+    prog = onkyo_serial
+    button = KEY_POWER
+    config = system-power=on
+end
+"""
+
+
+class RunOptionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.home = self.mktemp()
+        os.mkdir(self.home)
+        patcher = mock.patch.dict(os.environ, {'HOME': self.home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def parse(self, *args):
+        options = app.RunOptions()
+        options.parseOptions(list(args))
+        return options
+
+    def testDefaultLircrc(self):
+        path = os.path.join(self.home, '.lircrc')
+        with open(path, 'w') as f:
+            f.write(LIRCRC)
+        options = self.parse('-l', 'lircd')
+        self.assertEqual(path, options['lirc_config'])
+        self.assertEqual('!1PWR01',
+                         options['keymap'].button('RC-690M', 'KEY_POWER'))
+
+    def testNoLircrc(self):
+        e = self.assertRaises(usage.UsageError, self.parse, '-l', 'lircd')
+        self.assertIn('.lircrc', e.args[0])
+
+    def testNoLirc(self):
+        options = self.parse('-l', 'command')
+        self.assertIsNone(options['keymap'])
+
+    def testLircRepeat(self):
+        options = self.parse('-l', 'command', '--lirc_repeat', '0.5')
+        self.assertEqual(0.5, options['lirc_repeat'])
+        for value in ('-1', 'fast', 'nan'):
+            self.assertRaises(usage.UsageError, self.parse,
+                              '-l', 'command', '--lirc_repeat', value)
+
+    def testNumbers(self):
+        options = self.parse('-l', 'command', '--command_gap', '0.1',
+                             '--state_ttl', '5', '--metrics_port', '9100')
+        self.assertEqual(0.1, options['command_gap'])
+        self.assertEqual(5.0, options['state_ttl'])
+        self.assertEqual(9100, options['metrics_port'])
+        self.assertEqual(60128, options['eiscp'])
+        for name, value in (('--command_gap', 'slow'), ('--command_gap', '-1'),
+                            ('--state_ttl', 'inf'), ('--metrics_port', '1.5'),
+                            ('--metrics_port', '70000'), ('--eiscp', 'x')):
+            e = self.assertRaises(usage.UsageError, self.parse,
+                                  '-l', 'command', name, value)
+            self.assertIn(value, e.args[0])
@@ -0,0 +1,35 @@
+import json
+
+from .. import benchmark
+
+from twisted.trial import unittest
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def testFanout(self):
+        results = benchmark.benchFanout(1, 1, clients=(1, 2))
+        self.assertEqual(4, len(results))
+        self.assertEqual([1, 1, 2, 2], [r['clients'] for r in results])
+
+    def testRun(self):
+        results = benchmark.run(number=1, repeat=1)
+        names = set(r['name'] for r in results['results'])
+        self.assertIn('parse_fragmented', names)
+        self.assertIn('translate', names)
+        json.dumps(results)
+
+    def testDispatch(self):
+        results = benchmark.benchDispatch(1, 1, clients=(1, 2))
+        self.assertEqual(['dispatch_filtered'] * 2,
+                         [r['name'] for r in results])
+
+    def testDiscovery(self):
+        results = benchmark.benchDiscovery(1, 1, sources=2)
+        self.assertEqual(['discovery_answered', 'discovery_limited'],
+                         [r['name'] for r in results])
+
+    def testStartup(self):
+        results = benchmark.benchStartup(1, 1)
+        self.assertEqual(['startup_import', 'startup_first_translate'],
+                         [r['name'] for r in results])
+        self.assertFalse(results[1]['eiscp_loaded'])
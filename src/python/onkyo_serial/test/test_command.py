@@ -1,10 +1,120 @@
 from .. import command
+from .. import iscp
 
 import mock
 from twisted.trial import unittest
 from twisted.internet import protocol
+from twisted.internet import task
 from twisted.test import proto_helpers
 
 
 class CommandPortTestCase(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.onkyo = iscp.ISCP()
+        self.clock = self.onkyo.clock = task.Clock()
+        self.onkyo_tr = proto_helpers.StringTransport()
+        self.onkyo.makeConnection(self.onkyo_tr)
+        self.onkyo_tr.clear()
+        factory = command.CommandPortFactory(
+                self.onkyo, macros={'bedtime': ('!1MVL0A', '!1DIM03')})
+        self.proto = factory.buildProtocol(None)
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+        self.tr.clear()
+
+    def testLineReceived(self):
+        self.proto.lineReceived('system-power=on')
+        self.assertEqual('!1PWR01' + self.onkyo.send_delimiter,
+                         self.onkyo_tr.value())
+
+    def testInvalidCommand(self):
+        self.proto.lineReceived('bogus')
+        self.assertEqual('', self.onkyo_tr.value())
+        self.assertTrue(self.tr.value())
+
+    def testResponse(self):
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.assertEqual('system power=on' + self.proto.delimiter,
+                         self.tr.value())
+
+    def testSubscribe(self):
+        self.proto.lineReceived('subscribe mvl')
+        self.tr.clear()
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.assertEqual('', self.tr.value())
+        self.onkyo.lineReceived('!1MVL20\x1a')
+        self.assertIn('master volume', self.tr.value())
+        self.proto.lineReceived('subscribe all')
+        self.tr.clear()
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.assertTrue(self.tr.value())
+
+    def testBatch(self):
+        self.proto.lineReceived('system-power=on; master-volume=40')
+        self.assertEqual('!1PWR01\n!1MVL28\n', self.onkyo_tr.value())
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.onkyo.lineReceived('!1MVL28\x1a')
+        lines = self.tr.value().splitlines()
+        self.assertEqual('OK system power=on; master volume=28', lines[-1])
+
+    def testBatchInvalid(self):
+        self.proto.lineReceived('system-power=on; bogus')
+        self.assertEqual('', self.onkyo_tr.value())
+        self.assertIn('bogus', self.tr.value())
+
+    def testBatchTimeout(self):
+        self.proto.lineReceived('system-power=on; master-volume=40')
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.clock.advance(iscp.DEFAULT_TIMEOUT)
+        lines = self.tr.value().splitlines()
+        self.assertTrue(lines[-1].startswith('FAILED system power=on; '))
+        self.assertIn('No response to !1MVL28', lines[-1])
+
+    def testMacro(self):
+        self.proto.lineReceived('macro Bedtime')
+        self.assertEqual('!1MVL0A\n!1DIM03\n', self.onkyo_tr.value())
+        self.onkyo.lineReceived('!1MVL0A\x1a')
+        self.onkyo.lineReceived('!1DIM03\x1a')
+        self.assertEqual('OK master volume=0A; dimmer level=shut-off',
+                         self.tr.value().splitlines()[-1])
+
+    def testUnknownMacro(self):
+        self.proto.lineReceived('macro bogus')
+        self.assertEqual('', self.onkyo_tr.value())
+        self.assertEqual('Unknown macro: bogus\r\n', self.tr.value())
+
+    def testRamp(self):
+        self.onkyo.lineReceived('!1MVL14\x1a')
+        self.tr.clear()
+        self.proto.lineReceived('ramp 40 0.4 ease-out')
+        self.clock.pump([0.2, 0.2])
+        self.assertEqual('!1MVL23\n!1MVL28\n', self.onkyo_tr.value())
+        self.assertEqual('OK master volume=28\r\n', self.tr.value())
+
+    def testRampSuperseded(self):
+        self.onkyo.lineReceived('!1MVL14\x1a')
+        self.tr.clear()
+        self.proto.lineReceived('ramp 40')
+        self.proto.lineReceived('ramp 20 0')
+        self.assertEqual('FAILED Superseded by a newer ramp\r\n'
+                         'OK master volume=14\r\n', self.tr.value())
+
+    def testRampInvalid(self):
+        self.proto.lineReceived('ramp loud')
+        self.proto.lineReceived('ramp 40 1 bogus')
+        self.assertEqual('', self.onkyo_tr.value())
+        self.assertEqual(2, len(self.tr.value().splitlines()))
+
+    def testRepeat(self):
+        self.proto.lineReceived('repeat 3 master-volume=level-up')
+        self.assertEqual('!1MVLUP\n' * 3, self.onkyo_tr.value())
+
+    def testRepeatInvalid(self):
+        self.proto.lineReceived('repeat 3')
+        self.proto.lineReceived('repeat 0 master-volume=level-up')
+        self.proto.lineReceived(
+                'repeat {} master-volume=level-up'.format(
+                        command.MAX_REPEAT + 1))
+        self.proto.lineReceived('repeat 2 bogus')
+        self.assertEqual('', self.onkyo_tr.value())
+        self.assertEqual(4, len(self.tr.value().splitlines()))
@@ -3,7 +3,9 @@ from eiscp import core
 from .. import iscp
 import mock
 from twisted.trial import unittest
+from twisted.internet import error
 from twisted.internet import protocol
+from twisted.internet import task
 from twisted.test import proto_helpers
 
 
@@ -12,6 +14,7 @@ class ISCPTestCase(unittest.TestCase):
         factory = protocol.Factory()
         factory.protocol = iscp.ISCP
         self.proto = factory.buildProtocol('/dev/ttyUSB0')
+        self.proto.clock = task.Clock()
         self.tr = proto_helpers.StringTransport()
         self.proto.makeConnection(self.tr)
         self.tr.clear()
@@ -46,6 +49,107 @@ class ISCPTestCase(unittest.TestCase):
         self.proto.lineReceived('!1PWR00\x1a')
         self.assertFalse(cb.called)
 
+    def testCallbackCodes(self):
+        volume, zone2, everything = mock.Mock(), mock.Mock(), mock.Mock()
+        self.proto.add_cb('volume', volume, codes=['MVL', 'AMT'])
+        self.proto.add_cb('zone2', zone2, codes='Z')
+        self.proto.add_cb('everything', everything)
+        for line in ('!1PWR01', '!1MVL20', '!1ZVL10', '!1AMT00'):
+            self.proto.lineReceived(line)
+        self.assertEqual([mock.call('MVL20'), mock.call('AMT00')],
+                         volume.call_args_list)
+        self.assertEqual([mock.call('ZVL10')], zone2.call_args_list)
+        self.assertEqual(4, everything.call_count)
+
+        self.proto.add_cb('volume', volume)
+        self.proto.remove_cb('zone2')
+        self.assertEqual({}, self.proto._prefix_cb)
+        self.proto.lineReceived('!1ZVL11')
+        self.assertEqual(3, volume.call_count)
+        self.assertEqual(1, zone2.call_count)
+
+    def testQueryAnswered(self):
+        self.proto.lineReceived('!1PWR01\x1a')
+        reply = mock.MagicMock()
+        self.proto.command('system-power=query', reply=reply)
+        self.assertEqual(mock.call('PWR01'), reply.call_args)
+        self.assertEqual('', self.tr.value())
+
+    def testRevalidateRestored(self):
+        proto = iscp.ISCP()
+        proto.receiver_state.restore({'PWR': '01', 'MVL': '20', 'SLI': '10'})
+        tr = proto_helpers.StringTransport()
+        proto.makeConnection(tr)
+        self.assertEqual(['!1PWRQSTN', '!1MVLQSTN', '!1SLIQSTN'],
+                         tr.value().split(proto.send_delimiter)[:-1])
+        reply = mock.MagicMock()
+        proto.command('master-volume=query', reply=reply)
+        self.assertEqual(mock.call('MVL20'), reply.call_args)
+
+    def testRevalidateUnknown(self):
+        clientFactory = iscp.ISCPClientFactory()
+        clientFactory.clock = task.Clock()
+        connected = mock.Mock()
+        clientFactory.addConnectionObserver(connected, mock.Mock())
+        proto = clientFactory.buildProtocol(None)
+        proto.receiver_state.restore({'ZZZ': '00', 'MVL': '20'})
+        tr = proto_helpers.StringTransport()
+        proto.makeConnection(tr)
+        self.assertEqual(['!1PWRQSTN', '!1MVLQSTN'],
+                         tr.value().split(proto.send_delimiter)[:-1])
+        self.assertIsNone(proto.receiver_state.fresh('ZZZ'))
+        connected.assert_called_once_with(proto)
+        clientFactory.stopTrying()
+
+    def testQueryStale(self):
+        reply = mock.MagicMock()
+        self.proto.command('system-power=query', reply=reply)
+        self.assertFalse(reply.called)
+        self.assertEqual('!1PWRQSTN' + self.proto.send_delimiter,
+                         self.tr.value())
+
+    def testQueryAfterSet(self):
+        self.proto.lineReceived('!1PWR01\x1a')
+        self.proto.command('system-power=standby')
+        self.tr.clear()
+        reply = mock.MagicMock()
+        self.proto.command('system-power=query', reply=reply)
+        self.assertFalse(reply.called)
+
+    def testWait(self):
+        d = self.proto.command('system-power=on', wait=True)
+        self.assertNoResult(d)
+        self.proto.lineReceived('!1MVL20\x1a')
+        self.assertNoResult(d)
+        self.proto.lineReceived('!1PWR01\x1a')
+        self.assertEqual('PWR01', self.successResultOf(d))
+
+    def testWaitAnswered(self):
+        self.proto.lineReceived('!1PWR01\x1a')
+        d = self.proto.command('system-power=query', wait=True)
+        self.assertEqual('PWR01', self.successResultOf(d))
+
+    def testWaitTimeout(self):
+        d = self.proto.command('system-power=on', wait=True, timeout=1,
+                               retries=1)
+        self.proto.clock.advance(1)
+        self.assertNoResult(d)
+        self.assertEqual('!1PWR01\n!1PWR01\n', self.tr.value())
+        self.proto.clock.advance(1)
+        self.failureResultOf(d, error.TimeoutError)
+
+    def testWaitDefaultTimeout(self):
+        d = self.proto.command('system-power=on', wait=True, timeout=None)
+        self.proto.clock.advance(iscp.DEFAULT_TIMEOUT - 0.1)
+        self.assertNoResult(d)
+        self.proto.clock.advance(0.1)
+        self.failureResultOf(d, error.TimeoutError)
+
+    def testWaitConnectionLost(self):
+        d = self.proto.command('system-power=on', wait=True)
+        self.proto.connectionLost(None)
+        self.failureResultOf(d, error.ConnectionLost)
+
     def testISCPMixin(self):
         packet = str(core.eISCPPacket('!1PWR01\x1a'))
         mixin = iscp.eISCPMixin()
@@ -55,6 +159,25 @@ class ISCPTestCase(unittest.TestCase):
         self.assertEquals(mixin.doCmd.call_args,
                           mock.call('!1PWR01'))
 
+    def testISCPMixinFragmented(self):
+        packet = str(core.eISCPPacket('!1PWR01\x1a'))
+        mixin = iscp.eISCPMixin()
+        mixin.doCmd = mock.MagicMock()
+        for c in packet * 2:
+            mixin._processData(c)
+        self.assertEquals([mock.call('!1PWR01')] * 2,
+                          mixin.doCmd.call_args_list)
+
+    def testISCPMixinGarbage(self):
+        packet = str(core.eISCPPacket('!1PWR01\x1a'))
+        mixin = iscp.eISCPMixin()
+        mixin.doCmd = mock.MagicMock()
+        mixin._processData('IS\x00ISCPgarbage' + packet[:5])
+        mixin._processData(packet[5:] + 'junk' + packet)
+        self.assertEquals([mock.call('!1PWR01')] * 2,
+                          mixin.doCmd.call_args_list)
+        self.assertEqual(0, len(mixin._buffer))
+
 
 class MockProtocol(object):
     """Mock protocol."""
@@ -76,6 +199,262 @@ class ISCPClientFactoryTestCase(unittest.TestCase):
         self.assertIs(clientFactory, p.factory)
         self.assertTrue(resetDelay.called)
 
+    def testWaitNotConnected(self):
+        clientFactory = iscp.ISCPClientFactory()
+        d = clientFactory.command('system-power=on', wait=True)
+        self.failureResultOf(d, error.ConnectionClosed)
+
+    def testRampNotConnected(self):
+        clientFactory = iscp.ISCPClientFactory()
+        d = clientFactory.ramp(40)
+        self.failureResultOf(d, error.ConnectionClosed)
+
     def testclientConnectionLost(self):
         clientFactory = iscp.ISCPClientFactory()
         p = clientFactory.buildProtocol(None)
+
+    def testConnectionObservers(self):
+        clientFactory = iscp.ISCPClientFactory()
+        connected, disconnected = mock.Mock(), mock.Mock()
+        clientFactory.addConnectionObserver(connected, disconnected)
+        d = clientFactory.whenConnected()
+        p = clientFactory.buildProtocol(None)
+        self.assertNoResult(d)
+        p.makeConnection(proto_helpers.StringTransport())
+        self.assertIs(p, self.successResultOf(d))
+        connected.assert_called_once_with(p)
+        self.assertTrue(clientFactory.connected)
+        clientFactory.clientConnectionLost(mock.Mock(), error.ConnectionLost())
+        self.assertEqual(1, disconnected.call_count)
+        self.assertFalse(clientFactory.connected)
+        clientFactory.stopTrying()
+
+    def testOfflineQueue(self):
+        clientFactory = iscp.ISCPClientFactory()
+        clientFactory.clock = task.Clock()
+        clientFactory.offline_maxsize = 2
+        clientFactory.command('PWR01')
+        clientFactory.clock.advance(5)
+        clientFactory.command('MVLUP')
+        clientFactory.command('MVLDOWN')
+        clientFactory.command('MVLUP')
+        self.assertEqual(['!1MVLDOWN', '!1MVLUP'],
+                         [v[0] for v in clientFactory._offline.values()])
+        p = clientFactory.buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        p.makeConnection(tr)
+        self.assertEqual(['!1PWRQSTN', '!1MVLDOWN', '!1MVLUP'],
+                         tr.value().split(p.send_delimiter)[:-1])
+        self.assertEqual(0, len(clientFactory._offline))
+
+    def testOfflineDuplicates(self):
+        clientFactory = iscp.ISCPClientFactory()
+        clientFactory.clock = task.Clock()
+        for _ in range(3):
+            clientFactory.command('master-volume=level-up')
+        clientFactory.command('master-volume=40')
+        clientFactory.command('!1MVL28')
+        p = clientFactory.buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        p.makeConnection(tr)
+        self.assertEqual(['!1PWRQSTN'] + ['!1MVLUP'] * 3 + ['!1MVL28'],
+                         tr.value().split(p.send_delimiter)[:-1])
+
+    def testOfflineExpiry(self):
+        clientFactory = iscp.ISCPClientFactory()
+        clientFactory.clock = task.Clock()
+        clientFactory.command('MVLUP')
+        clientFactory.clock.advance(clientFactory.offline_ttl + 1)
+        p = clientFactory.buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        p.makeConnection(tr)
+        self.assertEqual('!1PWRQSTN' + p.send_delimiter, tr.value())
+
+    def testOfflineInvalid(self):
+        clientFactory = iscp.ISCPClientFactory()
+        self.assertRaises(ValueError, clientFactory.command, '!1ZZZ99')
+        self.assertEqual(0, len(clientFactory._offline))
+
+    def testOfflineReplayInvalid(self):
+        clientFactory = iscp.ISCPClientFactory()
+        clientFactory.clock = task.Clock()
+        # Slipped past validation somehow.
+        clientFactory._queue('!1ZZZ99', {})
+        clientFactory.command('system-power=on', reply=mock.Mock())
+        self.assertEqual({}, clientFactory._offline['!1PWR01'][2])
+        connected = mock.Mock()
+        clientFactory.addConnectionObserver(connected, mock.Mock())
+        d = clientFactory.whenConnected()
+        p = clientFactory.buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        p.makeConnection(tr)
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(['!1PWRQSTN', '!1PWR01'],
+                         tr.value().split(p.send_delimiter)[:-1])
+        self.assertIs(p, self.successResultOf(d))
+        connected.assert_called_once_with(p)
+        clientFactory.stopTrying()
+
+    def testCallbacksSurviveReconnect(self):
+        clientFactory = iscp.ISCPClientFactory()
+        cb = mock.Mock()
+        clientFactory.add_cb('mock', cb)
+        clientFactory.buildProtocol(None)
+        clientFactory.clientConnectionLost(mock.Mock(), error.ConnectionLost())
+        clientFactory.stopTrying()
+        p = clientFactory.buildProtocol(None)
+        p.lineReceived('!1PWR01')
+        cb.assert_called_once_with('PWR01')
+
+
+class eISCPFactoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.onkyo = iscp.ISCP()
+        self.onkyo.makeConnection(proto_helpers.StringTransport())
+        self.factory = iscp.eISCPFactory(self.onkyo)
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        proto.makeConnection(tr)
+        return proto, tr
+
+    def testCommandToPacket(self):
+        self.assertEqual(str(core.eISCPPacket('!1PWR01\x1a')),
+                         iscp.command_to_packet('PWR01'))
+
+    def testBroadcast(self):
+        transports = [self.connect()[1] for _ in range(3)]
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        packet = iscp.command_to_packet('PWR01')
+        for tr in transports:
+            self.assertEqual(packet * 2, tr.value())
+        self.assertEqual(1, self.factory.encoder.misses)
+        self.assertEqual(1, self.factory.encoder.hits)
+
+    def testDisconnect(self):
+        proto, tr = self.connect()
+        self.assertIn(self.factory, self.onkyo.cb)
+        proto.connectionLost(None)
+        self.assertNotIn(self.factory, self.onkyo.cb)
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.assertEqual('', tr.value())
+
+    def testSlowClientCoalesce(self):
+        self.factory.max_pending = 2
+        proto, tr = self.connect()
+        self.assertIs(proto, tr.producer)
+        proto.pauseProducing()
+        for line in ('!1MVL20', '!1PWR01', '!1MVL21', '!1AMT00'):
+            self.onkyo.lineReceived(line)
+        self.assertEqual('', tr.value())
+        proto.resumeProducing()
+        self.assertEqual(iscp.command_to_packet('MVL21') +
+                         iscp.command_to_packet('AMT00'), tr.value())
+
+    def testSlowClientDropOldest(self):
+        self.factory.policy = iscp.DROP_OLDEST
+        self.factory.max_pending = 2
+        proto, tr = self.connect()
+        proto.pauseProducing()
+        for line in ('!1MVL20', '!1MVL21', '!1MVL22'):
+            self.onkyo.lineReceived(line)
+        proto.resumeProducing()
+        self.assertEqual(iscp.command_to_packet('MVL21') +
+                         iscp.command_to_packet('MVL22'), tr.value())
+
+    def testSlowClientDisconnect(self):
+        self.factory.policy = iscp.DISCONNECT
+        self.factory.max_pending = 1
+        proto, tr = self.connect()
+        proto.pauseProducing()
+        self.onkyo.lineReceived('!1MVL20')
+        self.assertFalse(tr.disconnecting)
+        self.onkyo.lineReceived('!1MVL21')
+        self.assertTrue(tr.disconnecting)
+
+    def testInvalidPolicy(self):
+        self.assertRaises(ValueError, iscp.eISCPFactory, self.onkyo,
+                          policy='bogus')
+
+
+class eISCPDiscoveryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.discovery = iscp.eISCPDiscovery(None, clock=self.clock)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.discovery.transport = self.tr
+
+    def testIdentities(self):
+        self.assertIsNone(self.discovery.eiscp_port)
+        self.assertIsNone(self.discovery.mac)
+        first = self.discovery.addIdentity(60128)
+        second = self.discovery.addIdentity(60138, model='TX-SR605')
+        self.assertNotEqual(first.mac, second.mac)
+        self.assertEqual(60128, self.discovery.eiscp_port)
+        self.discovery.datagramReceived(
+                str(core.eISCPPacket('!xECNQSTN\r')), ('10.0.0.2', 60128))
+        self.assertEqual(
+                [(iscp.command_to_packet(
+                        'ECNTX-NR609/60128/XX/{}'.format(first.mac)),
+                  ('10.0.0.2', 60128)),
+                 (iscp.command_to_packet(
+                        'ECNTX-SR605/60138/XX/{}'.format(second.mac)),
+                  ('10.0.0.2', 60128))],
+                self.tr.written)
+
+    def query(self, host, message=iscp.DISCOVERY_QUERY):
+        self.discovery.datagramReceived(
+                str(core.eISCPPacket(message)), (host, 60128))
+
+    def testQueryPackets(self):
+        for end in iscp.DISCOVERY_TERMINATORS:
+            self.assertIn(
+                    str(core.eISCPPacket(iscp.DISCOVERY_QUERY + end)),
+                    self.discovery._query_packets)
+
+    def testEiscpQueryFastPath(self):
+        self.discovery.addIdentity(60128)
+        with mock.patch.object(iscp, 'packet_to_command') as parse:
+            # As sent by eiscp.core.eISCP.discover.
+            self.query('10.0.0.2', '!xECNQSTN')
+        self.assertFalse(parse.called)
+        self.assertEqual(1, len(self.tr.written))
+
+    def testParsedQuery(self):
+        identity = self.discovery.addIdentity(60128)
+        self.query('10.0.0.2', '!xECNQSTN\r\n\x1a')
+        self.assertEqual(
+                [(iscp.command_to_packet(
+                        'ECNTX-NR609/60128/XX/{}'.format(identity.mac)),
+                  ('10.0.0.2', 60128))], self.tr.written)
+
+    def testInvalid(self):
+        self.discovery.addIdentity(60128)
+        self.discovery.datagramReceived('garbage', ('10.0.0.2', 60128))
+        self.query('10.0.0.2', '!1PWRQSTN\r')
+        self.assertEqual([], self.tr.written)
+
+    def testRateLimit(self):
+        self.discovery.addIdentity(60128)
+        self.query('10.0.0.2')
+        self.query('10.0.0.2')
+        self.query('10.0.0.3')
+        self.assertEqual(['10.0.0.2', '10.0.0.3'],
+                         [addr[0] for _, addr in self.tr.written])
+        self.clock.advance(iscp.DISCOVERY_INTERVAL)
+        self.query('10.0.0.2')
+        self.assertEqual(3, len(self.tr.written))
+
+    def testManySources(self):
+        self.discovery.addIdentity(60128)
+        with mock.patch.object(iscp, 'MAX_DISCOVERY_SOURCES', 2):
+            self.query('10.0.0.2')
+            self.query('10.0.0.3')
+            self.query('10.0.0.4')
+            self.assertEqual(2, len(self.tr.written))
+            # Once the hosts answered so far go stale, they make room.
+            self.clock.advance(iscp.DISCOVERY_INTERVAL)
+            self.query('10.0.0.4')
+            self.assertEqual(3, len(self.tr.written))
@@ -0,0 +1,183 @@
+import os
+import signal
+
+from .. import keymap
+
+import mock
+from twisted.internet import task
+from twisted.trial import unittest
+
+LIRCRC = """
+# comment
+begin
+    prog = onkyo_serial
+    remote = RC-690M
+    button = KEY_VOLUMEUP
+    config = master-volume=level-up
+end
+
+begin
+    prog = onkyo_serial
+    button = KEY_POWER
+    config = system-power=on; input-selector=dvd
+end
+
+begin
+    prog = onkyo_serial
+    button = KEY_SLEEP
+    config = macro bedtime
+end
+
+begin
+    prog = onkyo_serial
+    button = KEY_VOLUMEDOWN
+    config = master-volume=level-down
+    repeat = 3
+    delay = 2
+end
+
+begin
+    prog = other
+    button = KEY_VOLUMEUP
+    config = bogus
+end
+
+begin night
+    begin
+        prog = onkyo_serial
+        button = KEY_VOLUMEUP
+        config = bogus
+    end
+end night
+"""
+
+
+class ParseTestCase(unittest.TestCase):
+    def write(self, content):
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def testParse(self):
+        entries = keymap.parse(self.write(LIRCRC))
+        self.assertEqual(5, len(entries))
+        self.assertEqual({'prog': 'onkyo_serial', 'remote': 'RC-690M',
+                          'button': 'KEY_VOLUMEUP',
+                          'config': 'master-volume=level-up'}, entries[0])
+
+    def testUnclosed(self):
+        self.assertRaises(ValueError, keymap.parse, self.write('begin\n'))
+        self.assertRaises(ValueError, keymap.parse, self.write('end\n'))
+
+    def testMissing(self):
+        self.assertRaises(ValueError, keymap.parse, self.mktemp())
+
+    def testCompileConfig(self):
+        self.assertEqual('!1MVLUP',
+                         keymap.compileConfig('master-volume=level-up'))
+        self.assertEqual('!1PWR01; !1MVL28',
+                         keymap.compileConfig('system-power=on; !1MVL28'))
+        self.assertEqual('ramp 20', keymap.compileConfig('ramp 20'))
+        self.assertRaises(ValueError, keymap.compileConfig, 'bogus')
+
+
+class KeymapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.write(LIRCRC)
+        self.clock = task.Clock()
+        self.reactor = mock.Mock()
+        self.keymap = keymap.Keymap(self.path, 'onkyo_serial',
+                                    clock=self.clock, reactor=self.reactor)
+
+    def write(self, content, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def testLoad(self):
+        self.assertEqual(4, self.keymap.load())
+        self.assertEqual('!1MVLUP',
+                         self.keymap.lookup('master-volume=level-up'))
+        self.assertEqual('!1PWR01; !1SLI10',
+                         self.keymap.button('RC-690M', 'KEY_POWER'))
+        self.assertEqual('!1MVLUP',
+                         self.keymap.button('RC-690M', 'KEY_VOLUMEUP'))
+        self.assertIsNone(self.keymap.button('other', 'KEY_VOLUMEUP'))
+        self.assertEqual('macro bedtime',
+                         self.keymap.button('other', 'KEY_SLEEP'))
+        self.assertEqual('unknown', self.keymap.lookup('unknown'))
+
+    def testPress(self):
+        self.keymap.load()
+        self.assertEqual('!1PWR01; !1SLI10',
+                         self.keymap.press('RC-690M', 'KEY_POWER', 0))
+        self.assertIsNone(self.keymap.press('RC-690M', 'KEY_POWER', 1))
+        self.assertIsNone(self.keymap.press('RC-690M', 'KEY_DVD', 0))
+        sent = [i for i in xrange(10)
+                if self.keymap.press('RC-690M', 'KEY_VOLUMEDOWN', i)]
+        self.assertEqual([0, 5, 8], sent)
+
+    def testInvalidRepeat(self):
+        self.write(LIRCRC.replace('repeat = 3', 'repeat = often'))
+        self.assertRaises(ValueError, self.keymap.load)
+        self.write(LIRCRC.replace('delay = 2', 'delay = -1'))
+        self.assertRaises(ValueError, self.keymap.load)
+
+    def testLoadInvalid(self):
+        self.write(LIRCRC.replace('input-selector=dvd', 'bogus'))
+        e = self.assertRaises(ValueError, self.keymap.load)
+        self.assertIn('KEY_POWER', e.args[0])
+
+    def testReload(self):
+        self.keymap.load()
+        reloaded = []
+        self.keymap.add_cb(self, reloaded.append)
+        self.write(LIRCRC.replace('level-up', 'level-down'))
+        self.assertTrue(self.keymap.reload())
+        self.assertEqual([self.keymap], reloaded)
+        self.assertEqual('!1MVLDOWN',
+                         self.keymap.button('RC-690M', 'KEY_VOLUMEUP'))
+        self.keymap.remove_cb(self)
+        self.keymap.reload()
+        self.assertEqual(1, len(reloaded))
+
+    def testReloadInvalid(self):
+        self.keymap.load()
+        self.write('begin\n', mtime=1)
+        self.assertFalse(self.keymap.reload())
+        self.assertEqual('!1MVLUP',
+                         self.keymap.button('RC-690M', 'KEY_VOLUMEUP'))
+        self.assertFalse(self.keymap.changed())
+
+    def testWatch(self):
+        self.keymap.load()
+        self.keymap.start(hup=False)
+        self.addCleanup(self.keymap.stop)
+        self.clock.advance(keymap.CHECK_INTERVAL)
+        self.assertEqual('!1MVLUP',
+                         self.keymap.button('RC-690M', 'KEY_VOLUMEUP'))
+        self.write(LIRCRC.replace('level-up', 'level-down'), mtime=1)
+        self.clock.advance(keymap.CHECK_INTERVAL)
+        self.assertEqual('!1MVLDOWN',
+                         self.keymap.button('RC-690M', 'KEY_VOLUMEUP'))
+
+    def testHup(self):
+        previous = signal.getsignal(signal.SIGHUP)
+        self.keymap.start()
+        self.assertEqual(self.keymap._hup, signal.getsignal(signal.SIGHUP))
+        self.keymap.load()
+        self.write(LIRCRC.replace('level-up', 'level-down'))
+        self.keymap._hup(signal.SIGHUP, None)
+        # Not reloaded from the signal handler itself.
+        self.assertEqual('!1MVLUP',
+                         self.keymap.button('RC-690M', 'KEY_VOLUMEUP'))
+        self.reactor.callFromThread.assert_called_once_with(
+                self.keymap.reload)
+        self.reactor.callFromThread.call_args[0][0]()
+        self.assertEqual('!1MVLDOWN',
+                         self.keymap.button('RC-690M', 'KEY_VOLUMEUP'))
+        self.keymap.stop()
+        self.assertEqual(previous, signal.getsignal(signal.SIGHUP))
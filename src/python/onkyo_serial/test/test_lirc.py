@@ -1,3 +1,4 @@
+from .. import keymap
 from .. import lirc
 
 import mock
@@ -7,4 +8,36 @@ from twisted.test import proto_helpers
 
 
 class LircTestCase(unittest.TestCase):
-    pass
+    def testDefaultKeymap(self):
+        path = self.mktemp()
+        lirc.write_default_config(path, 'onkyo_serial', 'RC-690M')
+        default = keymap.Keymap(path, 'onkyo_serial', clock=mock.Mock())
+        self.assertEqual(len(lirc.KEYMAP), default.load())
+
+
+class LircClientServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(lirc, 'pylirc')
+        self.pylirc = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pylirc.init.return_value = 5
+        self.reactor = mock.Mock()
+        factory = protocol.Factory()
+        factory.protocol = protocol.Protocol
+        self.service = lirc.LircClientService(
+                lirc.LircEndPoint(self.reactor, 'onkyo_serial'),
+                lambda: factory)
+
+    def testRestart(self):
+        self.service.startService()
+        self.assertEqual(1, self.pylirc.init.call_count)
+        reader = self.reactor.addReader.call_args[0][0]
+        self.service.stopService()
+        self.assertEqual(1, self.pylirc.exit.call_count)
+        self.reactor.removeReader.assert_called_with(reader)
+        self.assertEqual(-1, reader.fileno())
+        self.service.startService()
+        self.assertEqual(2, self.pylirc.init.call_count)
+        self.assertIsNot(reader, self.reactor.addReader.call_args[0][0])
+        self.service.stopService()
+        self.assertEqual(2, self.pylirc.exit.call_count)
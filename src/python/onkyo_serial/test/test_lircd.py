@@ -0,0 +1,184 @@
+from .. import command
+from .. import iscp
+from .. import keymap
+from .. import lircd
+from .. import repeat
+
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+LIRCRC = """
+begin
+    prog = onkyo_serial
+    remote = RC-690M
+    button = KEY_VOLUMEUP
+    config = master-volume=level-up
+end
+
+begin
+    prog = onkyo_serial
+    button = KEY_POWER
+    config = system-power=on
+end
+
+begin
+    prog = onkyo_serial
+    button = KEY_VOLUMEDOWN
+    config = master-volume=level-down
+    repeat = 2
+    delay = 1
+end
+"""
+
+VOLUME_UP = '000000037c9e0001 00 KEY_VOLUMEUP RC-690M\n'
+POWER = '000000037c9e0002 00 KEY_POWER RC-690M\n'
+
+
+def held(button, count):
+    return ''.join('000000037c9e0003 {:02x} {} RC-690M\n'.format(i, button)
+                   for i in xrange(count))
+
+
+class LircdTestCase(unittest.TestCase):
+    def setUp(self):
+        self.onkyo = iscp.ISCP()
+        self.onkyo.clock = task.Clock()
+        self.onkyo_tr = proto_helpers.StringTransport()
+        self.onkyo.makeConnection(self.onkyo_tr)
+        self.onkyo_tr.clear()
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write(LIRCRC)
+        self.keymap = keymap.Keymap(path, 'onkyo_serial', clock=task.Clock())
+        self.keymap.load()
+
+
+class LircdProtocolTestCase(LircdTestCase):
+    def setUp(self):
+        LircdTestCase.setUp(self)
+        self.factory = lircd.LircdClientFactory(
+                command.CommandPortFactory(self.onkyo), self.keymap)
+        self.proto = self.factory.buildProtocol(None)
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def testButton(self):
+        self.proto.dataReceived(VOLUME_UP + POWER)
+        self.assertEqual('!1MVLUP\n!1PWR01\n', self.onkyo_tr.value())
+
+    def testPartialLines(self):
+        self.proto.dataReceived(VOLUME_UP[:10])
+        self.assertEqual('', self.onkyo_tr.value())
+        self.proto.dataReceived(VOLUME_UP[10:] + POWER[:5])
+        self.assertEqual('!1MVLUP\n', self.onkyo_tr.value())
+        self.proto.dataReceived(POWER[5:])
+        self.assertEqual('!1MVLUP\n!1PWR01\n', self.onkyo_tr.value())
+
+    def testUnmapped(self):
+        self.proto.dataReceived('000000037c9e0003 00 KEY_DVD RC-690M\n'
+                                '000000037c9e0001 00 KEY_VOLUMEUP other\n'
+                                'garbage\n')
+        self.assertEqual('', self.onkyo_tr.value())
+
+    def testReplySkipped(self):
+        self.proto.dataReceived('BEGIN\nSIGHUP\nSUCCESS\nEND\n' + POWER)
+        self.assertEqual('!1PWR01\n', self.onkyo_tr.value())
+
+    def testResponsesIgnored(self):
+        self.onkyo.lineReceived('!1PWR01\x1a')
+        self.assertEqual('', self.tr.value())
+
+    def testLineTooLong(self):
+        self.proto.dataReceived('x' * (lircd.MAX_LENGTH + 1))
+        self.assertTrue(self.tr.disconnecting)
+
+    def testKeymapReloaded(self):
+        self.proto.dataReceived(VOLUME_UP)
+        with open(self.keymap.path, 'w') as f:
+            f.write(LIRCRC.replace('level-up', 'level-down'))
+        self.keymap.reload()
+        self.proto.dataReceived(VOLUME_UP)
+        self.assertEqual('!1MVLUP\n!1MVLDOWN\n', self.onkyo_tr.value())
+
+    def testRepeatFilter(self):
+        self.factory.repeat_filter = repeat.RepeatFilter(clock=task.Clock())
+        self.proto.dataReceived(VOLUME_UP * 3)
+        self.assertEqual('!1MVLUP\n', self.onkyo_tr.value())
+
+    def testConnectionLost(self):
+        self.proto.connectionLost(None)
+        self.assertEqual({}, self.keymap._cbs)
+        self.assertIsNone(self.proto.commands)
+
+
+class FakeLircd(protocol.Protocol):
+    """Stand-in lircd, sends each client a button press."""
+
+    def connectionMade(self):
+        self.transport.write(self.factory.line)
+
+
+class LircdServiceTestCase(LircdTestCase):
+    """Against a local stand-in for the lircd socket."""
+
+    def setUp(self):
+        LircdTestCase.setUp(self)
+        self.path = self.mktemp()
+        self.server = protocol.Factory()
+        self.server.protocol = FakeLircd
+        self.server.line = POWER
+        self.port = None
+        self.service = lircd.LircdClientService(
+                self.path,
+                lambda: command.CommandPortFactory(self.onkyo),
+                self.keymap)
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        self.service.stopService()
+        if self.port is not None:
+            return self.port.stopListening()
+
+    def listen(self):
+        self.port = reactor.listenUNIX(self.path, self.server)
+
+    @defer.inlineCallbacks
+    def waitForWrite(self):
+        for _ in xrange(100):
+            if self.onkyo_tr.value():
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
+    def testRepeats(self):
+        # Sent every 2nd repeat, after the first is ignored.
+        self.server.line = held('KEY_POWER', 3) + held('KEY_VOLUMEDOWN', 6)
+        self.listen()
+        self.service.startService()
+        yield self.waitForWrite()
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(['!1PWR01', '!1MVLDOWN', '!1MVLDOWN', '!1MVLDOWN'],
+                         self.onkyo_tr.value().splitlines())
+
+    @defer.inlineCallbacks
+    def testConnect(self):
+        self.listen()
+        self.service.startService()
+        yield self.waitForWrite()
+        self.assertEqual('!1PWR01\n', self.onkyo_tr.value())
+
+    @defer.inlineCallbacks
+    def testReconnect(self):
+        self.service.startService()
+        factory = self.service.factory
+        factory.initialDelay = factory.delay = factory.maxDelay = 0.01
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual('', self.onkyo_tr.value())
+        self.assertTrue(factory.retries)
+        self.listen()
+        yield self.waitForWrite()
+        self.assertEqual('!1PWR01\n', self.onkyo_tr.value())
@@ -0,0 +1,61 @@
+import os
+
+from .. import macros
+from .. import translate
+
+from twisted.trial import unittest
+
+
+class CompileBatchTestCase(unittest.TestCase):
+    def testCompile(self):
+        self.assertEqual(
+                ('!1PWR01', '!1SLI10', '!1MVL28'),
+                macros.compileBatch(
+                        'system-power=on; input-selector=dvd;MVL28;'))
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, macros.compileBatch,
+                          'system-power=on; bogus')
+        self.assertRaises(ValueError, macros.compileBatch, ' ; ')
+
+    def testIsBatch(self):
+        self.assertTrue(macros.isBatch('PWR01;MVL28'))
+        self.assertFalse(macros.isBatch('PWR01'))
+
+
+class LoadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+    def testLoad(self):
+        self.write('[macros]\n'
+                   'Movie-Night = system-power=on; input-selector=dvd;\n'
+                   '    master-volume=40\n'
+                   'bedtime = MVL0A\n')
+        translator = translate.CommandTranslator()
+        loaded = macros.load(self.path, translator)
+        self.assertEqual({'movie-night': ('!1PWR01', '!1SLI10', '!1MVL28'),
+                          'bedtime': ('!1MVL0A',)}, loaded)
+        # Compiled once, up front.
+        self.assertEqual(4, translator.misses)
+
+    def testNoSection(self):
+        self.write('[other]\nfoo = bar\n')
+        self.assertEqual({}, macros.load(self.path))
+
+    def testInvalidMacro(self):
+        self.write('[macros]\nbroken = system-power=on; bogus\n')
+        e = self.assertRaises(ValueError, macros.load, self.path)
+        self.assertIn('broken', e.args[0])
+
+    def testMissing(self):
+        self.assertFalse(os.path.exists(self.path))
+        self.assertRaises(ValueError, macros.load, self.path)
+
+    def testUnparseable(self):
+        self.write('macros = no section\n')
+        self.assertRaises(ValueError, macros.load, self.path)
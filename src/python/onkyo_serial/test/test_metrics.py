@@ -0,0 +1,74 @@
+from .. import iscp
+from .. import metrics
+
+import mock
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.web.test import requesthelper
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def testCounter(self):
+        c = self.registry.counter('hits_total', 'Hits.', ['code'])
+        c.inc(labels=('MVL',))
+        c.inc(2, labels=('MVL',))
+        self.assertIs(c, self.registry.counter('hits_total', 'Hits.'))
+        self.assertIn('hits_total{code="MVL"} 3.0', self.registry.render())
+
+    def testHistogram(self):
+        h = self.registry.histogram('latency_seconds', 'Latency.',
+                                    buckets=(0.1, 1))
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+        text = self.registry.render()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count 3', text)
+
+    def testCallback(self):
+        self.registry.callback('depth', 'Depth.', 'gauge', lambda: 4)
+        self.assertIn('depth 4.0', self.registry.render())
+
+    def testTypeMismatch(self):
+        self.registry.counter('x', 'X.')
+        self.assertRaises(TypeError, self.registry.histogram, 'x', 'X.')
+
+    def testResource(self):
+        self.registry.counter('hits_total', 'Hits.').inc()
+        request = requesthelper.DummyRequest([''])
+        body = metrics.MetricsResource(self.registry).render_GET(request)
+        self.assertIn('hits_total 1.0', body)
+
+    def testISCPHooks(self):
+        proto = iscp.ISCP()
+        proto.makeConnection(proto_helpers.StringTransport())
+        latency = metrics.REGISTRY['onkyo_serial_iscp_response_latency_seconds']
+        count = latency.count
+        proto.lineReceived('!1PWR01')
+        self.assertEqual(count + 1, latency.count)
+
+    def testUnansweredLatency(self):
+        proto = iscp.ISCP()
+        latency = metrics.REGISTRY['onkyo_serial_iscp_response_latency_seconds']
+        with mock.patch.object(metrics, 'now', return_value=0):
+            proto.makeConnection(proto_helpers.StringTransport())
+        count, total = latency.count, latency.sum
+        # The query at connection went unanswered, this is unsolicited.
+        with mock.patch.object(metrics, 'now', return_value=60):
+            proto.lineReceived('!1PWR01')
+        self.assertEqual(count, latency.count)
+        # And a stale send doesn't hide newer ones.
+        with mock.patch.object(metrics, 'now', return_value=100):
+            proto.sendLine('!1MVLQSTN')
+        with mock.patch.object(metrics, 'now', return_value=200):
+            proto.sendLine('!1MVLQSTN')
+        with mock.patch.object(metrics, 'now', return_value=201):
+            proto.lineReceived('!1MVL20')
+        self.assertEqual(count + 1, latency.count)
+        self.assertEqual(total + 1, latency.sum)
@@ -0,0 +1,117 @@
+from .. import iscp
+from .. import ramp
+from .. import scheduler
+
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+
+class StepsTestCase(unittest.TestCase):
+    def testLinear(self):
+        self.assertEqual([(0.5, 10), (1.0, 20), (1.5, 30), (2.0, 40)],
+                         ramp.steps(0, 40, 2.0, interval=0.5))
+
+    def testDown(self):
+        self.assertEqual([(1.0, 20), (2.0, 0)],
+                         ramp.steps(40, 0, 2.0, interval=1.0))
+
+    def testNoRepeatedLevels(self):
+        planned = ramp.steps(10, 13, 2.0, interval=0.2)
+        self.assertEqual([11, 12, 13], [level for _, level in planned])
+
+    def testCurves(self):
+        for curve in ramp.CURVES:
+            planned = ramp.steps(0, 50, 2.0, interval=0.2, curve=curve)
+            levels = [level for _, level in planned]
+            self.assertEqual(50, levels[-1])
+            self.assertEqual(sorted(levels), levels)
+            self.assertLessEqual(planned[-1][0], 2.0)
+        linear = dict(ramp.steps(0, 50, 2.0, curve=ramp.LINEAR))
+        ease_in = dict(ramp.steps(0, 50, 2.0, curve=ramp.EASE_IN))
+        self.assertLess(ease_in[1.0], linear[1.0])
+
+    def testInstant(self):
+        self.assertEqual([(0, 40)], ramp.steps(10, 40, 0))
+        self.assertEqual([], ramp.steps(40, 40, 2.0))
+
+
+class RampTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.onkyo = iscp.ISCP()
+        self.onkyo.clock = self.clock
+        self.tr = proto_helpers.StringTransport()
+        self.onkyo.makeConnection(self.tr)
+        self.onkyo.lineReceived('!1MVL14\x1a')
+        self.tr.clear()
+
+    def written(self):
+        return self.tr.value().split(self.onkyo.send_delimiter)[:-1]
+
+    def testRamp(self):
+        d = self.onkyo.ramp(40, duration=1.0)
+        self.assertEqual([], self.written())
+        self.clock.pump([0.2] * 5)
+        self.assertEqual(['!1MVL18', '!1MVL1C', '!1MVL20', '!1MVL24',
+                          '!1MVL28'], self.written())
+        self.assertEqual('MVL28', self.successResultOf(d))
+
+    def testDefaults(self):
+        d = self.onkyo.ramp(40, duration=None, curve=None)
+        self.clock.advance(ramp.DEFAULT_DURATION)
+        self.assertEqual('MVL28', self.successResultOf(d))
+        defaults = self.written()
+        self.tr.clear()
+        self.onkyo.lineReceived('!1MVL14\x1a')
+        self.onkyo.ramp(40, duration=ramp.DEFAULT_DURATION, curve=ramp.LINEAR)
+        self.clock.advance(ramp.DEFAULT_DURATION)
+        self.assertEqual(defaults, self.written())
+
+    def testQueriesUnknownLevel(self):
+        self.onkyo.receiver_state = type(self.onkyo.receiver_state)(
+                clock=self.clock)
+        d = self.onkyo.ramp(40, duration=0)
+        self.assertEqual(['!1MVLQSTN'], self.written())
+        self.onkyo.lineReceived('!1MVL20\x1a')
+        self.assertEqual(['!1MVLQSTN', '!1MVL28'], self.written())
+        self.successResultOf(d)
+
+    def testSuperseded(self):
+        first = self.onkyo.ramp(40, duration=1.0)
+        self.clock.advance(0.2)
+        second = self.onkyo.ramp(0, duration=0)
+        f = self.failureResultOf(first, defer.CancelledError)
+        self.assertIn('Superseded', f.getErrorMessage())
+        self.assertEqual('MVL00', self.successResultOf(second))
+        self.clock.advance(1)
+        self.assertEqual(['!1MVL18', '!1MVL00'], self.written())
+
+    def testCancel(self):
+        d = self.onkyo.ramp(40, duration=1.0)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def testConnectionLost(self):
+        d = self.onkyo.ramp(40, duration=1.0)
+        self.onkyo.connectionLost(error.ConnectionDone())
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, self.onkyo.ramp, 101)
+        self.assertRaises(ValueError, self.onkyo.ramp, 40, duration=-1)
+        self.assertRaises(ValueError, self.onkyo.ramp, 40, curve='bogus')
+
+    def testPacedToLink(self):
+        self.onkyo.scheduler = scheduler.WriteScheduler(
+                self.onkyo.sendLine, baudrate=300, gap=0.5, clock=self.clock)
+        interval = (self.onkyo.scheduler.transmitTime('!1MVL00') +
+                    self.onkyo.scheduler.gap)
+        self.onkyo.ramp(40, duration=2.0)
+        self.clock.pump([0.1] * 25)
+        self.assertEqual(int(2.0 / interval), len(self.written()))
+        self.assertEqual('!1MVL28', self.written()[-1])
@@ -0,0 +1,73 @@
+from .. import repeat
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+
+class RepeatFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.filter = repeat.RepeatFilter(clock=self.clock)
+
+    def testPassThrough(self):
+        self.assertEqual(['system-power=on', 'input-selector=dvd'],
+                         self.filter.filter(['system-power=on',
+                                             'input-selector=dvd']))
+        self.assertEqual(0, self.filter.dropped)
+
+    def testCollapse(self):
+        self.assertEqual(['input-selector=dvd'],
+                         self.filter.filter(['input-selector=dvd'] * 3))
+        self.assertEqual(2, self.filter.dropped)
+
+    def testNetSteps(self):
+        self.assertEqual(
+                ['!1MVLDOWN'],
+                self.filter.filter(['master-volume=level-up'] +
+                                   ['master-volume=level-down'] * 2))
+
+    def testNetZero(self):
+        self.assertEqual([], self.filter.filter(['master-volume=level-up',
+                                                 'master-volume=level-down']))
+
+    def testDebounce(self):
+        self.assertEqual(['!1MVLUP'],
+                         self.filter.filter(['master-volume=level-up']))
+        self.clock.advance(0.1)
+        self.assertEqual([], self.filter.filter(['master-volume=level-up']))
+        self.clock.advance(0.1)
+        self.assertEqual(['!1MVLUP'],
+                         self.filter.filter(['master-volume=level-up']))
+        # The other direction is a different key.
+        self.assertEqual(['!1MVLDOWN'],
+                         self.filter.filter(['master-volume=level-down']))
+
+    def testInterval(self):
+        self.assertEqual(['audio-muting=toggle'],
+                         self.filter.filter(['audio-muting=toggle']))
+        self.clock.advance(0.3)
+        self.assertEqual([], self.filter.filter(['audio-muting=toggle']))
+        self.clock.advance(0.3)
+        self.assertEqual(['audio-muting=toggle'],
+                         self.filter.filter(['audio-muting=toggle']))
+
+    def testAcceleration(self):
+        sent = []
+        for _ in xrange(14):
+            sent.extend(self.filter.filter(['master-volume=level-up']))
+            self.clock.advance(0.25)
+        self.assertEqual(['!1MVLUP'] * 4 + ['repeat 2 !1MVLUP'] * 6 +
+                         ['repeat 4 !1MVLUP'] * 4, sent)
+
+    def testReleased(self):
+        for _ in xrange(6):
+            self.filter.filter(['master-volume=level-up'])
+            self.clock.advance(0.25)
+        self.clock.advance(repeat.DEFAULT_HOLD_TIMEOUT)
+        self.assertEqual(['!1MVLUP'],
+                         self.filter.filter(['master-volume=level-up']))
+
+    def testUntranslatable(self):
+        self.assertEqual(['bogus', 'subscribe all'],
+                         self.filter.filter(['bogus', 'bogus',
+                                             'subscribe all']))
@@ -0,0 +1,137 @@
+from .. import iscp
+from .. import scheduler
+from .. import state
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+
+class WriteSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.written = []
+        self.scheduler = scheduler.WriteScheduler(
+                self.written.append, baudrate=9600, gap=0.05, clock=self.clock)
+
+    def testPacing(self):
+        self.scheduler.schedule('!1PWR01')
+        self.scheduler.schedule('!1MVL20')
+        self.assertEqual(['!1PWR01'], self.written)
+        self.assertEqual(1, self.scheduler.depth)
+        self.clock.advance(0.05)
+        self.assertEqual(['!1PWR01'], self.written)
+        self.clock.advance(self.scheduler.transmitTime('!1PWR01'))
+        self.assertEqual(['!1PWR01', '!1MVL20'], self.written)
+        self.assertEqual(0, self.scheduler.depth)
+
+    def testPriority(self):
+        self.scheduler.schedule('!1PWR01')
+        self.scheduler.schedule('!1MVLQSTN', scheduler.BACKGROUND)
+        self.scheduler.schedule('!1MVLUP', scheduler.INTERACTIVE)
+        self.assertEqual(1, self.scheduler.queueDepth(scheduler.BACKGROUND))
+        self.clock.pump([0.1, 0.1])
+        self.assertEqual(['!1PWR01', '!1MVLUP', '!1MVLQSTN'], self.written)
+
+    def testClear(self):
+        self.scheduler.schedule('!1PWR01')
+        self.scheduler.schedule('!1MVL20')
+        self.scheduler.clear()
+        self.clock.advance(1)
+        self.assertEqual(['!1PWR01'], self.written)
+        self.assertEqual(0, len(self.clock.getDelayedCalls()))
+
+
+class CoalesceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.written = []
+        self.state = state.ReceiverState(ttl=10, unsolicited=(),
+                                         clock=self.clock)
+        self.scheduler = scheduler.WriteScheduler(
+                self.written.append, clock=self.clock, state=self.state)
+        # Occupy the link, so that everything else stays queued.
+        self.scheduler.schedule('!1PWR01')
+
+    def flush(self):
+        self.clock.pump([0.1] * 20)
+        return self.written[1:]
+
+    def testAbsoluteSupersedes(self):
+        for level in range(0x20, 0x30):
+            self.scheduler.schedule('!1MVL{:02X}'.format(level))
+        self.assertEqual(1, self.scheduler.depth)
+        self.assertEqual(['!1MVL2F'], self.flush())
+
+    def testStepsOnLevel(self):
+        self.scheduler.schedule('!1MVL20')
+        self.scheduler.schedule('!1MVLUP')
+        self.scheduler.schedule('!1MVLUP')
+        self.assertEqual(['!1MVL22'], self.flush())
+
+    def testNetSteps(self):
+        self.state.update('MVL', '20')
+        for _ in range(5):
+            self.scheduler.schedule('!1MVLUP')
+        self.scheduler.schedule('!1MVLDOWN')
+        self.assertEqual(['!1MVL24'], self.flush())
+
+    def testNetStepsStaleLevel(self):
+        self.state.update('MVL', '20')
+        self.clock.advance(11)
+        self.scheduler.schedule('!1PWR01')
+        for _ in range(3):
+            self.scheduler.schedule('!1MVLUP')
+        self.assertEqual(['!1PWR01'] + ['!1MVLUP'] * 3, self.flush())
+
+    def testNetStepsAfterDisconnect(self):
+        self.state.update('MVL', '20')
+        self.state.disconnected()
+        for _ in range(3):
+            self.scheduler.schedule('!1MVLUP')
+        self.assertEqual(['!1MVLUP'] * 3, self.flush())
+
+    def testNetStepsUnknownLevel(self):
+        self.scheduler.schedule('!1SLIUP')
+        self.scheduler.schedule('!1SLIUP')
+        self.assertEqual(['!1SLIUP', '!1SLIUP'], self.flush())
+
+    def testStepsCancel(self):
+        self.scheduler.schedule('!1MVLUP')
+        self.scheduler.schedule('!1MVLDOWN')
+        self.assertEqual(0, self.scheduler.depth)
+        self.assertEqual([], self.flush())
+
+    def testStepsChangeDirection(self):
+        self.scheduler.schedule('!1MVLUP')
+        self.scheduler.schedule('!1MVLDOWN')
+        self.scheduler.schedule('!1MVLDOWN')
+        self.assertEqual(['!1MVLDOWN'], self.flush())
+
+    def testDuplicateQuery(self):
+        self.scheduler.schedule('!1MVLQSTN', scheduler.BACKGROUND)
+        self.scheduler.schedule('!1MVLQSTN', scheduler.BACKGROUND)
+        self.assertEqual(['!1MVLQSTN'], self.flush())
+
+    def testNotCoalesced(self):
+        self.scheduler.schedule('!1OSDUP')
+        self.scheduler.schedule('!1OSDUP')
+        self.scheduler.schedule('!1OSDDOWN')
+        self.assertEqual(['!1OSDUP', '!1OSDUP', '!1OSDDOWN'], self.flush())
+
+
+class ISCPSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proto = iscp.ISCP()
+        self.proto.scheduler = scheduler.WriteScheduler(
+                self.proto.sendLine, clock=self.clock)
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def testCommand(self):
+        self.proto.command('system-power=on')
+        self.assertEqual('!1PWRQSTN' + self.proto.send_delimiter,
+                         self.tr.value())
+        self.clock.advance(1)
+        self.assertEqual('!1PWRQSTN\n!1PWR01\n', self.tr.value())
@@ -1,10 +1,74 @@
+from .. import metrics
+from .. import scheduler
 from .. import service
+from .. import state
 
 import mock
 from twisted.trial import unittest
 from twisted.internet import protocol
+from twisted.internet import task
 from twisted.test import proto_helpers
 
 
 class ServiceTestCase(unittest.TestCase):
-    pass
+    def testClientChildServices(self):
+        connector = mock.Mock()
+        connect = mock.Mock(return_value=connector)
+        svc = service.ISCPClientService(connect, 'localhost', 7001)
+        child = mock.Mock()
+        svc.addService(child)
+        child.reset_mock()
+        svc.startService()
+        factory = connect.call_args[1]['factory']
+        self.assertFalse(child.startService.called)
+
+        p = factory.buildProtocol(None)
+        p.makeConnection(proto_helpers.StringTransport())
+        self.assertEqual(1, child.startService.call_count)
+        factory.clientConnectionLost(connector, None)
+        self.assertEqual(1, child.stopService.call_count)
+        factory.stopTrying()
+
+        svc.stopService()
+        self.assertEqual(1, child.stopService.call_count)
+        self.assertTrue(connector.disconnect.called)
+
+    def testClientPaced(self):
+        connector = mock.Mock()
+        connect = mock.Mock(return_value=connector)
+        svc = service.ISCPClientService(connect, 'localhost', 7001, gap=0.05)
+        factory = svc.getProtocol()
+        clock = task.Clock()
+        factory.clock = factory.scheduler.clock = clock
+        svc.startService()
+        self.assertNotIn('gap', connect.call_args[1])
+        for _ in range(2):
+            p = factory.buildProtocol(None)
+            self.assertIs(factory.scheduler, p.scheduler)
+            tr = proto_helpers.StringTransport()
+            p.makeConnection(tr)
+            for _ in range(3):
+                factory.command('!1OSDUP')
+            self.assertEqual(['!1PWRQSTN'],
+                             tr.value().split(p.send_delimiter)[:-1])
+            clock.pump([0.1] * 5)
+            self.assertEqual(['!1PWRQSTN'] + ['!1OSDUP'] * 3,
+                             tr.value().split(p.send_delimiter)[:-1])
+            factory.clientConnectionLost(connector, None)
+        factory.stopTrying()
+        svc.stopService()
+
+    def testRegisterMetricsPerDevice(self):
+        registry = metrics.Registry()
+        for name, code in (('/dev/ttyUSB1', 'MVL'), ('/dev/ttyUSB2', 'PWR')):
+            rs = state.ReceiverState()
+            rs.answer(code)
+            ws = scheduler.WriteScheduler(mock.Mock())
+            service.registerMetrics(rs, ws, registry, device=name)
+        text = registry.render()
+        self.assertIn('onkyo_serial_queries_total{device="/dev/ttyUSB1",'
+                      'code="MVL",result="miss"} 1.0', text)
+        self.assertIn('onkyo_serial_queries_total{device="/dev/ttyUSB2",'
+                      'code="PWR",result="miss"} 1.0', text)
+        self.assertIn('onkyo_serial_write_queue_depth{device="/dev/ttyUSB2",'
+                      'priority="0"} 0.0', text)
@@ -0,0 +1,117 @@
+import os
+
+from .. import iscp
+from .. import scheduler
+from .. import simulator
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+
+class SimulatedReceiverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sim = simulator.SimulatedReceiver(
+                processing_delay=0.05, max_pending=2,
+                unsolicited_interval=None, clock=self.clock)
+        self.tr = proto_helpers.StringTransport()
+        self.sim.makeConnection(self.tr)
+
+    def testQuery(self):
+        self.sim.dataReceived('!1PWRQSTN\n')
+        self.assertEqual('', self.tr.value())
+        self.clock.advance(0.05)
+        self.assertEqual('!1PWR01\x1a', self.tr.value())
+
+    def testSet(self):
+        self.sim.dataReceived('!1MVL30\n!1MVLUP\n')
+        self.clock.pump([0.05, 0.05])
+        self.assertEqual('!1MVL30\x1a!1MVL31\x1a', self.tr.value())
+        self.assertEqual('31', self.sim.state['MVL'])
+
+    def testBaudRate(self):
+        self.sim.respond('PWR01')
+        self.sim.respond('PWR01')
+        self.assertEqual('!1PWR01\x1a', self.tr.value())
+        self.clock.advance(8 * 10 / 9600.0)
+        self.assertEqual('!1PWR01\x1a' * 2, self.tr.value())
+
+    def testOverrun(self):
+        self.sim.dataReceived('!1PWR01\n!1PWR00\n!1PWR01\n')
+        self.assertEqual(1, self.sim.dropped)
+
+    def testUnknown(self):
+        self.sim.dataReceived('!1XXX01\n')
+        self.clock.advance(1)
+        self.assertEqual('', self.tr.value())
+
+    def testUnsolicited(self):
+        self.sim.unsolicited_interval = 1
+        self.sim.connectionMade()
+        self.clock.advance(1)
+        self.assertEqual('!1AMT00\x1a', self.tr.value())
+        self.sim.connectionLost(None)
+
+
+class SimulatorLoopbackTestCase(unittest.TestCase):
+    """Run the bridge's ISCP protocol against the simulator."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sim = simulator.SimulatedReceiver(
+                unsolicited_interval=None, clock=self.clock)
+        self.proto = iscp.ISCP()
+        self.proto.clock = self.clock
+        self.proto.scheduler = scheduler.WriteScheduler(
+                self.proto.sendLine, clock=self.clock)
+        self.sim_tr = proto_helpers.StringTransport()
+        self.proto_tr = proto_helpers.StringTransport()
+        self.sim.makeConnection(self.sim_tr)
+        self.proto.makeConnection(self.proto_tr)
+
+    def pump(self, seconds):
+        for _ in range(int(seconds / 0.01)):
+            self.clock.advance(0.01)
+            for src, dst in ((self.proto_tr, self.sim),
+                             (self.sim_tr, self.proto)):
+                data = src.value()
+                src.clear()
+                if data:
+                    dst.dataReceived(data)
+
+    def testCommands(self):
+        d = self.proto.command('master-volume=level-up', wait=True)
+        for _ in range(10):
+            self.proto.command('master-volume=level-up')
+        self.pump(2)
+        self.assertEqual('MVL21', self.successResultOf(d))
+        self.assertEqual(0, self.sim.dropped)
+        self.assertEqual('2B', self.proto.receiver_state.get('MVL'))
+
+
+class PtySimulatorServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.service = simulator.PtySimulatorService(
+                processing_delay=0, unsolicited_interval=None)
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+    def testQuery(self):
+        fd = os.open(self.service.device, os.O_RDWR | os.O_NOCTTY)
+        self.addCleanup(os.close, fd)
+        os.write(fd, '!1PWRQSTN\n')
+
+        def read():
+            self.assertEqual('!1PWR01\x1a', os.read(fd, 64))
+        return task.deferLater(reactor, 0.1, read)
+
+    def testStopClosesPty(self):
+        fds = (self.service._master, self.service._master_out,
+               self.service._slave)
+        self.service.stopService()
+        for fd in fds:
+            self.assertRaises(OSError, os.fstat, fd)
+        self.service.startService()
+        self.assertTrue(os.path.exists(self.service.device))
@@ -0,0 +1,102 @@
+import json
+
+from .. import state
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+
+class ReceiverStateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.state = state.ReceiverState(ttl=10, unsolicited=['PWR'],
+                                         clock=self.clock)
+
+    def testTTL(self):
+        self.state.update('MVL', '20')
+        self.assertEqual('20', self.state.answer('MVL'))
+        self.clock.advance(11)
+        self.assertIsNone(self.state.answer('MVL'))
+        self.assertEqual('20', self.state.get('MVL'))
+        self.assertEqual(1, self.state.hits['MVL'])
+        self.assertEqual(1, self.state.misses['MVL'])
+
+    def testUnsolicited(self):
+        self.state.update('PWR', '01')
+        self.clock.advance(100)
+        self.assertEqual('01', self.state.fresh('PWR'))
+        self.state.disconnected()
+        self.assertIsNone(self.state.fresh('PWR'))
+
+    def testInvalidate(self):
+        self.state.update('PWR', '01')
+        self.state.invalidate('PWR')
+        self.assertIsNone(self.state.fresh('PWR'))
+
+    def testUnknown(self):
+        self.assertIsNone(self.state.answer('SLI'))
+        self.assertEqual(1, self.state.misses['SLI'])
+
+
+class StateSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+        self.state = state.ReceiverState(ttl=10, clock=self.clock)
+        self.snapshot = state.StateSnapshot(self.state, self.path,
+                                            interval=60, clock=self.clock)
+
+    def restored(self):
+        rs = state.ReceiverState(ttl=10, clock=self.clock)
+        count = state.StateSnapshot(rs, self.path).load()
+        return rs, count
+
+    def testSaveAndLoad(self):
+        self.state.update('MVL', '20')
+        self.state.update('PWR', '01')
+        self.snapshot.save()
+        rs, count = self.restored()
+        self.assertEqual(2, count)
+        self.assertEqual('20', rs.fresh('MVL'))
+        self.assertEqual(set(['MVL', 'PWR']), rs.restored)
+        rs.update('MVL', '21')
+        self.assertEqual(set(['PWR']), rs.restored)
+        self.clock.advance(11)
+        self.assertIsNone(rs.fresh('PWR'))
+
+    def testPeriodic(self):
+        self.snapshot.start()
+        self.state.update('MVL', '20')
+        self.clock.advance(60)
+        self.assertEqual(1, self.restored()[1])
+        self.state.update('PWR', '01')
+        self.snapshot.stop()
+        self.assertEqual(2, self.restored()[1])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def testMissingOrCorrupt(self):
+        self.assertEqual(0, self.snapshot.load())
+        with open(self.path, 'w') as f:
+            f.write('{"version"')
+        self.assertEqual(0, self.snapshot.load())
+        self.assertEqual(0, len(self.state))
+
+    def testMalformed(self):
+        for content in ('[]', '{"version": 1, "values": []}'):
+            with open(self.path, 'w') as f:
+                f.write(content)
+            self.assertEqual(0, self.snapshot.load())
+        with open(self.path, 'w') as f:
+            json.dump({'version': state.SNAPSHOT_VERSION,
+                       'values': {'MVL': '20', 'PWR': 1, 'TOOLONG': '00',
+                                  'AMT': u'\u00e9'}}, f)
+        self.assertEqual(1, self.snapshot.load())
+        self.assertEqual('20', self.state.fresh('MVL'))
+        self.assertEqual(1, len(self.state))
+
+    def testUnknownCode(self):
+        with open(self.path, 'w') as f:
+            json.dump({'version': state.SNAPSHOT_VERSION,
+                       'values': {'MVL': '20', 'ZZZ': '00'}}, f)
+        self.assertEqual(1, self.snapshot.load())
+        self.assertEqual(set(['MVL']), self.state.restored)
@@ -0,0 +1,102 @@
+import marshal
+import os
+import subprocess
+import sys
+
+import mock
+
+from .. import benchmark
+from .. import tables
+from .. import translate
+
+from twisted.trial import unittest
+
+
+class TablesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'tables.marshal')
+        patcher = mock.patch.object(tables, '_tables', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testCompile(self):
+        compiled = tables.compileTables()
+        self.assertEqual(tables.FORMAT_VERSION, compiled['format'])
+        self.assertEqual('main', compiled['zone_mappings'][None])
+        self.assertIn('PWR', compiled['codes']['main'])
+        self.assertEqual('system-power', compiled['decoder']['PWR'][0])
+        self.assertEqual((0, 100), compiled['ranges']['MVL'])
+        # Marshallable, so it can be cached.
+        self.assertEqual(compiled, marshal.loads(marshal.dumps(compiled)))
+
+    def testBuildAndLoad(self):
+        built = tables.build(self.path)
+        self.assertTrue(os.path.exists(self.path))
+        with mock.patch.object(tables, 'cachePath', return_value=self.path):
+            with mock.patch.object(tables, 'compileTables') as compile_mock:
+                loaded = tables.load()
+                self.assertEqual(built, loaded)
+                self.assertIs(loaded, tables.load())
+                self.assertFalse(compile_mock.called)
+
+    def testStaleCache(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            marshal.dump({'format': tables.FORMAT_VERSION - 1}, f)
+        with mock.patch.object(tables, 'cachePath', return_value=self.path):
+            loaded = tables.load()
+        self.assertEqual(tables.FORMAT_VERSION, loaded['format'])
+        # And the cache is replaced.
+        self.assertEqual(loaded, tables._read(self.path))
+
+    def testCorruptCache(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write('garbage')
+        self.assertIsNone(tables._read(self.path))
+
+    def testCachePathChangesWithSource(self):
+        path = tables.cachePath()
+        with mock.patch.object(os, 'stat') as stat:
+            stat.return_value.st_size = 1
+            stat.return_value.st_mtime = 1
+            self.assertNotEqual(path, tables.cachePath())
+
+
+class TranslationTestCase(unittest.TestCase):
+    """Spot checks that the compiled tables translate like onkyo-eiscp."""
+
+    def setUp(self):
+        self.translator = translate.CommandTranslator()
+
+    def testTranslate(self):
+        from eiscp import core
+        for cmd in ['system-power=on', 'main.power:standby',
+                    'zone2.volume=50', 'master-volume=level-up',
+                    'main.speaker-a=on', 'input-selector=dvd',
+                    'master-volume 25', 'tuning=87.5']:
+            try:
+                expected = '!1' + core.command_to_iscp(cmd)
+            except ValueError:
+                self.assertRaises(ValueError, self.translator.translate, cmd)
+            else:
+                self.assertEqual(expected, self.translator.translate(cmd))
+
+    def testInvalid(self):
+        for cmd in ['bogus', 'main.bogus=on', 'system-power=bogus',
+                    'master-volume=101', 'zone9.power=on']:
+            self.assertRaises(ValueError, self.translator.translate, cmd)
+
+    def testExtraArguments(self):
+        # onkyo-eiscp raises IndexError here.
+        self.assertEqual('!1ZVL32',
+                         self.translator.translate('zone2 volume 50'))
+        self.assertEqual('!1SPA01',
+                         self.translator.translate('main speaker-a on'))
+
+    def testLazyImport(self):
+        script = ('import sys\n'
+                  'from onkyo_serial import iscp, command, translate\n'
+                  'assert "eiscp.commands" not in sys.modules\n')
+        env = dict(os.environ, PYTHONPATH=benchmark._PACKAGE_ROOT)
+        subprocess.check_call([sys.executable, '-c', script], env=env)
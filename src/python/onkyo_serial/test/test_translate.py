@@ -0,0 +1,56 @@
+from .. import translate
+
+from twisted.trial import unittest
+
+
+class CommandTranslatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.translator = translate.CommandTranslator(maxsize=2,
+                                                      negative_maxsize=1)
+
+    def testTranslate(self):
+        self.assertEqual('!1PWRQSTN',
+                         self.translator.translate('system-power=query'))
+        self.assertEqual('!1PWR01', self.translator.translate('!1PWR01'))
+        self.assertEqual('!1PWR01', self.translator.translate('PWR01'))
+
+    def testHitsAndMisses(self):
+        self.translator.translate('PWR01')
+        self.translator.translate('PWR01')
+        self.assertEqual(1, self.translator.misses)
+        self.assertEqual(1, self.translator.hits)
+
+    def testEviction(self):
+        self.translator.translate('PWR01')
+        self.translator.translate('PWR00')
+        self.translator.translate('PWR01')
+        self.translator.translate('PWRQSTN')
+        self.assertEqual(2, len(self.translator))
+        self.translator.translate('PWR00')
+        self.assertEqual(4, self.translator.misses)
+
+    def testNegativeCache(self):
+        self.assertRaises(ValueError, self.translator.translate, 'bogus')
+        self.assertRaises(ValueError, self.translator.translate, 'bogus')
+        self.assertEqual(1, self.translator.misses)
+        self.assertEqual(1, self.translator.negative_hits)
+        self.assertEqual(0, len(self.translator))
+
+
+class ResponseDecoderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.decoder = translate.ResponseDecoder()
+
+    def testDecode(self):
+        resp = self.decoder.decode('PWR01')
+        self.assertEqual('PWR01', resp)
+        self.assertEqual('PWR', resp.code)
+        self.assertEqual('01', resp.args)
+        self.assertEqual('system power=on', resp.normalized)
+
+    def testDecodeUnlisted(self):
+        resp = self.decoder.decode('MVL32')
+        self.assertEqual('master volume=32', resp.normalized)
+
+    def testDecodeInvalid(self):
+        self.assertRaises(ValueError, self.decoder.decode, 'XXX01')
@@ -0,0 +1,316 @@
+"""Translation between friendly and raw ISCP commands.
+
+Translating a command through the onkyo-eiscp tables is comparatively
+expensive, and the same handful of commands (volume keys, queries) tend
+to be sent over and over, so translations are memoized here.
+
+Responses from the receiver are decoded through a reverse index built
+once from the same tables.
+
+Both use the precompiled tables from :py:mod:`onkyo_serial.tables`,
+which are only loaded on the first lookup.
+"""
+
+import collections
+import re
+
+from . import metrics
+from . import tables as eiscp_tables
+
+__author__ = 'blaedd@gmail.com'
+
+
+class CommandTranslator(object):
+    """Bounded, memoizing translator from commands to raw ISCP.
+
+    Both human friendly and raw commands are accepted::
+
+        translator.translate('system-power=on')  # '!1PWR01'
+        translator.translate('PWR01')            # '!1PWR01'
+        translator.translate('!1PWR01')          # '!1PWR01'
+
+    Successful translations and invalid commands are kept in separate
+    least recently used caches, so a client spamming garbage cannot evict
+    the commands that are actually in use.
+
+    Attributes:
+        hits (int): number of lookups answered from the cache.
+        misses (int): number of lookups that went to the eiscp tables.
+        negative_hits (int): number of invalid commands rejected from the
+            cache.
+    """
+
+    _command_sep = re.compile('[. ]')
+    _args_sep = re.compile('[:=]')
+    _value_sep = re.compile('[ ,]')
+
+    def __init__(self, maxsize=256, negative_maxsize=64, tables=None):
+        """
+
+        Args:
+            maxsize (int): maximum number of valid translations to keep.
+            negative_maxsize (int): maximum number of invalid commands to keep.
+            tables (dict): compiled command tables, loaded on the first
+                translation by default, see :py:mod:`onkyo_serial.tables`.
+        """
+        self.tables = tables
+        self.maxsize = maxsize
+        self.negative_maxsize = negative_maxsize
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self._cache = collections.OrderedDict()
+        self._negative = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def translate(self, cmd):
+        """Translate a command to its normalized raw form.
+
+        Args:
+            cmd (str): friendly or raw ISCP command, with or without the !1
+                prefix.
+
+        Returns:
+            str: the raw command, including the !1 prefix.
+
+        Raises:
+            ValueError: if the command is not valid.
+        """
+        cache = self._cache
+        try:
+            result = cache.pop(cmd)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            cache[cmd] = result
+            return result
+
+        negative = self._negative
+        try:
+            error = negative.pop(cmd)
+        except KeyError:
+            pass
+        else:
+            self.negative_hits += 1
+            negative[cmd] = error
+            raise ValueError(error)
+
+        self.misses += 1
+        try:
+            result = self._translate(cmd)
+        except ValueError, e:
+            self._store(negative, self.negative_maxsize, cmd, e.args[0])
+            raise
+        self._store(cache, self.maxsize, cmd, result)
+        return result
+
+    def clear(self):
+        """Forget all cached translations."""
+        self._cache.clear()
+        self._negative.clear()
+
+    @staticmethod
+    def _store(cache, maxsize, key, value):
+        if len(cache) >= maxsize:
+            cache.popitem(last=False)
+        cache[key] = value
+
+    def _translate(self, cmd):
+        if self.tables is None:
+            self.tables = eiscp_tables.load()
+        if cmd.startswith('!1'):
+            cmd = cmd[2:]
+        try:
+            return '!1{}'.format(self._commandToISCP(cmd))
+        except ValueError:
+            # Not a friendly command, so it should be a raw one.
+            if cmd[:3] not in self.tables['decoder']:
+                raise ValueError(
+                        'Cannot convert ISCP message to command: %s' % cmd)
+            return '!1{}'.format(cmd)
+
+    def _commandToISCP(self, command):
+        """Same as `eiscp.core.command_to_iscp`, for a single string.
+
+        Where it differs:
+
+        - commands it fails on with something other than a ValueError are
+          rejected with a ValueError.
+        - 'zone command argument' works.
+        - levels are accepted if they are in any of a command's ranges,
+          onkyo-eiscp only checks whichever range its dict happens to list
+          first, which varies between processes.
+        """
+        tables = self.tables
+        norm = lambda s: s.strip().lower()
+        if ':' in command or '=' in command:
+            base, arguments = self._args_sep.split(command, 1)
+            parts = [norm(c) for c in self._command_sep.split(base)]
+            if len(parts) == 2:
+                zone, command = parts
+            else:
+                zone = 'main'
+                command = parts[0]
+            argument = norm(self._value_sep.split(arguments)[0])
+        else:
+            parts = [norm(c) for c in self._command_sep.split(command)]
+            if len(parts) >= 3:
+                # onkyo-eiscp takes the argument from parts[3:], and so
+                # fails on 'zone2 volume 50'.
+                zone, command, argument = parts[:3]
+            elif len(parts) == 2:
+                zone = 'main'
+                command, argument = parts
+            else:
+                raise ValueError('Need at least command and argument')
+
+        group = tables['zone_mappings'].get(zone, zone)
+        if zone not in tables['codes']:
+            raise ValueError('"%s" is not a valid zone' % zone)
+        prefix = tables['command_mappings'].get(group, {}).get(command, command)
+        if prefix not in tables['codes'][group]:
+            raise ValueError('"%s" is not a valid command in zone "%s"'
+                             % (command, zone))
+
+        try:
+            aliases, level_ranges = tables['value_mappings'][group][prefix]
+        except KeyError:
+            aliases, level_ranges = {}, ()
+        try:
+            value = aliases[argument]
+        except KeyError:
+            if not (argument.isdigit() and
+                    self._inRange(int(argument), level_ranges)):
+                raise ValueError('"%s" is not a valid argument for command '
+                                 '"%s" in zone "%s"' % (argument, command, zone))
+            value = '{:X}'.format(int(argument))
+        return '%s%s' % (prefix, value)
+
+    @staticmethod
+    def _inRange(level, level_ranges):
+        for first, last, step in level_ranges:
+            if first <= level <= last and (level - first) % step == 0:
+                return True
+        return False
+
+
+class Response(str):
+    """A raw ISCP response (without the !1 prefix), decoded once.
+
+    This is a plain string as far as callbacks are concerned, but also
+    carries the decoded form so that subscribers don't each need to go
+    back to the eiscp tables.
+
+    Attributes:
+        code (str): the three character ISCP command, eg. PWR
+        args (str): the command arguments, eg. 01
+        name (str|tuple): the command name(s) as per onkyo-eiscp.
+        value (str|tuple|int): the decoded argument as per onkyo-eiscp.
+        normalized (str): human friendly form, eg. system power=on
+    """
+
+    def __new__(cls, line, name, value, normalized):
+        self = str.__new__(cls, line)
+        self.code = line[:3]
+        self.args = line[3:]
+        self.name = name
+        self.value = value
+        self.normalized = normalized
+        return self
+
+
+class ResponseDecoder(object):
+    """Reverse index from ISCP code and argument to decoded responses.
+
+    The index is built once from the onkyo-eiscp tables, and mirrors
+    :py:func:`eiscp.core.iscp_to_command`.
+    """
+
+    _hex_re = re.compile('[+-]?[0-9a-f]$', re.IGNORECASE)
+
+    def __init__(self, tables=None):
+        """
+
+        Args:
+            tables (dict): compiled command tables, loaded on first use by
+                default, see :py:mod:`onkyo_serial.tables`.
+        """
+        self._index = None
+        self._ranges = None
+        if tables is not None:
+            self._setTables(tables)
+
+    def _setTables(self, tables):
+        self._index = tables['decoder']
+        self._ranges = tables['ranges']
+
+    def _load(self):
+        self._setTables(eiscp_tables.load())
+
+    @staticmethod
+    def _decoded(name, value):
+        cmd_name = name[0] if isinstance(name, tuple) else name
+        normalized = '{}={}'.format(eiscp_tables._normalize(cmd_name), value)
+        return name, value, normalized
+
+    def __contains__(self, code):
+        if self._index is None:
+            self._load()
+        return code in self._index
+
+    def levelRange(self, code):
+        """Return the (low, high) range of levels a command accepts.
+
+        Args:
+            code (str): three character ISCP command.
+
+        Returns:
+            tuple: the range, or None if the command doesn't take a level.
+        """
+        if self._ranges is None:
+            self._load()
+        return self._ranges.get(code)
+
+    def decode(self, line):
+        """Decode a raw ISCP response.
+
+        Args:
+            line (str): response, without the !1 prefix or terminator.
+
+        Returns:
+            Response: the decoded response.
+
+        Raises:
+            ValueError: if the command is not known.
+        """
+        if self._index is None:
+            self._load()
+        try:
+            name, values = self._index[line[:3]]
+        except KeyError:
+            raise ValueError(
+                    'Cannot convert ISCP message to command: %s' % line)
+        args = line[3:]
+        try:
+            decoded = values[args]
+        except KeyError:
+            if self._hex_re.match(args):
+                decoded = self._decoded(name, int(args, 16))
+            else:
+                decoded = self._decoded(name, args)
+        return Response(line, *decoded)
+
+
+# Translations don't depend on the device, so one cache is shared by default.
+TRANSLATOR = CommandTranslator()
+DECODER = ResponseDecoder()
+
+metrics.REGISTRY.callback(
+        'onkyo_serial_translations_total',
+        'Command translations, by cache result.', 'counter',
+        lambda: {('hit',): TRANSLATOR.hits, ('miss',): TRANSLATOR.misses,
+                 ('invalid',): TRANSLATOR.negative_hits},
+        ('result',))